@@ -12,13 +12,22 @@ from matplotlib.ticker import AutoMinorLocator
 import heartpy as hp
 
 import ECGMetaData
+from dtype_policy import DEFAULT_DTYPE_POLICY
 import scipy.signal as sgn
 
 
 class ECGGenerator(object):
     def __init__(self, ecg_data, ecg_meta_data: ECGMetaData.ECGMetaData = None,
-                 to_preprocess=False): #TODO chnage to_preprocess to True
-        self.ecg_data = ecg_data
+                 to_preprocess=False, dtype_policy=DEFAULT_DTYPE_POLICY,
+                 adc_gain=None, baseline=0): #TODO chnage to_preprocess to True
+        # ecg_data is in mV, or ADC values (e.g. a signal store's stored signal) converted with adc_gain and baseline
+        self.dtype_policy = dtype_policy
+        if np.issubdtype(np.asarray(ecg_data).dtype, np.integer):
+            if adc_gain is None:
+                raise ValueError("ADC ecg_data needs the adc_gain (and baseline) of the record to be converted to mV")
+            self.ecg_data = dtype_policy.to_compute(ecg_data, adc_gain, baseline)
+        else:
+            self.ecg_data = np.asarray(ecg_data).astype(dtype_policy.get_compute_dtype(), copy=False)
         # if to_normalize:
         #    self.__normalize_ecg_data__()
         self.ecg_meta_data = ecg_meta_data
@@ -256,6 +265,7 @@ class ECGGenerator(object):
 
         self.ecg_data = sgn.sosfiltfilt(self.__remove_baseline_filter__(self.ecg_meta_data.get_sample_rate()),
                                         self.ecg_data, padtype='constant', axis=-1) #supose to put the signal in the middle
+        self.ecg_data = self.ecg_data.astype(self.dtype_policy.get_compute_dtype(), copy=False)
 
         # self.ecg_data = hp.filter_signal(self.ecg_data, cutoff=40,
         #                                     sample_rate=self.ecg_meta_data.get_sample_rate(), order=5,
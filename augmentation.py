@@ -0,0 +1,182 @@
+import time
+
+import numpy as np
+from torch.utils.data import get_worker_info
+
+DEFAULT_SAMPLE_RATE = 500
+
+
+class GaussianNoise:
+    """
+    Add white gaussian noise of std mV to the signals.
+    """
+    def __init__(self, std=0.01, p=0.5):
+        self.std = std
+        self.p = p
+
+    def __call__(self, batch, rng):
+        noise = rng.standard_normal(batch.shape, dtype=np.float32)
+        noise *= self.std
+        batch += noise
+
+
+class BaselineWander:
+    """
+    Add a slow sinusoidal baseline wander (e.g. breathing) of up to amplitude mV and max_freq Hz, with the
+    same frequency on every lead and a random phase and amplitude per lead.
+    """
+    def __init__(self, amplitude=0.2, min_freq=0.05, max_freq=0.5, sample_rate=DEFAULT_SAMPLE_RATE, p=0.5):
+        self.amplitude = amplitude
+        self.min_freq = min_freq
+        self.max_freq = max_freq
+        self.sample_rate = sample_rate
+        self.p = p
+
+    def __call__(self, batch, rng):
+        batch_size, num_leads, num_samples = batch.shape
+        freqs = rng.uniform(self.min_freq, self.max_freq, size=(batch_size, 1, 1)).astype(np.float32)
+        phases = rng.uniform(0, 2 * np.pi, size=(batch_size, num_leads, 1)).astype(np.float32)
+        amplitudes = rng.uniform(0, self.amplitude, size=(batch_size, num_leads, 1)).astype(np.float32)
+        times = np.arange(num_samples, dtype=np.float32) / np.float32(self.sample_rate)
+        wander = 2 * np.pi * freqs * times + phases
+        np.sin(wander, out=wander)
+        wander *= amplitudes
+        batch += wander
+
+
+class PowerlineInterference:
+    """
+    Add a powerline interference of up to amplitude mV at one of freqs Hz (50 or 60 by default).
+    """
+    def __init__(self, amplitude=0.05, freqs=(50, 60), sample_rate=DEFAULT_SAMPLE_RATE, p=0.5):
+        self.amplitude = amplitude
+        self.freqs = np.asarray(freqs, dtype=np.float32)
+        self.sample_rate = sample_rate
+        self.p = p
+
+    def __call__(self, batch, rng):
+        batch_size, num_leads, num_samples = batch.shape
+        freqs = rng.choice(self.freqs, size=(batch_size, 1, 1))
+        phases = rng.uniform(0, 2 * np.pi, size=(batch_size, 1, 1)).astype(np.float32)
+        amplitudes = rng.uniform(0, self.amplitude, size=(batch_size, num_leads, 1)).astype(np.float32)
+        times = np.arange(num_samples, dtype=np.float32) / np.float32(self.sample_rate)
+        interference = 2 * np.pi * freqs * times + phases
+        np.sin(interference, out=interference)
+        batch += interference * amplitudes
+
+
+class LeadDropout:
+    """
+    Zero every lead with probability lead_p, keeping at least one lead of every signal.
+    """
+    def __init__(self, lead_p=0.1, p=0.5):
+        self.lead_p = lead_p
+        self.p = p
+
+    def __call__(self, batch, rng):
+        batch_size, num_leads, _ = batch.shape
+        dropped = rng.random((batch_size, num_leads)) < self.lead_p
+        dropped[dropped.all(axis=1), rng.integers(num_leads)] = False
+        batch[dropped] = 0
+
+
+class AmplitudeScaling:
+    """
+    Scale every signal by a random factor in [low, high].
+    """
+    def __init__(self, low=0.8, high=1.2, p=0.5):
+        self.low = low
+        self.high = high
+        self.p = p
+
+    def __call__(self, batch, rng):
+        scales = rng.uniform(self.low, self.high, size=len(batch)).astype(np.float32)
+        batch *= scales[:, None, None]
+
+
+class BatchAugmentation:
+    """
+    This class is used to augment whole collated batches of signals, shaped (batch, leads, samples) in mV,
+    with vectorized operations instead of a per sample loop in __getitem__.
+    Every augmentation is applied to a random subset of the batch (each signal with probability p of the
+    augmentation), computing on the selected signals only. The batch is modified in place, missing samples
+    (nans) stay missing unless their lead is dropped.
+    The random generator is seeded by (seed, epoch, worker id), so every DataLoader worker draws a different
+    and reproducible stream, call set_epoch to change it every epoch.
+    Pass it as the batch_transform of ECGDataset (or IterableECGDataset), it runs in collate_fn.
+    Example:
+        augmentation = BatchAugmentation([GaussianNoise(), BaselineWander(), LeadDropout()], seed=0)
+        dataset = ECGDataset(signal_store=store, batch_transform=augmentation)
+        data_loader = DataLoader(dataset, batch_size=64, num_workers=8, collate_fn=dataset.collate_fn)
+    """
+    def __init__(self, augmentations=None, seed=0):
+        self.augmentations = default_augmentations() if augmentations is None else augmentations
+        self.seed = seed
+        self.epoch = 0
+        self.rng = None
+        self.rng_key = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __get_rng__(self):
+        worker_info = get_worker_info()
+        rng_key = (self.seed, self.epoch, 0 if worker_info is None else worker_info.id)
+        if rng_key != self.rng_key:
+            self.rng = np.random.default_rng(rng_key)
+            self.rng_key = rng_key
+        return self.rng
+
+    def __call__(self, batch):
+        """
+        Augment a batch in place.
+        Args:
+            batch: the signals, a float array shaped (batch, leads, samples).
+        Returns:
+            The augmented batch.
+        """
+        rng = self.__get_rng__()
+        for augmentation in self.augmentations:
+            selected = np.flatnonzero(rng.random(len(batch)) < augmentation.p)
+            if len(selected) == len(batch):
+                augmentation(batch, rng)
+            elif len(selected):
+                selected_batch = batch[selected]
+                augmentation(selected_batch, rng)
+                batch[selected] = selected_batch
+        return batch
+
+
+def default_augmentations(sample_rate=DEFAULT_SAMPLE_RATE):
+    return [GaussianNoise(), BaselineWander(sample_rate=sample_rate), PowerlineInterference(sample_rate=sample_rate),
+            LeadDropout(), AmplitudeScaling()]
+
+
+def benchmark(batch_size=64, num_leads=12, num_samples=5000, repeats=20):
+    """
+    Time every augmentation on a batch, vectorized and per sample.
+    Returns:
+        A dict from every augmentation name to its (batch, per sample) cost in ms per batch.
+    """
+    signals = np.random.default_rng(0).standard_normal((batch_size, num_leads, num_samples), dtype=np.float32)
+    timings = {}
+    for augmentation in default_augmentations():
+        augmentation.p = 1.0
+        batch_augmentation = BatchAugmentation([augmentation])
+        batch = signals.copy()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            batch_augmentation(batch)
+        batch_ms = (time.perf_counter() - start) / repeats * 1000
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for sample in batch:
+                batch_augmentation(sample[None])
+        sample_ms = (time.perf_counter() - start) / repeats * 1000
+        timings[type(augmentation).__name__] = (batch_ms, sample_ms)
+    return timings
+
+
+if __name__ == '__main__':
+    for name, (batch_ms, sample_ms) in benchmark().items():
+        print(f"{name:<22} batch: {batch_ms:7.2f} ms  per sample: {sample_ms:7.2f} ms  ({sample_ms / batch_ms:.1f}x)")
@@ -1,5 +1,18 @@
-from typing import Dict, List, Iterator, Any
+import hashlib
+import os
+import pickle
+from types import MappingProxyType
+from typing import Dict, List, Iterator, Any, Sequence, Mapping, Callable, Tuple
+import numpy as np
 import pandas as pd
+from scipy import sparse
+
+from multi_hot import multi_hot_from_codes
+
+CATEGORIES_CSV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'categories.csv')
+CATEGORIES_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.categories_cache.pkl')
+# bump it whenever the compiled objects change, caches of another version are dropped
+CATEGORIES_CACHE_VERSION = 2
 
 
 class Categories:
@@ -13,12 +26,28 @@ class Categories:
             'Atrial premature complex(es) - APC APB': ['Atrial premature complex(es)',
                                                        'Atrial premature complexes_ nonconducted'],
                                                        }
+    A Categories object is immutable, the alias to index table and the inverse mapping are compiled
+    once when it is created, the hash on first use. Use encode and decode to convert whole datasets
+    of aliases to multi-hot matrices.
     """
     def __init__(self, categories_lookup_dict: Dict[str, List[str]]):
-        self.categories_lookup_dict = categories_lookup_dict
-        self.categories = sorted(categories_lookup_dict.keys())
-        self.num_categories = len(self.categories)
-        self.category_to_idx = {cat: idx for idx, cat in enumerate(self.categories)}
+        aliases = {cat: (cats,) if isinstance(cats, str) else tuple(cats)
+                   for cat, cats in categories_lookup_dict.items()}
+        set_attr = super().__setattr__
+        set_attr('categories_lookup_dict', dict(categories_lookup_dict))
+        set_attr('categories', sorted(categories_lookup_dict.keys()))
+        set_attr('num_categories', len(self.categories))
+        set_attr('category_to_idx', {cat: idx for idx, cat in enumerate(self.categories)})
+        set_attr('aliases', aliases)
+        alias_to_idxs = {}
+        for cat in self.categories:
+            for alias in aliases[cat]:
+                alias_to_idxs.setdefault(alias, []).append(self.category_to_idx[cat])
+        set_attr('alias_to_idxs', {alias: np.unique(idxs) for alias, idxs in alias_to_idxs.items()})
+        set_attr('categories_lookup_dict_inverse', {cat: cat_full for cat_full, cats in aliases.items() for cat in cats})
+
+    def __setattr__(self, name: str, value: Any):
+        raise AttributeError(f"{type(self).__name__} is immutable")
 
     def __len__(self) -> int:
         return self.num_categories
@@ -30,20 +59,28 @@ class Categories:
         return iter(self.categories)
 
     def __contains__(self, item: str) -> bool:
-        return item in self.categories
+        return item in self.category_to_idx
 
     def __repr__(self) -> str:
         return f"Categories: {self.categories}"
 
     def __eq__(self, other: Any) -> bool:
         return (
-            self.categories_lookup_dict == other.categories_lookup_dict
+            self.aliases == other.aliases
             if isinstance(other, Categories)
             else False
         )
 
     def __hash__(self) -> int:
-        return hash(self.categories_lookup_dict)
+        if '_hash' not in self.__dict__:
+            super().__setattr__('_hash', hash(frozenset(self.aliases.items())))
+        return self._hash
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # the hash of strings is salted per process, so it is not pickled but computed again
+        state = self.__dict__.copy()
+        state.pop('_hash', None)
+        return state
 
     def get_category_idx(self, category: str) -> int:
         """
@@ -75,21 +112,103 @@ class Categories:
         """
         return [self.categories[idx] for idx in idxs]
 
-    def get_categories_lookup_dict(self) -> Dict[str, List[str]]:
+    def get_categories_lookup_dict(self) -> Mapping[str, List[str]]:
         """
         Get the category mapping.
         Returns:
-            The category mapping.
+            The category mapping (read only).
         """
-        return self.categories_lookup_dict
+        return MappingProxyType(self.categories_lookup_dict)
 
-    def get_categories_lookup_dict_inverse(self) -> Dict[str, str]:
+    def get_categories_lookup_dict_inverse(self) -> Mapping[str, str]:
         """
         Get the inverse category mapping.
         Returns:
-            The inverse category mapping.
+            The inverse category mapping (read only).
+        """
+        return MappingProxyType(self.categories_lookup_dict_inverse)
+
+    def get_alias_idxs(self, alias: str) -> np.ndarray:
+        """
+        Get the indices of the categories an alias belongs to.
+        Args:
+            alias: the name used in the dataset.
+        Returns:
+            The indices of the categories, empty if the alias is unknown.
+        """
+        return self.alias_to_idxs.get(alias, np.empty(0, dtype=np.int64))
+
+    def encode(self, alias_lists: Sequence[Sequence[str]], packed: bool = False) -> np.ndarray:
+        """
+        Encode the aliases of many records to a multi-hot matrix. Unknown aliases are ignored.
+        Args:
+            alias_lists: the aliases (names used in the dataset) of every record.
+            packed: whether to pack the matrix bits along the categories axis (np.packbits).
+        Returns:
+            A uint8 matrix shaped (records, categories), or (records, ceil(categories / 8)) when packed.
+        """
+        lengths = np.fromiter((len(aliases) for aliases in alias_lists), dtype=np.int64, count=len(alias_lists))
+        flat_aliases = np.fromiter((alias for aliases in alias_lists for alias in aliases), dtype=object,
+                                   count=lengths.sum())
+        codes, unique_aliases = pd.factorize(flat_aliases)
+        unique_idxs = [self.get_alias_idxs(alias) for alias in unique_aliases]
+        rows = np.repeat(np.arange(len(alias_lists)), lengths)
+        matrix = multi_hot_from_codes(rows, codes, unique_idxs, (len(alias_lists), self.num_categories)).toarray()
+        return np.packbits(matrix, axis=1) if packed else matrix
+
+    def decode(self, matrix, packed: bool = False) -> List[List[str]]:
+        """
+        Decode a multi-hot matrix to the categories of every record.
+        Args:
+            matrix: a multi-hot matrix shaped (records, categories), dense or sparse.
+            packed: whether the matrix bits are packed along the categories axis (np.packbits).
+        Returns:
+            The categories of every record.
         """
-        return {cat: cat_full for cat_full, cats in self.categories_lookup_dict.items() for cat in cats}
+        if packed:
+            matrix = np.unpackbits(np.asarray(matrix, dtype=np.uint8), axis=1, count=self.num_categories)
+        matrix = sparse.csr_matrix(matrix)
+        matrix.sort_indices()
+        flat_categories = np.asarray(self.categories, dtype=object)[matrix.indices].tolist()
+        indptr = matrix.indptr.tolist()
+        return [flat_categories[start:end] for start, end in zip(indptr[:-1], indptr[1:])]
+
+    def get_translation_keys(self) -> Dict[str, List[str]]:
+        """
+        Get the keys identifying every category across datasets: its name and its aliases,
+        stripped and lower cased.
+        """
+        return {cat: sorted({key.strip().lower() for key in (cat,) + self.aliases[cat]} - {''})
+                for cat in self.categories}
+
+    def translation_matrix(self, other: 'Categories') -> sparse.csr_matrix:
+        """
+        Build the sparse matrix translating the label space of these categories to the one of other.
+        A category translates to every category of other sharing its name or one of its aliases
+        (the rule build_mimic_pre_dict merges the datasets with).
+        Args:
+            other: the target categories.
+        Returns:
+            A binary uint8 CSR matrix shaped (len(self), len(other)).
+        """
+        key_to_idx = {}
+
+        def incidence(categories: 'Categories') -> Tuple[List[int], List[int]]:
+            keys = categories.get_translation_keys()
+            rows = [idx for idx, cat in enumerate(categories.categories) for _ in keys[cat]]
+            cols = [key_to_idx.setdefault(key, len(key_to_idx)) for cat in categories.categories for key in keys[cat]]
+            return rows, cols
+
+        self_rows, self_cols = incidence(self)
+        other_rows, other_cols = incidence(other)
+        shape = (len(key_to_idx),)
+        self_keys = sparse.csr_matrix((np.ones(len(self_rows), dtype=np.int32), (self_rows, self_cols)),
+                                      shape=(self.num_categories,) + shape)
+        other_keys = sparse.csr_matrix((np.ones(len(other_rows), dtype=np.int32), (other_rows, other_cols)),
+                                       shape=(other.num_categories,) + shape)
+        translation = (self_keys @ other_keys.T).tocsr()
+        translation.data[:] = 1
+        return translation.astype(np.uint8)
 
 
 ny_categories_lookup_dict = \
@@ -639,8 +758,8 @@ sph_categories_lookup_dict = {
     'Ventricular Pre Excitation': ['Ventricular preexcitation']
 
 }
-def build_mimic_pre_dict():
-    mimic_df = pd.read_csv('categories.csv')
+def build_mimic_pre_dict(categories_csv_path=CATEGORIES_CSV_PATH):
+    mimic_df = pd.read_csv(categories_csv_path)
     mimic_pre_dict = {}
     for cat in mimic_df['name']:
         mimic_pre_dict[cat] = []
@@ -674,8 +793,88 @@ def build_mimic_pre_dict():
         mimic_pre_dict[category] = list(set(aliases))
     return mimic_pre_dict
 
-mimic_pre_dict = build_mimic_pre_dict()
-mimic_pre_dict['Premature Ventricular Contractions'] = ['PVC', 'PVCS','PVC(s)']
+def _fingerprint(*items: Any) -> str:
+    return hashlib.sha1(repr(items).encode()).hexdigest()
+
+
+_cache = None
+_cache_path = None
+
+
+def enable_cache(cache_path: str = CATEGORIES_CACHE_PATH):
+    """
+    Serialize the compiled objects (categories, translation matrices, the MIMIC dict) to cache_path, so the next
+    processes load them instead of compiling them. Without it they are only cached in memory, and nothing is
+    written to disk.
+    Args:
+        cache_path: the cache file, None to stop serializing.
+    """
+    global _cache, _cache_path
+    _cache_path = cache_path
+    _cache = None
+
+
+def _load_cache() -> Dict[Any, Any]:
+    if _cache_path is None:
+        return {}
+    try:
+        with open(_cache_path, 'rb') as cache_file:
+            version, cache = pickle.load(cache_file)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, TypeError, ValueError):
+        return {}
+    return cache if version == CATEGORIES_CACHE_VERSION else {}
+
+
+def _cached(key: Any, build: Callable[[], Any]) -> Any:
+    """
+    Get a compiled object from the cache, building it if missing. The cache is serialized once enabled,
+    see enable_cache.
+    Args:
+        key: the cache key, it must change whenever the sources of the object change.
+        build: builds the object.
+    Returns:
+        The compiled object.
+    """
+    global _cache
+    if _cache is None:
+        _cache = _load_cache()
+    if key not in _cache:
+        _cache[key] = build()
+        if _cache_path is not None:
+            tmp_path = f'{_cache_path}.{os.getpid()}'
+            try:
+                with open(tmp_path, 'wb') as cache_file:
+                    pickle.dump((CATEGORIES_CACHE_VERSION, _cache), cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, _cache_path)
+            except OSError:
+                pass  # a read only checkout, the object is rebuilt in the next process
+    return _cache[key]
+
+
+def get_mimic_pre_dict() -> Dict[str, List[str]]:
+    """
+    Get the MIMIC categories merged with the aliases of all the other datasets.
+    Built from categories.csv on first use and cached until categories.csv or the alias dicts change.
+    """
+    csv_stat = os.stat(CATEGORIES_CSV_PATH)
+    key = ('mimic_pre_dict', csv_stat.st_mtime_ns, csv_stat.st_size,
+           _fingerprint(physionet_categories_lookup_dict, sph_categories_lookup_dict, br_categories_lookup_dict,
+                        Mobile_Labeled_categories_lookup_dict, ny_categories_lookup_dict))
+
+    def build():
+        mimic_pre_dict = build_mimic_pre_dict()
+        mimic_pre_dict['Premature Ventricular Contractions'] = ['PVC', 'PVCS','PVC(s)']
+        return mimic_pre_dict
+
+    return _cached(key, build)
+
+
+def __getattr__(name: str) -> Any:
+    # mimic_pre_dict used to be built when the module was imported
+    if name == 'mimic_pre_dict':
+        return get_mimic_pre_dict()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 mimic_categories_lookup_dict = {
     'AV Block': ['AVB'],
@@ -785,17 +984,91 @@ mimic_categories_lookup_dict = {
     'Wide Complex Tachycardia': ['Wide Complex Tachycardia', 'Intraventricular Conduction Delay', 'QRS - Prolonged', 'Poor R Wave Progression', 'Idioventricular Rhythm', 'Intraventricular conduction delay', 'Wide-QRS tachycardia']
 }
 
-dataset_lookup_dicts = {
-    'NY': Categories(ny_categories_lookup_dict),
-    'Brazilian': Categories(br_categories_lookup_dict),
-    'SPH': Categories(sph_categories_lookup_dict),
-    'CPSC': Categories(physionet_categories_lookup_dict),
-    'CPSC_Extra': Categories(physionet_categories_lookup_dict),
-    'StPetersburg': Categories(physionet_categories_lookup_dict),
-    'PTB': Categories(physionet_categories_lookup_dict),
-    'PTB_XL': Categories(physionet_categories_lookup_dict),
-    'Georgia': Categories(physionet_categories_lookup_dict),
-    'Chapman_Shaoxing': Categories(physionet_categories_lookup_dict),
-    'Ningbo': Categories(physionet_categories_lookup_dict),
-    'Mobile_Labeled': Categories(Mobile_Labeled_categories_lookup_dict)
-}
+class CategoriesRegistry(Mapping):
+    """
+    This class is used to store the categories of every dataset.
+    It maps dataset names to their Categories, each one is compiled on first access only and
+    loaded from the serialized cache (see enable_cache) when its lookup dict did not change. Datasets sharing a
+    lookup dict share the same Categories object.
+    Example:
+        registry = CategoriesRegistry({'NY': ny_categories_lookup_dict})
+        registry['NY'].get_category_idx('Atrial Fibrillation')
+    """
+    def __init__(self, lookup_dicts: Dict[str, Dict[str, List[str]]]):
+        self.lookup_dicts = dict(lookup_dicts)
+        self.categories = {}
+
+    def __getitem__(self, name: str) -> Categories:
+        if name not in self.categories:
+            lookup_dict = self.lookup_dicts[name]
+            self.categories[name] = _cached(('categories', _fingerprint(lookup_dict)),
+                                            lambda: Categories(lookup_dict))
+        return self.categories[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.lookup_dicts)
+
+    def __len__(self) -> int:
+        return len(self.lookup_dicts)
+
+    def __repr__(self) -> str:
+        return f"CategoriesRegistry: {list(self.lookup_dicts)}"
+
+    def register(self, name: str, lookup_dict: Dict[str, List[str]]):
+        """
+        Register (or replace) the lookup dict of a dataset.
+        Args:
+            name: the name of the dataset.
+            lookup_dict: the categories lookup dict of the dataset.
+        """
+        self.lookup_dicts[name] = lookup_dict
+        self.categories.pop(name, None)
+
+    def get_translation_matrix(self, source: str, target: str) -> sparse.csr_matrix:
+        """
+        Get the matrix translating the label space of a dataset to the one of another dataset,
+        see Categories.translation_matrix. Compiled once per pair of lookup dicts and cached.
+        Args:
+            source: the name of the source dataset.
+            target: the name of the target dataset.
+        Returns:
+            A binary uint8 CSR matrix shaped (source categories, target categories).
+        """
+        key = ('translation', _fingerprint(self.lookup_dicts[source]), _fingerprint(self.lookup_dicts[target]))
+        return _cached(key, lambda: self[source].translation_matrix(self[target]))
+
+    def remap(self, labels, source: str, target: str):
+        """
+        Remap a multi-hot label matrix from the label space of a dataset to the one of another dataset.
+        The whole matrix is remapped by a single sparse product with the translation matrix.
+        Args:
+            labels: the labels shaped (records, source categories), dense or sparse.
+            source: the name of the source dataset.
+            target: the name of the target dataset.
+        Returns:
+            The binary uint8 labels shaped (records, target categories), sparse if labels is sparse.
+        """
+        translation = self.get_translation_matrix(source, target)
+        if sparse.issparse(labels):
+            remapped = (sparse.csr_matrix(labels, dtype=np.int32) @ translation).tocsr()
+            remapped.eliminate_zeros()
+            remapped.data[:] = 1
+            return remapped.astype(np.uint8)
+        return (np.asarray(labels, dtype=np.int32) @ translation > 0).astype(np.uint8)
+
+
+dataset_lookup_dicts = CategoriesRegistry({
+    'NY': ny_categories_lookup_dict,
+    'Brazilian': br_categories_lookup_dict,
+    'SPH': sph_categories_lookup_dict,
+    'CPSC': physionet_categories_lookup_dict,
+    'CPSC_Extra': physionet_categories_lookup_dict,
+    'StPetersburg': physionet_categories_lookup_dict,
+    'PTB': physionet_categories_lookup_dict,
+    'PTB_XL': physionet_categories_lookup_dict,
+    'Georgia': physionet_categories_lookup_dict,
+    'Chapman_Shaoxing': physionet_categories_lookup_dict,
+    'Ningbo': physionet_categories_lookup_dict,
+    'Mobile_Labeled': Mobile_Labeled_categories_lookup_dict,
+    'MIMIC': mimic_categories_lookup_dict
+})
@@ -0,0 +1,58 @@
+import hashlib
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+CONTENT_HASH_COLUMN = 'content_hash'
+
+
+def content_hash(stored_signal: np.ndarray) -> str:
+    """
+    Hash the content of a record, its stored samples (e.g. the int16 ADC values), with blake2b.
+    Records with the same samples get the same hash, whatever their ids or files. The shape and the dtype
+    are hashed too, so the same bytes in another layout do not collide.
+    """
+    stored_signal = np.ascontiguousarray(stored_signal)
+    digest = hashlib.blake2b(repr((stored_signal.shape, stored_signal.dtype.str)).encode(), digest_size=16)
+    digest.update(stored_signal.data)
+    return digest.hexdigest()
+
+
+def get_canonical_rows(content_hashes: Sequence[str]) -> np.ndarray:
+    """
+    Get the canonical row of every record, the first record with the same content.
+    Args:
+        content_hashes: the content hash of every record.
+    Returns:
+        The row of the first record with the same hash, for every record. A record is a duplicate when its
+        canonical row is not its own row.
+    """
+    codes, _ = pd.factorize(np.asarray(content_hashes))
+    first_rows = np.full(codes.max() + 1 if len(codes) else 0, len(codes), dtype=np.int64)
+    np.minimum.at(first_rows, codes, np.arange(len(codes)))
+    return first_rows[codes]
+
+
+def drop_duplicate_rows(content_hashes: Sequence[str], rows: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Drop the duplicates of some rows, keeping the first row of every content in the order of rows.
+    Args:
+        content_hashes: the content hash of every record, e.g. the content_hash column of a manifest.
+        rows: the rows to deduplicate, defaults to all the rows.
+    Returns:
+        The rows without duplicates.
+    """
+    rows = np.arange(len(content_hashes)) if rows is None else np.asarray(rows, dtype=np.int64)
+    _, first_idxs = np.unique(np.asarray(content_hashes)[rows], return_index=True)
+    return rows[np.sort(first_idxs)]
+
+
+def get_dedup_report(content_hashes: Sequence[str]) -> Dict[str, float]:
+    """
+    Get how many records are duplicates, i.e. the work saved by skipping them.
+    """
+    num_records = len(content_hashes)
+    num_unique = len(pd.unique(np.asarray(content_hashes)))
+    return {'num_records': num_records, 'num_unique': num_unique, 'num_duplicates': num_records - num_unique,
+            'saved_fraction': (num_records - num_unique) / num_records if num_records else 0.0}
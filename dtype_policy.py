@@ -0,0 +1,84 @@
+import numpy as np
+
+
+class DTypePolicy:
+    """
+    This class is used to store the dtypes the ecg signals are kept in.
+    Signals are stored as ADC values (storage dtype) and converted to physical units (mV)
+    only when they are computed on (compute dtype).
+    Numeric tolerances of the default policy (int16 storage, float32 compute):
+        - int16 storage is lossless for 16 bit records such as MIMIC-IV-ECG and the PhysioNet
+          challenge .mat files, since these are the ADC values written by the device. The
+          smallest int16 value is reserved for missing samples (nan), as in WFDB.
+        - float32 compute has a relative error of 2 ** -24 (about 6e-8). For an ADC gain of
+          200/mV the physical range is +-163.84 mV, so the absolute error is below 1e-5 mV,
+          three orders of magnitude below the 5 uV ADC resolution.
+        - filters (sosfiltfilt, neurokit) still run in float64 internally, their output is
+          cast back to the compute dtype, so the errors above do not accumulate.
+    Example:
+        policy = DTypePolicy()  # int16 storage, float32 compute
+        legacy_policy = DTypePolicy(storage_dtype=np.float64, compute_dtype=np.float64)
+    """
+    def __init__(self, storage_dtype=np.int16, compute_dtype=np.float32):
+        self.storage_dtype = np.dtype(storage_dtype)
+        self.compute_dtype = np.dtype(compute_dtype)
+
+    def __repr__(self) -> str:
+        return f"DTypePolicy(storage_dtype={self.storage_dtype}, compute_dtype={self.compute_dtype})"
+
+    def get_storage_dtype(self):
+        return self.storage_dtype
+
+    def get_compute_dtype(self):
+        return self.compute_dtype
+
+    def is_storage_digital(self):
+        return np.issubdtype(self.storage_dtype, np.integer)
+
+    def get_nan_value(self):
+        """
+        Get the storage value used for missing samples, None when the storage dtype is a float.
+        """
+        return np.iinfo(self.storage_dtype).min if self.is_storage_digital() else None
+
+    def to_compute(self, data, adc_gain=1.0, baseline=0):
+        """
+        Convert stored signals to physical units in the compute dtype.
+        Args:
+            data: the stored signals, shaped (..., leads, samples).
+            adc_gain: the ADC gain of every lead (ADC units per mV), a scalar or shaped (leads,).
+            baseline: the ADC baseline of every lead, a scalar or shaped (leads,).
+        Returns:
+            The physical signals in the compute dtype, missing samples are nans.
+        """
+        data = np.asarray(data)
+        if not np.issubdtype(data.dtype, np.integer):
+            return data.astype(self.compute_dtype, copy=False)
+        adc_gain = np.asarray(adc_gain, dtype=self.compute_dtype)[..., None]
+        baseline = np.asarray(baseline, dtype=self.compute_dtype)[..., None]
+        physical = (data.astype(self.compute_dtype) - baseline) / adc_gain
+        physical[data == np.iinfo(data.dtype).min] = np.nan
+        return physical
+
+    def to_storage(self, data, adc_gain=1.0, baseline=0):
+        """
+        Convert physical signals to the storage dtype.
+        Args:
+            data: the physical signals, shaped (..., leads, samples).
+            adc_gain: the ADC gain of every lead (ADC units per mV), a scalar or shaped (leads,).
+            baseline: the ADC baseline of every lead, a scalar or shaped (leads,).
+        Returns:
+            The signals in the storage dtype, nans are stored as get_nan_value().
+        """
+        data = np.asarray(data)
+        if not self.is_storage_digital():
+            return data.astype(self.storage_dtype, copy=False)
+        info = np.iinfo(self.storage_dtype)
+        digital = np.rint(data * np.asarray(adc_gain)[..., None] + np.asarray(baseline)[..., None])
+        nans = np.isnan(digital)
+        digital = np.clip(digital, info.min + 1, info.max)
+        digital[nans] = info.min
+        return digital.astype(self.storage_dtype)
+
+
+DEFAULT_DTYPE_POLICY = DTypePolicy()
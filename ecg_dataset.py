@@ -1,30 +1,207 @@
-import wfdb
+from functools import partial
+
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 import numpy as np
+import pandas as pd
+
+from dedup import drop_duplicate_rows, get_dedup_report
+from dtype_policy import DEFAULT_DTYPE_POLICY
+from ecg_io import read_wfdb_record, get_signal_metadata, get_mimic_header_path
+
+def read_wfdb_item(header_path, dtype_policy=DEFAULT_DTYPE_POLICY, record_cache=None):
+    """
+    Read a MIMIC-IV-ECG WFDB record as a dataset item, through record_cache if given (see record_cache.py).
+    Returns:
+        The signal in the compute dtype, its signal metadata, the wfdb record, the subject id and the study id.
+    """
+    record_path = f'{header_path.parent}/{header_path.stem}'
+    if record_cache is None:
+        stored_signal, metadata = read_wfdb_record(record_path, dtype_policy)
+    else:
+        stored_signal, metadata = record_cache.get_or_load(record_path,
+                                                           partial(read_wfdb_record, record_path, dtype_policy))
+    signal_data = dtype_policy.to_compute(stored_signal, metadata.adc_gain, metadata.baseline)
+    signal_metadata = get_signal_metadata(metadata)
+    subject_id = [column.split(":")[1].strip() for column in metadata.comments][0]
+    return signal_data, signal_metadata, metadata, subject_id, metadata.record_name
+
+def get_label_rows(signal_store, label_store):
+    """
+    Get the label store row of every record of a signal store, None when the label store follows the manifest.
+    """
+    record_ids = signal_store.get_record_ids()
+    if len(label_store) == len(record_ids) and np.array_equal(label_store.get_record_ids(), record_ids.astype(str)):
+        return None
+    return label_store.get_rows(record_ids)
+
+def get_store_rows(signal_store, record_ids):
+    """
+    Get the signal store rows of records by their ids.
+    """
+    rows = pd.Index(signal_store.get_record_ids().astype(str)).get_indexer(np.asarray(record_ids, dtype=str))
+    if (rows < 0).any():
+        raise KeyError(f"records not in the signal store: {list(np.asarray(record_ids)[rows < 0][:5])}")
+    return rows.astype(np.int64)
+
+def deduplicate_store_rows(signal_store, rows=None):
+    """
+    Drop the records with the same content as an earlier one (see dedup.content_hash) from signal store rows.
+    Returns:
+        The rows without duplicates and a report of how many records were dropped.
+    """
+    content_hashes = signal_store.get_content_hashes()
+    dedup_report = get_dedup_report(content_hashes if rows is None else content_hashes[rows])
+    return drop_duplicate_rows(content_hashes, rows), dedup_report
+
+def get_record_labels(label_store, label_row):
+    """
+    Get the multi-hot labels of a label store row, all zeros for records without labels (-1).
+    """
+    if label_row >= 0:
+        return label_store.get_labels(label_row)
+    return np.zeros(label_store.shape[1], dtype=np.uint8)
+
+def get_worker_shards(num_shards, shuffle, seed, epoch):
+    """
+    Get the shards the current DataLoader worker reads, and its random generator.
+    The shard order is shuffled the same way in every worker (by the seed and the epoch), so the workers
+    split it without overlapping.
+    """
+    shard_order = np.arange(num_shards)
+    if shuffle:
+        np.random.default_rng((seed, epoch)).shuffle(shard_order)
+    worker_info = get_worker_info()
+    worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+    return shard_order[worker_id::num_workers], np.random.default_rng((seed, epoch, worker_id))
+
+def shuffle_items(items, buffer_size, rng):
+    """
+    Shuffle a stream of items through a buffer of buffer_size items.
+    """
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        idx = rng.integers(len(buffer))
+        yield buffer[idx]
+        buffer[idx] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+def stack_signals(signal_data_list, dtype_policy, batch_transform=None):
+    """
+    Stack the signals of a batch in the compute dtype and apply batch_transform (e.g.
+    augmentation.BatchAugmentation) to them.
+    Returns:
+        The signals, shaped (batch, leads, samples).
+    """
+    signal_data_array = np.stack(signal_data_list).astype(dtype_policy.get_compute_dtype(), copy=False)
+    if batch_transform is not None:
+        signal_data_array = batch_transform(signal_data_array)
+    return signal_data_array
+
+def collate_batch(batch, dtype_policy, batch_transform=None, with_labels=False):
+    """
+    Collate the (signal_data, signal_metadata, metadata[, labels]) items of ECGDataset and IterableECGDataset.
+    Returns:
+        The signals tensor (see stack_signals), the signal_metadata and metadata lists and, with_labels, the
+        labels tensor.
+    """
+    signal_data_list, signal_metadata_list, metadata_list = list(zip(*batch))[:3]
+    signal_data_tensor = torch.from_numpy(stack_signals(signal_data_list, dtype_policy, batch_transform))
+    if not with_labels:
+        return signal_data_tensor, signal_metadata_list, metadata_list
+    labels_tensor = torch.from_numpy(np.stack([item[3] for item in batch]))
+    return signal_data_tensor, signal_metadata_list, metadata_list, labels_tensor
 
 class ECGDataset(Dataset):
-    def __init__(self, patients_group_directory):
+    """
+    This class is used to read the MIMIC-IV-ECG records, either from the WFDB files of patients_group_directory
+    or from a packed signal store (see signal_store.SignalStore).
+    Items are (signal_data, signal_metadata, metadata) tuples. With a signal store, signal_metadata is the
+    manifest row of the record and metadata is its record id.
+    With a label store (see label_store.LabelStore) the multi-hot labels of the record are appended to the items.
+    The labels of a signal store are looked up by row, a label store saved with the record ids of the manifest
+    is read without any search.
+    indices restricts the dataset to some records (e.g. a fold of splits.load_splits), item i is record indices[i].
+    record_cache (record_cache.RecordCache or SharedRecordCache) keeps the decoded WFDB records between epochs,
+    with a SharedRecordCache the metadata of the items holds the header fields only (see record_cache.get_header).
+    batch_transform (e.g. augmentation.BatchAugmentation) is applied by collate_fn to the collated signals.
+    record_ids (e.g. from record_query.RecordQuery.select) restricts the dataset to these records, in this order.
+    With a signal store they are looked up in the manifest, otherwise patients_group_directory must be the files
+    directory of the dataset and only the files of these records are opened, the directory is not searched.
+    deduplicate (signal store only) skips the records with the same samples as an earlier one, the numbers of
+    records kept and skipped are in dedup_report.
+    """
+    def __init__(self, patients_group_directory=None, dtype_policy=DEFAULT_DTYPE_POLICY, signal_store=None,
+                 label_store=None, indices=None, record_cache=None, batch_transform=None, record_ids=None,
+                 deduplicate=False):
         self.patients_group_directory = patients_group_directory
-        self.signal_paths = list(patients_group_directory.rglob("**/*.dat"))
-        self.header_paths = list(patients_group_directory.rglob("**/*.hea"))
+        self.record_cache = record_cache
+        self.batch_transform = batch_transform
+        self.indices = None if indices is None else np.asarray(indices, dtype=np.int64)
+        self.dtype_policy = dtype_policy if signal_store is None else signal_store.dtype_policy
+        self.signal_store = signal_store
+        self.label_store = label_store
+        if record_ids is not None:
+            if indices is not None:
+                raise ValueError("indices and record_ids both select records, give only one of them")
+            if signal_store is not None:
+                self.indices = get_store_rows(signal_store, record_ids)
+        self.dedup_report = None
+        if deduplicate:
+            if signal_store is None:
+                raise ValueError("deduplicate uses the content hashes of a signal_store")
+            self.indices, self.dedup_report = deduplicate_store_rows(signal_store, self.indices)
+        if signal_store is None and record_ids is not None:
+            self.header_paths = [get_mimic_header_path(patients_group_directory, record_id) for record_id in record_ids]
+            self.signal_paths = [header_path.with_suffix('.dat') for header_path in self.header_paths]
+        elif signal_store is None:
+            # sorted, so indices select the same records on every machine
+            self.signal_paths = sorted(patients_group_directory.rglob("**/*.dat"))
+            self.header_paths = sorted(patients_group_directory.rglob("**/*.hea"))
+        self.label_rows = None
+        if signal_store is not None and label_store is not None:
+            self.label_rows = get_label_rows(signal_store, label_store)
 
         self.image_ids = []
         self.study_ids = []
         self.subject_ids = []
     
     def __len__(self):
+        if self.indices is not None:
+            return len(self.indices)
+        if self.signal_store is not None:
+            return len(self.signal_store)
         return len(self.signal_paths)
     
     def __getitem__(self, idx):
-        signal_path = self.signal_paths[idx]
-        header_path = self.header_paths[idx]
-        signal_data, signal_metadata = wfdb.rdsamp(f'{signal_path.parent}/{signal_path.stem}')
-        metadata = wfdb.rdheader(f'{header_path.parent}/{header_path.stem}')
+        if self.indices is not None:
+            idx = self.indices[idx]
+        return self.get_record_item(idx)
 
-        subject_id = metadata.comments
-        subject_id = [column.split(":")[1].strip() for column in subject_id][0]
-        study_id = metadata.record_name
+    def get_record_item(self, idx):
+        """
+        Get the item of a record by its signal store row (or header path index), ignoring indices.
+        """
+        if self.signal_store is not None:
+            signal_data = self.signal_store.get_signal(idx)
+            signal_metadata = self.signal_store.manifest.iloc[idx].to_dict()
+            metadata = signal_metadata['record_id']
+            label_row = idx if self.label_rows is None else self.label_rows[idx]
+        else:
+            signal_data, signal_metadata, metadata, label_row = self.__get_wfdb_item__(idx)
+        if self.label_store is None:
+            return (signal_data,signal_metadata,metadata)
+        labels = get_record_labels(self.label_store, label_row)
+        return (signal_data,signal_metadata,metadata,labels)
+
+    def __get_wfdb_item__(self, idx):
+        signal_data, signal_metadata, metadata, subject_id, study_id = read_wfdb_item(self.header_paths[idx],
+                                                                                     self.dtype_policy,
+                                                                                     self.record_cache)
 
 
         self.subject_ids.append(subject_id)
@@ -33,10 +210,141 @@ class ECGDataset(Dataset):
         image_id = f"{subject_id}_{study_id}"
         self.image_ids.append(image_id)
 
-        return (signal_data.T,signal_metadata,metadata)
+        label_row = self.label_store.get_row(image_id) if self.label_store is not None else -1
+        return signal_data, signal_metadata, metadata, label_row
     
     def collate_fn(self, batch):
-        signal_data_list, signal_metadata_list, metadata_list = zip(*batch)
-        signal_data_array = np.array(signal_data_list)
-        signal_data_tensor = torch.tensor(signal_data_array)
-        return signal_data_tensor, signal_metadata_list, metadata_list
\ No newline at end of file
+        return collate_batch(batch, self.dtype_policy, self.batch_transform, with_labels=self.label_store is not None)
+
+class IterableECGDataset(IterableDataset):
+    """
+    This class is used to stream the records of ECGDataset shard by shard, for training on large corpora.
+    A shard is a block of shard_size consecutive rows of a signal store, read with a single slice of the
+    memory-mapped signals, or a directory of patients_group_directory at shard_depth (p1000/... for depth 1,
+    p1000/p10000032/... for depth 2) whose records are read in order.
+    Every DataLoader worker reads its own shards only, and nothing but the shard list is copied to the workers.
+    indices (signal store only) restricts the stream to some rows, they are read in sorted order.
+    The shard order is shuffled every epoch and the records are shuffled through a buffer of buffer_size records.
+    deduplicate (signal store only) skips the records with the same samples as an earlier one, see dedup_report.
+    Items and batches are the ones of ECGDataset, batch_transform is applied by collate_fn as in ECGDataset.
+    Example:
+        dataset = IterableECGDataset(signal_store=store, label_store=label_store, indices=splits['train'])
+        data_loader = DataLoader(dataset, batch_size=64, num_workers=8, collate_fn=dataset.collate_fn)
+        for epoch in range(num_epochs):
+            dataset.set_epoch(epoch)
+            for batch in data_loader:
+                ...
+    """
+    def __init__(self, patients_group_directory=None, dtype_policy=DEFAULT_DTYPE_POLICY, signal_store=None,
+                 label_store=None, indices=None, shard_size=1024, shard_depth=1, buffer_size=2048, shuffle=True,
+                 seed=0, batch_transform=None, deduplicate=False):
+        self.patients_group_directory = patients_group_directory
+        self.batch_transform = batch_transform
+        self.dtype_policy = dtype_policy if signal_store is None else signal_store.dtype_policy
+        self.signal_store = signal_store
+        self.label_store = label_store
+        self.indices = None if indices is None else np.sort(np.asarray(indices, dtype=np.int64))
+        self.dedup_report = None
+        if deduplicate:
+            if signal_store is None:
+                raise ValueError("deduplicate uses the content hashes of a signal_store")
+            self.indices, self.dedup_report = deduplicate_store_rows(signal_store, self.indices)
+        self.shard_size = shard_size
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.label_rows = None
+        if signal_store is not None:
+            num_records = len(signal_store) if self.indices is None else len(self.indices)
+            self.shards = [(start, min(start + shard_size, num_records)) for start in range(0, num_records, shard_size)]
+            if label_store is not None:
+                self.label_rows = get_label_rows(signal_store, label_store)
+        else:
+            if indices is not None:
+                raise ValueError("indices select signal store rows, they require a signal_store")
+            self.shards = sorted(path for path in patients_group_directory.glob('/'.join(['*'] * shard_depth))
+                                 if path.is_dir())
+
+    def set_epoch(self, epoch):
+        """
+        Set the epoch, the shuffling of every epoch is different and reproducible.
+        """
+        self.epoch = epoch
+
+    def __read_store_shard__(self, shard):
+        start, end = shard
+        rows = slice(start, end) if self.indices is None else self.indices[start:end]
+        # one large read for the whole shard
+        signal_data = self.signal_store.get_signal(rows)
+        manifest_records = self.signal_store.manifest.iloc[rows].to_dict('records')
+        row_idxs = np.arange(start, end) if self.indices is None else rows
+        for shard_idx, signal_metadata in enumerate(manifest_records):
+            item = (signal_data[shard_idx], signal_metadata, signal_metadata['record_id'])
+            if self.label_store is not None:
+                row = row_idxs[shard_idx]
+                item += (get_record_labels(self.label_store, row if self.label_rows is None else self.label_rows[row]),)
+            yield item
+
+    def __read_directory_shard__(self, shard):
+        for header_path in sorted(shard.rglob("*.hea")):
+            signal_data, signal_metadata, metadata, subject_id, study_id = read_wfdb_item(header_path,
+                                                                                         self.dtype_policy)
+            item = (signal_data, signal_metadata, metadata)
+            if self.label_store is not None:
+                item += (get_record_labels(self.label_store, self.label_store.get_row(f"{subject_id}_{study_id}")),)
+            yield item
+
+    def __iter__(self):
+        worker_shards, rng = get_worker_shards(len(self.shards), self.shuffle, self.seed, self.epoch)
+        read_shard = self.__read_directory_shard__ if self.signal_store is None else self.__read_store_shard__
+        items = (item for shard_idx in worker_shards for item in read_shard(self.shards[shard_idx]))
+        if not self.shuffle:
+            yield from items
+            return
+        yield from shuffle_items(items, self.buffer_size, rng)
+
+    def collate_fn(self, batch):
+        return collate_batch(batch, self.dtype_policy, self.batch_transform, with_labels=self.label_store is not None)
+
+class SerialPairDataset(Dataset):
+    """
+    This class is used to serve (prior, current) pairs of ECGs of the same subject, to compare a study with
+    the previous one.
+    Every record of dataset (an ECGDataset over a signal store) whose previous study in serial_index
+    (see serial_index.SerialIndex) is in the signal store is paired with it, the prior record is read from the
+    whole store even if dataset is restricted by indices. max_days ignores prior studies older than that.
+    Records without a study id are never paired, a study packed twice is paired with its first record.
+    Items are (prior_item, current_item) pairs of ECGDataset items, collate_fn collates both sides.
+    Example:
+        dataset = SerialPairDataset(ECGDataset(signal_store=store, indices=splits['train']), serial_index)
+        data_loader = DataLoader(dataset, batch_size=32, shuffle=True, collate_fn=dataset.collate_fn)
+    """
+    def __init__(self, dataset, serial_index, max_days=None):
+        if dataset.signal_store is None:
+            raise ValueError("serial pairs are looked up by the study ids of a signal_store manifest")
+        self.dataset = dataset
+        manifest = dataset.signal_store.manifest
+        rows = np.arange(len(manifest)) if dataset.indices is None else dataset.indices
+        study_ids = pd.to_numeric(manifest['study_id'], errors='coerce').fillna(-1).to_numpy().astype(np.int64)
+        if len(study_ids) and (study_ids < 0).all():
+            raise ValueError("the signal_store manifest has no study ids, e.g. a challenge store")
+        prior_study_ids = serial_index.get_prior_studies(study_ids[rows], max_days=max_days)
+        # the store row of every study, the first one when a study was packed twice
+        unique_study_ids, first_rows = np.unique(study_ids, return_index=True)
+        first_rows, unique_study_ids = first_rows[unique_study_ids >= 0], unique_study_ids[unique_study_ids >= 0]
+        idxs = np.minimum(np.searchsorted(unique_study_ids, prior_study_ids), max(len(unique_study_ids) - 1, 0))
+        paired = (prior_study_ids >= 0) & (unique_study_ids[idxs] == prior_study_ids)
+        # dataset items of the current records, and store rows of their priors
+        self.current_idxs = np.flatnonzero(paired)
+        self.prior_rows = first_rows[idxs[paired]]
+
+    def __len__(self):
+        return len(self.current_idxs)
+
+    def __getitem__(self, idx):
+        return self.dataset.get_record_item(self.prior_rows[idx]), self.dataset[self.current_idxs[idx]]
+
+    def collate_fn(self, batch):
+        prior_batch, current_batch = list(zip(*batch))
+        return self.dataset.collate_fn(prior_batch), self.dataset.collate_fn(current_batch)
\ No newline at end of file
@@ -0,0 +1,110 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import wfdb
+from scipy.io import loadmat
+
+from dtype_policy import DEFAULT_DTYPE_POLICY
+
+SIGNAL_METADATA_FIELDS = ['fs', 'sig_len', 'n_sig', 'base_date', 'base_time', 'units', 'sig_name', 'comments']
+
+
+def read_wfdb_record(record_path, dtype_policy=DEFAULT_DTYPE_POLICY):
+    """
+    Read a WFDB record (header and signal) in the storage dtype of the policy.
+    Args:
+        record_path: the record path, without an extension.
+        dtype_policy: the dtype policy to read the signal with.
+    Returns:
+        The stored signal shaped (leads, samples) and the wfdb record. Use
+        dtype_policy.to_compute(signal, record.adc_gain, record.baseline) to get mV.
+    """
+    record = wfdb.rdrecord(str(record_path), physical=False, return_res=16)
+    if dtype_policy.is_storage_digital():
+        signal_data = record.d_signal.T.astype(dtype_policy.get_storage_dtype(), copy=False)
+    else:
+        signal_data = record.dac(expanded=False).T.astype(dtype_policy.get_storage_dtype(), copy=False)
+    return signal_data, record
+
+
+def read_wfdb_header(record_path):
+    """
+    Read the header of a WFDB record only.
+    Args:
+        record_path: the record path, without an extension.
+    Returns:
+        The wfdb record without its signal, it holds the adc_gain, baseline and the signal metadata.
+    """
+    return wfdb.rdheader(str(record_path))
+
+
+def get_mimic_header_path(files_directory, record_id):
+    """
+    Get the header path of a MIMIC-IV-ECG record from its id, without searching the directory.
+    Args:
+        files_directory: the files directory of the dataset (e.g. './files').
+        record_id: the record id, '{subject_id}_{study_id}'.
+    Returns:
+        The header path, files/p{first 4 digits of the subject}/p{subject}/s{study}/{study}.hea.
+    """
+    subject_id, study_id = str(record_id).split('_')
+    return Path(files_directory) / f'p{subject_id[:4]}' / f'p{subject_id}' / f's{study_id}' / f'{study_id}.hea'
+
+
+def get_signal_metadata(record):
+    """
+    Get the signal metadata of a record, the same fields wfdb.rdsamp returns.
+    Args:
+        record: the wfdb record.
+    Returns:
+        The signal metadata dict.
+    """
+    return {field: getattr(record, field) for field in SIGNAL_METADATA_FIELDS}
+
+
+def load_challenge_data(filename, dtype_policy=DEFAULT_DTYPE_POLICY):
+    x = loadmat(filename)
+    data = np.asarray(x['val'])  # ADC values
+    storage_dtype = dtype_policy.get_storage_dtype()
+    if dtype_policy.is_storage_digital() and data.size:
+        # narrowing would silently wrap the values out of the storage range
+        storage_info = np.iinfo(storage_dtype)
+        if data.min() < storage_info.min or data.max() > storage_info.max:
+            raise ValueError(f"{filename} has ADC values out of the {storage_dtype} storage range "
+                             f"[{storage_info.min}, {storage_info.max}]")
+    data = data.astype(storage_dtype, copy=False)
+    new_file = filename.replace('.mat', '.hea')
+    input_header_file = os.path.join(new_file)
+    with open(input_header_file, 'r') as f:
+        header_data = f.readlines()
+    return data, header_data
+
+
+def get_challenge_sample_rate(header_data):
+    # the first header line is: <record name> <number of leads> <sampling rate> <number of samples> ...
+    return float(header_data[0].split()[2])
+
+
+def get_challenge_calibration(header_data):
+    """
+    Get the ADC gain and baseline of every lead from a PhysioNet challenge header.
+    A lead line is: <file> <format> <gain>[(<baseline>)]/<units> <resolution> <adc zero> ...,
+    the baseline defaults to the adc zero, as in WFDB.
+    Args:
+        header_data: the header lines, as returned by load_challenge_data.
+    Returns:
+        The ADC gains and baselines, both shaped (leads,).
+    """
+    num_leads = int(header_data[0].split()[1])
+    adc_gain, baseline = np.ones(num_leads, dtype=np.float32), np.zeros(num_leads, dtype=np.float32)
+    for lead, line in enumerate(header_data[1:num_leads + 1]):
+        fields = line.split()
+        gain_field = fields[2].split('/')[0]
+        if '(' in gain_field:
+            gain_field, baseline_field = gain_field.rstrip(')').split('(')
+            baseline[lead] = float(baseline_field)
+        elif len(fields) > 4:
+            baseline[lead] = float(fields[4])
+        adc_gain[lead] = float(gain_field) or 200.0  # a gain of 0 means the WFDB default
+    return adc_gain, baseline
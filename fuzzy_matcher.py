@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from fuzzywuzzy import fuzz
+from scipy import sparse
+
+from report_classifier import clean_report
+
+
+def _ngrams(text: str, n: int) -> List[str]:
+    padded = f'{" " * (n - 1)}{text} '
+    return [padded[i:i + n] for i in range(len(padded) - n + 1)]
+
+
+def _score_candidates(task: Tuple[str, Sequence[str], str]) -> Tuple[Optional[str], int]:
+    report, candidates, scorer = task
+    score_fn = getattr(fuzz, scorer)
+    best_alias, best_score = None, -1
+    for alias in candidates:
+        score = score_fn(report, alias)
+        if score > best_score:
+            best_alias, best_score = alias, score
+    return best_alias, best_score
+
+
+class FuzzyAliasMatcher:
+    """
+    This class is used to map free-text reports that were not tagged manually to categories.
+    A character n-gram index over the aliases (and names) of the categories picks the candidates
+    sharing the most n-grams with a report, only those are scored with fuzzywuzzy. Unique reports
+    are scored in parallel and the results are memoized in a persistent json cache.
+    Example:
+        matcher = FuzzyAliasMatcher(mimic_categories_lookup_dict, cache_path='fuzzy_matches.json')
+        matches = matcher.match_many(unique_report_types)
+        matches['atrial fibrilation'] -> ('atrial fibrillation', 97, ['Atrial Fibrillation', ...])
+    """
+    def __init__(self, categories_lookup_dict: Dict[str, List[str]], ngram: int = 3, num_candidates: int = 10,
+                 min_score: int = 80, scorer: str = 'token_set_ratio', cache_path: Optional[str] = None):
+        self.ngram = ngram
+        self.num_candidates = num_candidates
+        self.min_score = min_score
+        self.scorer = scorer
+        self.cache_path = cache_path
+        alias_to_categories = {}
+        for category, aliases in categories_lookup_dict.items():
+            aliases = [aliases] if isinstance(aliases, str) else aliases
+            for alias in [category] + list(aliases):
+                alias = clean_report(alias).strip()
+                if alias and category not in alias_to_categories.setdefault(alias, []):
+                    alias_to_categories[alias].append(category)
+        self.alias_to_categories = alias_to_categories
+        self.aliases = sorted(alias_to_categories)
+        self.ngram_to_idx = {}
+        self.alias_ngrams = self.__vectorize__(self.aliases, grow=True)
+        self.alias_ngram_counts = np.asarray(self.alias_ngrams.sum(axis=1)).ravel()
+        self.fingerprint = hashlib.sha1(repr((sorted(alias_to_categories.items()), ngram, num_candidates,
+                                              scorer)).encode()).hexdigest()
+        self.cache = self.__load_cache__()
+
+    def __vectorize__(self, texts: Sequence[str], grow: bool = False) -> sparse.csr_matrix:
+        rows, cols = [], []
+        for row, text in enumerate(texts):
+            for gram in set(_ngrams(text, self.ngram)):
+                col = self.ngram_to_idx.setdefault(gram, len(self.ngram_to_idx)) if grow else \
+                    self.ngram_to_idx.get(gram)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+        return sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                                 shape=(len(texts), len(self.ngram_to_idx)))
+
+    def __load_cache__(self) -> Dict[str, Tuple[Optional[str], int]]:
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return {}
+        with open(self.cache_path, 'r') as cache_file:
+            cache = json.load(cache_file)
+        if cache.get('fingerprint') != self.fingerprint:
+            return {}  # the aliases changed, the cached matches are stale
+        return {report: tuple(match) for report, match in cache['matches'].items()}
+
+    def __save_cache__(self):
+        if self.cache_path is None:
+            return
+        tmp_path = f'{self.cache_path}.{os.getpid()}'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump({'fingerprint': self.fingerprint, 'matches': self.cache}, cache_file)
+        os.replace(tmp_path, self.cache_path)
+
+    def get_candidates(self, reports: Sequence[str]) -> List[List[str]]:
+        """
+        Get the aliases sharing the most n-grams with every report (by their Dice coefficient).
+        Args:
+            reports: the cleaned reports.
+        Returns:
+            Up to num_candidates aliases for every report.
+        """
+        report_ngrams = self.__vectorize__(reports)
+        shared = (report_ngrams @ self.alias_ngrams.T).tocsr()
+        report_counts = np.asarray([len(set(_ngrams(report, self.ngram))) for report in reports], dtype=np.float32)
+        candidates = []
+        for row in range(len(reports)):
+            start, end = shared.indptr[row], shared.indptr[row + 1]
+            alias_idxs = shared.indices[start:end]
+            dice = 2 * shared.data[start:end] / (report_counts[row] + self.alias_ngram_counts[alias_idxs])
+            if len(alias_idxs) > self.num_candidates:
+                top = np.argpartition(-dice, self.num_candidates)[:self.num_candidates]
+                alias_idxs, dice = alias_idxs[top], dice[top]
+            candidates.append([self.aliases[idx] for idx in alias_idxs[np.argsort(-dice)]])
+        return candidates
+
+    def match_many(self, reports: Sequence[str], num_workers: Optional[int] = None,
+                   chunksize: int = 256) -> Dict[str, Tuple[str, int, List[str]]]:
+        """
+        Match free-text reports to categories.
+        Args:
+            reports: the free-text reports, duplicates are matched once.
+            num_workers: the number of worker processes scoring the candidates, defaults to the number of cpus.
+            chunksize: the number of reports sent to a worker at a time.
+        Returns:
+            A dict from every report with a match scoring at least min_score to its
+            (alias, score, categories).
+        """
+        cleaned = {report: clean_report(report).strip() for report in set(reports)}
+        to_score = sorted({text for text in cleaned.values() if text and text not in self.cache})
+        if to_score:
+            tasks = [(text, candidates, self.scorer) for text, candidates in zip(to_score,
+                                                                                 self.get_candidates(to_score))]
+            if len(tasks) <= chunksize:
+                results = list(map(_score_candidates, tasks))
+            else:
+                with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                    results = list(executor.map(_score_candidates, tasks, chunksize=chunksize))
+            self.cache.update(zip(to_score, results))
+            self.__save_cache__()
+        matches = {}
+        for report, text in cleaned.items():
+            alias, score = self.cache.get(text, (None, -1))
+            if alias is not None and score >= self.min_score:
+                matches[report] = (alias, score, self.alias_to_categories[alias])
+        return matches
+
+    def match(self, report: str) -> Optional[Tuple[str, int, List[str]]]:
+        """
+        Match a single free-text report, see match_many.
+        """
+        return self.match_many([report]).get(report)
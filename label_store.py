@@ -0,0 +1,140 @@
+import struct
+import zipfile
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3I2H')
+
+
+def memmap_npz(path) -> Dict[str, np.ndarray]:
+    """
+    Memory-map the arrays of an uncompressed .npz file (as written by np.savez).
+    np.load reads every member of an .npz to memory, here every member is mapped at its offset
+    inside the zip file instead.
+    Args:
+        path: the .npz file.
+    Returns:
+        A dict from every member name (without '.npy') to its read only memory-mapped array.
+    """
+    arrays = {}
+    with open(path, 'rb') as npz_file, zipfile.ZipFile(npz_file) as zip_file:
+        for info in zip_file.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{path} member {info.filename} is compressed, save it with np.savez")
+            npz_file.seek(info.header_offset)
+            local_header = ZIP_LOCAL_HEADER.unpack(npz_file.read(ZIP_LOCAL_HEADER.size))
+            npz_file.seek(info.header_offset + ZIP_LOCAL_HEADER.size + local_header[-2] + local_header[-1])
+            version = np.lib.format.read_magic(npz_file)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else \
+                np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(npz_file)
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+            if np.prod(shape) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=npz_file.tell(), shape=shape,
+                                     order='F' if fortran_order else 'C')
+    return arrays
+
+
+def align_labels(labels: sparse.csr_matrix, label_record_ids: Sequence[str],
+                 record_ids: Sequence[str]) -> sparse.csr_matrix:
+    """
+    Reorder the rows of a label matrix to follow record_ids (e.g. the record ids of a signal store manifest).
+    Args:
+        labels: the label matrix, one row per label_record_ids.
+        label_record_ids: the record id of every row of labels.
+        record_ids: the wanted order of the rows. Records without labels get an empty row.
+    Returns:
+        The aligned label matrix, one row per record_ids.
+    """
+    rows = pd.Index(np.asarray(label_record_ids, dtype=str)).get_indexer(np.asarray(record_ids, dtype=str))
+    aligned = sparse.csr_matrix(labels)[np.maximum(rows, 0)]
+    # zero the rows of the records without labels, in the label dtype (diags defaults to float64)
+    return sparse.diags((rows >= 0).astype(labels.dtype), dtype=labels.dtype, format='csr') @ aligned
+
+
+def save_label_store(path, labels: sparse.csr_matrix, categories: Sequence[str], record_ids: Sequence[str]):
+    """
+    Save a multi-hot label matrix, its category names and the record ids of its rows in a single .npz file.
+    Args:
+        path: the .npz file.
+        labels: the binary label matrix shaped (records, categories).
+        categories: the category name of every column.
+        record_ids: the record id of every row, usually the record ids of the signal store manifest
+            (see align_labels).
+    """
+    labels = sparse.csr_matrix(labels)
+    labels.sum_duplicates()
+    labels.eliminate_zeros()
+    labels.sort_indices()
+    np.savez(path, indptr=labels.indptr.astype(np.int64), indices=labels.indices.astype(np.int32),
+             shape=np.asarray(labels.shape, dtype=np.int64), categories=np.asarray(categories, dtype=str),
+             record_ids=np.asarray(record_ids, dtype=str))
+
+
+class LabelStore:
+    """
+    This class is used to read a label store written by save_label_store.
+    The arrays are memory-mapped, getting the labels of a record reads a few bytes only.
+    """
+    def __init__(self, path):
+        self.path = path
+        arrays = memmap_npz(path)
+        self.indptr = arrays['indptr']
+        self.indices = arrays['indices']
+        self.shape = tuple(int(dim) for dim in arrays['shape'])
+        self.categories = arrays['categories']
+        self.record_ids = arrays['record_ids']
+        self.record_id_to_row = None
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def get_categories(self) -> List[str]:
+        return self.categories.tolist()
+
+    def get_record_ids(self) -> np.ndarray:
+        return self.record_ids
+
+    def get_label_idxs(self, idx: int) -> np.ndarray:
+        """
+        Get the category indexes of a record.
+        """
+        return np.asarray(self.indices[self.indptr[idx]:self.indptr[idx + 1]])
+
+    def get_labels(self, idx: int) -> np.ndarray:
+        """
+        Get the multi-hot label vector of a record.
+        Args:
+            idx: the row of the record.
+        Returns:
+            A uint8 vector shaped (categories,).
+        """
+        labels = np.zeros(self.shape[1], dtype=np.uint8)
+        labels[self.get_label_idxs(idx)] = 1
+        return labels
+
+    def get_matrix(self) -> sparse.csr_matrix:
+        """
+        Get the whole label matrix.
+        """
+        return sparse.csr_matrix((np.ones(len(self.indices), dtype=np.uint8), self.indices, self.indptr),
+                                 shape=self.shape)
+
+    def get_rows(self, record_ids: Sequence[str]) -> np.ndarray:
+        """
+        Get the rows of records by their ids, -1 for records without labels.
+        """
+        return pd.Index(self.record_ids).get_indexer(np.asarray(record_ids, dtype=str))
+
+    def get_row(self, record_id: str) -> int:
+        """
+        Get the row of a single record by its id, -1 when it has no labels.
+        """
+        if self.record_id_to_row is None:
+            self.record_id_to_row = {record_id: row for row, record_id in enumerate(self.record_ids.tolist())}
+        return self.record_id_to_row.get(record_id, -1)
@@ -0,0 +1,161 @@
+import os
+import warnings
+
+import numpy as np
+from scipy import signal
+
+BEAT_LENGTH = 250
+
+
+def beat_window(rpeaks, sampling_rate):
+    """
+    Compute the segmentation window around each R-peak, in samples.
+    The window follows neurokit's ecg_segment: it scales with the mean heart rate and
+    is widened for heart rates of 80 bpm and above.
+    Args:
+        rpeaks: the sample indexes of the R-peaks.
+        sampling_rate: the sampling rate of the signal.
+    Returns:
+        The (start, end) offsets of the window relative to the R-peak.
+    """
+    heart_rate = 60 * sampling_rate / np.mean(np.diff(rpeaks))
+    m = heart_rate / 60
+    epochs_start = -0.35 / m
+    epochs_end = 0.5 / m
+    if heart_rate >= 80:
+        epochs_start -= 0.1
+        epochs_end += 0.1
+    return int(round(epochs_start * sampling_rate)), int(round(epochs_end * sampling_rate))
+
+
+def gather_beats(ecg, rpeaks, window):
+    """
+    Gather a fixed window around every R-peak for all the leads at once.
+    Beats whose window falls outside the record are dropped, neurokit pads those with
+    nans which makes them useless for the median anyway.
+    Args:
+        ecg: the ecg signal, shaped (leads, samples).
+        rpeaks: the sample indexes of the R-peaks.
+        window: the (start, end) offsets returned by beat_window.
+    Returns:
+        The beats, shaped (beats, leads, window length).
+    """
+    offsets = np.arange(window[0], window[1])
+    idx = np.asarray(rpeaks)[:, None] + offsets[None, :]
+    complete = (idx[:, 0] >= 0) & (idx[:, -1] < ecg.shape[-1])
+    return np.ascontiguousarray(ecg[:, idx[complete]].transpose(1, 0, 2))
+
+
+def median_beats(ecg, rpeaks, sampling_rate=500, beat_length=BEAT_LENGTH):
+    """
+    Compute the median beat of every lead of an ecg.
+    All the beats of all the leads are resampled to beat_length in a single FFT call, a beat
+    containing a nan comes out as all nans and is ignored by the median.
+    Args:
+        ecg: the ecg signal, shaped (leads, samples).
+        rpeaks: the sample indexes of the R-peaks (usually found on lead II).
+        sampling_rate: the sampling rate of the signal.
+        beat_length: the number of samples of the resampled beat.
+    Returns:
+        The median beats, shaped (leads, beat_length). Leads without a usable beat are all nans.
+    """
+    ecg = np.asarray(ecg)
+    med_beats = np.full((ecg.shape[0], beat_length), np.nan, dtype=np.result_type(ecg.dtype, np.float32))
+    if len(rpeaks) < 2:
+        return med_beats
+    beats = gather_beats(ecg, rpeaks, beat_window(rpeaks, sampling_rate))
+    if beats.shape[0] == 0 or beats.shape[-1] == 0:
+        return med_beats
+    rsmp_beats = signal.resample(beats, beat_length, axis=-1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)  # all-nan leads
+        return np.nanmedian(rsmp_beats, axis=0).astype(med_beats.dtype, copy=False)
+
+
+def median_beats_validity(med_beats):
+    """
+    Get the validity mask of median beats.
+    Args:
+        med_beats: median beats shaped (..., leads, beat_length).
+    Returns:
+        A boolean mask shaped (..., leads), True where the lead's median beat has no nans.
+    """
+    return ~np.isnan(med_beats).any(axis=-1)
+
+
+def compact_valid_ecgs(ecg_arr, valid, min_valid_leads=1, chunk_size=4096):
+    """
+    Drop the ecgs with less than min_valid_leads valid leads by moving the kept ecgs to the
+    front of ecg_arr in place. Works on memory-mapped arrays, only chunk_size ecgs are held
+    in memory at a time.
+    Args:
+        ecg_arr: the median beats, shaped (N, leads, beat_length). Modified in place.
+        valid: the validity mask, shaped (N, leads). Modified in place.
+        min_valid_leads: the minimal number of valid leads an ecg must have to be kept.
+        chunk_size: the number of ecgs moved at a time.
+    Returns:
+        The compacted views of ecg_arr and valid, and the original indexes of the kept ecgs.
+    """
+    kept_idx = np.flatnonzero(valid.sum(axis=1) >= min_valid_leads)
+    # every destination is at or before its source, so moving in increasing order never
+    # overwrites an ecg that was not moved yet.
+    for start in range(0, len(kept_idx), chunk_size):
+        src = kept_idx[start:start + chunk_size]
+        if src[-1] == start + len(src) - 1:
+            continue  # nothing was dropped up to the end of this chunk
+        ecg_arr[start:start + len(src)] = ecg_arr[src]
+        valid[start:start + len(src)] = valid[src]
+    return ecg_arr[:len(kept_idx)], valid[:len(kept_idx)], kept_idx
+
+
+def open_median_beats_memmap(output_path, num_ecgs, num_leads=12, beat_length=BEAT_LENGTH, mode='w+',
+                             dtype=np.float32):
+    """
+    Open (or create) the memory-mapped median beats output.
+    The beats are saved to '<output_path>_beats.npy' and the validity mask to
+    '<output_path>_valid.npy'. Once compacted (see save_kept_idx), an existing output is opened
+    with its kept ecgs only, the rows past them are left overs of the compaction.
+    Args:
+        output_path: the output path prefix.
+        num_ecgs: the number of ecgs, only used when creating the output.
+        num_leads: the number of leads, only used when creating the output.
+        beat_length: the number of samples of a median beat, only used when creating the output.
+        mode: 'w+' to create the output, 'r+' or 'r' to open an existing one.
+        dtype: the dtype of the median beats, only used when creating the output.
+    Returns:
+        The memory-mapped median beats and validity mask.
+    """
+    beats_path, valid_path = f'{output_path}_beats.npy', f'{output_path}_valid.npy'
+    if mode == 'w+':
+        if os.path.exists(_kept_idx_path(output_path)):
+            os.remove(_kept_idx_path(output_path))  # the kept ecgs of a previous output
+        beats = np.lib.format.open_memmap(beats_path, mode='w+', dtype=dtype,
+                                          shape=(num_ecgs, num_leads, beat_length))
+        valid = np.lib.format.open_memmap(valid_path, mode='w+', dtype=np.bool_, shape=(num_ecgs, num_leads))
+        return beats, valid
+    beats, valid = np.load(beats_path, mmap_mode=mode), np.load(valid_path, mmap_mode=mode)
+    kept_idx = load_kept_idx(output_path)
+    if kept_idx is not None:
+        beats, valid = beats[:len(kept_idx)], valid[:len(kept_idx)]
+    return beats, valid
+
+
+def _kept_idx_path(output_path):
+    return f'{output_path}_kept_idx.npy'
+
+
+def save_kept_idx(output_path, kept_idx):
+    """
+    Save the original indexes of the ecgs kept by compact_valid_ecgs to '<output_path>_kept_idx.npy',
+    row i of the compacted output is the ecg kept_idx[i].
+    """
+    np.save(_kept_idx_path(output_path), np.asarray(kept_idx, dtype=np.int64))
+
+
+def load_kept_idx(output_path):
+    """
+    Load the original indexes of the ecgs of a compacted output, None when it was not compacted.
+    """
+    if not os.path.exists(_kept_idx_path(output_path)):
+        return None
+    return np.load(_kept_idx_path(output_path))
@@ -0,0 +1,143 @@
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from report_classifier import REPORT_COLUMNS
+
+CACHE_DIR_NAME = '.columnar_cache'
+# the parquet metadata keys identifying the version of the source csv
+SOURCE_MTIME_KEY = b'source_mtime_ns'
+SOURCE_SIZE_KEY = b'source_size'
+# table name -> (csv path relative to the data directory, the needed columns and their types)
+TABLE_SPECS: Dict[str, Tuple[str, Dict[str, str]]] = {
+    'machine_measurements': (os.path.join('all_data', 'machine_measurements.csv'), {
+        'subject_id': 'int64', 'study_id': 'int64', 'ecg_time': 'datetime',
+        **{col: 'category' for col in REPORT_COLUMNS},
+    }),
+    'omr': (os.path.join('all_data', 'omr.csv'), {
+        'subject_id': 'int64', 'chartdate': 'datetime', 'seq_num': 'int32', 'result_name': 'category',
+        'result_value': 'string',
+    }),
+    'patients': (os.path.join('all_data', 'patients.csv'), {
+        'subject_id': 'int64', 'gender': 'category', 'anchor_age': 'int16', 'anchor_year': 'int16',
+        'anchor_year_group': 'category', 'dod': 'datetime',
+    }),
+    'tags': ('tags.csv', {
+        'Unique Report': 'string', 'Our Classification': 'string',
+    }),
+}
+ARROW_TYPES = {
+    'int64': pa.int64(), 'int32': pa.int32(), 'int16': pa.int16(), 'float32': pa.float32(), 'float64': pa.float64(),
+    'string': pa.string(), 'datetime': pa.timestamp('ns'), 'category': pa.dictionary(pa.int32(), pa.string()),
+}
+
+
+def _to_arrow(values: pd.Series, column_type: str) -> pa.Array:
+    if column_type == 'category':
+        return pa.array(values, type=pa.string(), from_pandas=True).dictionary_encode()
+    if column_type == 'datetime':
+        return pa.array(pd.to_datetime(values, errors='coerce'), type=ARROW_TYPES[column_type], from_pandas=True)
+    if column_type == 'string':
+        return pa.array(values, type=pa.string(), from_pandas=True)
+    # the csv values are read as strings, nulls go through float to keep them
+    return pa.array(pd.to_numeric(values, errors='coerce'), from_pandas=True).cast(ARROW_TYPES[column_type])
+
+
+class MimicTables:
+    """
+    This class is used to load the MIMIC-IV-ECG csv tables (machine_measurements.csv, omr.csv, patients.csv
+    and tags.csv) through a columnar cache.
+    Every table is converted once, in chunks, to a typed Parquet file holding only the needed columns
+    (see TABLE_SPECS), text columns with few values are dictionary encoded and read as categoricals.
+    A cached table is rebuilt when the modification time or the size of its csv changes.
+    Example:
+        tables = MimicTables('.')
+        ecg_df = tables.read('machine_measurements', columns=['subject_id', 'study_id', 'ecg_time'])
+        for omr_chunk in tables.iter_chunks('omr'):
+            ...
+    """
+    def __init__(self, data_dir='.', cache_dir=None, chunksize: int = 500_000,
+                 table_specs: Dict[str, Tuple[str, Dict[str, str]]] = None):
+        self.data_dir = data_dir
+        self.cache_dir = os.path.join(data_dir, CACHE_DIR_NAME) if cache_dir is None else cache_dir
+        self.chunksize = chunksize
+        self.table_specs = TABLE_SPECS if table_specs is None else table_specs
+
+    def get_source_path(self, name: str) -> str:
+        return os.path.join(self.data_dir, self.table_specs[name][0])
+
+    def get_cache_path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, f'{name}.parquet')
+
+    def __source_version__(self, name: str) -> Dict[bytes, bytes]:
+        source_stat = os.stat(self.get_source_path(name))
+        return {SOURCE_MTIME_KEY: str(source_stat.st_mtime_ns).encode(),
+                SOURCE_SIZE_KEY: str(source_stat.st_size).encode()}
+
+    def is_cached(self, name: str) -> bool:
+        """
+        Check whether the cache of a table exists and was converted from the current version of its csv.
+        """
+        cache_path = self.get_cache_path(name)
+        if not os.path.exists(cache_path):
+            return False
+        metadata = pq.read_schema(cache_path).metadata or {}
+        return all(metadata.get(key) == value for key, value in self.__source_version__(name).items())
+
+    def convert(self, name: str) -> str:
+        """
+        Convert a csv table to its Parquet cache, one row group per chunk of the csv.
+        Args:
+            name: the name of the table, see TABLE_SPECS.
+        Returns:
+            The path of the cache.
+        """
+        source_path = self.get_source_path(name)
+        column_types = self.table_specs[name][1]
+        source_version = self.__source_version__(name)
+        header = pd.read_csv(source_path, nrows=0).columns
+        columns = [col for col in column_types if col in header]
+        schema = pa.schema([(col, ARROW_TYPES[column_types[col]]) for col in columns], metadata=source_version)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_path = self.get_cache_path(name)
+        tmp_path = f'{cache_path}.{os.getpid()}'
+        with pq.ParquetWriter(tmp_path, schema) as writer:
+            for chunk in pd.read_csv(source_path, usecols=columns, dtype=str, chunksize=self.chunksize):
+                writer.write_table(pa.Table.from_arrays([_to_arrow(chunk[col], column_types[col])
+                                                         for col in columns], schema=schema))
+        os.replace(tmp_path, cache_path)
+        return cache_path
+
+    def __cached_path__(self, name: str) -> str:
+        if not self.is_cached(name):
+            self.convert(name)
+        return self.get_cache_path(name)
+
+    def read(self, name: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Read a table, converting it first if its cache is missing or stale.
+        Args:
+            name: the name of the table, see TABLE_SPECS.
+            columns: the columns to read, defaults to all the cached columns.
+        Returns:
+            The table.
+        """
+        return pq.read_table(self.__cached_path__(name), columns=columns).to_pandas()
+
+    def iter_chunks(self, name: str, columns: Optional[List[str]] = None,
+                    chunksize: Optional[int] = None) -> Iterator[pd.DataFrame]:
+        """
+        Stream a table in chunks, converting it first if its cache is missing or stale.
+        Args:
+            name: the name of the table, see TABLE_SPECS.
+            columns: the columns to read, defaults to all the cached columns.
+            chunksize: the number of rows of every chunk, defaults to the conversion chunksize.
+        Returns:
+            An iterator over DataFrames of up to chunksize rows.
+        """
+        parquet_file = pq.ParquetFile(self.__cached_path__(name))
+        for batch in parquet_file.iter_batches(batch_size=chunksize or self.chunksize, columns=columns):
+            yield batch.to_pandas()
@@ -0,0 +1,32 @@
+import numpy as np
+from scipy import sparse
+
+
+def multi_hot_from_codes(rows, codes, unique_indices, shape):
+    """
+    Build a binary multi-hot matrix from coded items.
+    Every item is a (row, code) pair, where code indexes unique_indices, the column indexes the
+    item sets. The expansion is done with array operations, the per-item lookups only happen once
+    per unique value.
+    Args:
+        rows: the row of every item.
+        codes: the code of every item, negative codes are ignored.
+        unique_indices: for every code, the column indexes it sets.
+        shape: the (rows, columns) shape of the matrix.
+    Returns:
+        A binary uint8 CSR matrix.
+    """
+    rows, codes = np.asarray(rows, dtype=np.int64), np.asarray(codes, dtype=np.int64)
+    keep = codes >= 0
+    rows, codes = rows[keep], codes[keep]
+    unique_lengths = np.fromiter((len(idxs) for idxs in unique_indices), dtype=np.int64, count=len(unique_indices))
+    unique_ptr = np.concatenate(([0], np.cumsum(unique_lengths)))
+    unique_flat = np.concatenate([np.asarray(idxs, dtype=np.int64) for idxs in unique_indices] +
+                                 [np.empty(0, dtype=np.int64)])
+    lengths = unique_lengths[codes]
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    cols = unique_flat[np.repeat(unique_ptr[codes], lengths) + within]
+    matrix = sparse.csr_matrix((np.ones(len(cols), dtype=np.uint8), (np.repeat(rows, lengths), cols)), shape=shape)
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix
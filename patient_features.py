@@ -0,0 +1,88 @@
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+LBS_TO_KG = 0.45359237
+INCHES_TO_CM = 2.54
+# the OMR results attached to every ECG
+RESULT_COLUMNS = ['Weight', 'Height', 'BMI (kg/m2)', 'Blood Pressure']
+# result name -> (converted result name, conversion factor)
+UNIT_CONVERSIONS = {
+    'Height (Inches)': ('Height', INCHES_TO_CM),
+    'Weight (Lbs)': ('Weight', LBS_TO_KG),
+}
+FEATURE_COLUMNS = ['subject_id', 'study_id', 'image_id', 'age', 'gender', 'ecg_time']
+
+
+def convert_height_weight(results_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert the heights to cm and the weights to kg in the OMR table (omr.csv), rounded to 2 decimals.
+    'Height (Inches)' is renamed to 'Height' and 'Weight (Lbs)' to 'Weight'.
+    Args:
+        results_df: the OMR table, with 'result_name' and 'result_value' columns.
+    Returns:
+        A converted copy of results_df.
+    """
+    results_df = results_df.copy()
+    result_values = results_df['result_value'].astype(object)
+    for result_name, (converted_name, factor) in UNIT_CONVERSIONS.items():
+        mask = (results_df['result_name'] == result_name).to_numpy()
+        if not mask.any():
+            continue
+        converted = (pd.to_numeric(result_values[mask], errors='coerce') * factor).round(2)
+        result_values[mask] = converted.to_numpy(dtype=object)
+        results_df.loc[mask, 'result_name'] = converted_name
+    results_df['result_value'] = result_values
+    return results_df
+
+
+def attach_patient_features(ecg_df: pd.DataFrame, results_df: pd.DataFrame, patients_df: pd.DataFrame,
+                            result_names: List[str] = None, max_days: Optional[int] = None) -> pd.DataFrame:
+    """
+    Build the per-study patient feature table (ecg_with_patients_data_df): the age and gender of the subject
+    and, for every result in result_names, the OMR value charted nearest to the day of the ECG.
+    Every result is attached with a merge_asof by subject, so the memory used is bounded by the number of
+    ECGs and results instead of their per-subject product. Ties are resolved to the earlier result.
+    Args:
+        ecg_df: the ECGs (machine_measurements.csv), with 'subject_id', 'study_id' and 'ecg_time' columns.
+        results_df: the OMR table (omr.csv), with 'subject_id', 'chartdate', 'result_name' and
+            'result_value' columns. The units are converted with convert_height_weight.
+        patients_df: the patients table (patients.csv), with 'subject_id', 'anchor_age' and 'gender' columns.
+        result_names: the results to attach, defaults to RESULT_COLUMNS.
+        max_days: results charted more than max_days away from the ECG are ignored, by default any result is used.
+    Returns:
+        A DataFrame with one row per row of ecg_df and the FEATURE_COLUMNS + result_names columns.
+    """
+    result_names = RESULT_COLUMNS if result_names is None else result_names
+    subject_ids = ecg_df['subject_id'].to_numpy()
+    study_ids = ecg_df['study_id'].to_numpy()
+    features = pd.DataFrame({'subject_id': subject_ids, 'study_id': study_ids})
+    features['image_id'] = features['subject_id'].astype(str) + '_' + features['study_id'].astype(str)
+    patients = patients_df.drop_duplicates('subject_id').set_index('subject_id')
+    features['age'] = features['subject_id'].map(patients['anchor_age'])
+    features['gender'] = features['subject_id'].map(patients['gender'])
+    # the notebook compares days, not times
+    features['ecg_time'] = pd.to_datetime(ecg_df['ecg_time']).dt.normalize().to_numpy()
+
+    ecgs = pd.DataFrame({'subject_id': subject_ids, 'ecg_time': features['ecg_time'].to_numpy(),
+                         'row': np.arange(len(features))})
+    ecgs = ecgs.dropna(subset=['ecg_time']).sort_values('ecg_time', kind='stable')
+    # only the wanted results (and the ones converted to them) are converted
+    source_names = list(result_names) + [source_name for source_name, (converted_name, _)
+                                         in UNIT_CONVERSIONS.items() if converted_name in result_names]
+    results = results_df.loc[results_df['result_name'].isin(source_names),
+                             ['subject_id', 'chartdate', 'result_name', 'result_value']]
+    results = convert_height_weight(results)
+    results = results.assign(chartdate=pd.to_datetime(results['chartdate']),
+                             subject_id=results['subject_id'].astype(ecgs['subject_id'].dtype))
+    tolerance = None if max_days is None else pd.Timedelta(days=max_days)
+    for result_name in result_names:
+        by_result = results.loc[results['result_name'] == result_name, ['subject_id', 'chartdate', 'result_value']]
+        by_result = by_result.drop_duplicates(subset=['chartdate', 'subject_id'])
+        nearest = pd.merge_asof(ecgs, by_result.sort_values('chartdate', kind='stable'), left_on='ecg_time',
+                                right_on='chartdate', by='subject_id', direction='nearest', tolerance=tolerance)
+        values = np.full(len(features), np.nan, dtype=object)
+        values[nearest['row'].to_numpy()] = nearest['result_value'].to_numpy(dtype=object)
+        features[result_name] = values
+    return features
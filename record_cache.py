@@ -0,0 +1,232 @@
+import hashlib
+import multiprocessing
+import pickle
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from types import SimpleNamespace
+
+import numpy as np
+
+from ecg_io import SIGNAL_METADATA_FIELDS
+
+# the fields of a wfdb record the dataset items use, SharedRecordCache keeps them next to the signal
+HEADER_FIELDS = ['record_name', 'adc_gain', 'baseline'] + SIGNAL_METADATA_FIELDS
+
+
+class RecordCache:
+    """
+    This class is used to keep decoded records in memory between epochs, up to a byte budget.
+    The values are (stored_signal, record) pairs, as returned by ecg_io.read_wfdb_record, only the stored
+    signal (in the storage dtype, e.g. int16) is counted in the budget. The least recently used records
+    are evicted first.
+    The cache is local to the process, every DataLoader worker fills its own copy, see SharedRecordCache
+    to share a single cache between the workers.
+    Example:
+        dataset = ECGDataset(Path('./files'), record_cache=RecordCache(max_bytes=8 * 2 ** 30))
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.records = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def get_or_load(self, key, load):
+        """
+        Get a record from the cache, loading (and caching) it on a miss.
+        Args:
+            key: the key of the record, e.g. its path.
+            load: loads the (stored_signal, record) pair of the record.
+        Returns:
+            The (stored_signal, record) pair of the record.
+        """
+        if key in self.records:
+            self.hits += 1
+            self.records.move_to_end(key)
+            return self.records[key]
+        self.misses += 1
+        value = load()
+        nbytes = value[0].nbytes
+        if nbytes > self.max_bytes:
+            return value
+        while self.num_bytes + nbytes > self.max_bytes:
+            _, (evicted_signal, _) = self.records.popitem(last=False)
+            self.num_bytes -= evicted_signal.nbytes
+            self.evictions += 1
+        self.records[key] = value
+        self.num_bytes += nbytes
+        return value
+
+    def clear(self):
+        self.records.clear()
+        self.num_bytes = 0
+
+    def get_stats(self):
+        """
+        Get the hit/miss statistics of the cache.
+        """
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / requests if requests else 0.0, 'num_records': len(self.records),
+                'num_bytes': self.num_bytes, 'max_bytes': self.max_bytes}
+
+
+def get_header(record):
+    """
+    Get the header fields (HEADER_FIELDS) of a wfdb record, without its signal.
+    """
+    return SimpleNamespace(**{field: getattr(record, field) for field in HEADER_FIELDS})
+
+
+def _key_hash(key):
+    # a stable hash, the same in every worker process (hash() of str is salted per process)
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'little') & (2 ** 63 - 1)
+
+
+class SharedRecordCache:
+    """
+    This class is used to share a single cache of stored signals between all the DataLoader workers.
+    The signals are kept in slots of fixed shape inside a shared memory block created by the main process,
+    so a record decoded by one worker is a hit for all of them. The cache is set associative: a record may
+    be kept in the num_ways slots of its set, the least recently used slot of the set is replaced.
+    Every slot keeps the stored signal and the header fields of the record (see get_header) pickled in
+    header_bytes bytes, so a hit reads nothing from disk. Records whose signal does not fit a slot (another
+    shape or dtype), or whose header is larger than header_bytes, are not cached.
+    mp_context must be the multiprocessing context of the workers ('fork' or 'spawn'), the default one by default.
+    Call close() in the main process when done, to free the shared memory.
+    Example:
+        cache = SharedRecordCache(max_bytes=8 * 2 ** 30, signal_shape=(12, 5000))
+        dataset = ECGDataset(Path('./files'), record_cache=cache)
+        data_loader = DataLoader(dataset, batch_size=32, num_workers=8, collate_fn=dataset.collate_fn)
+    """
+    def __init__(self, max_bytes, signal_shape=(12, 5000), dtype=np.int16, num_ways=4, header_bytes=2048,
+                 mp_context=None):
+        self.signal_shape = tuple(signal_shape)
+        self.dtype = np.dtype(dtype)
+        self.num_ways = num_ways
+        self.header_bytes = header_bytes
+        slot_bytes = int(np.prod(self.signal_shape)) * self.dtype.itemsize + header_bytes
+        self.num_sets = max(int(max_bytes // (slot_bytes * num_ways)), 1)
+        num_slots = self.num_sets * num_ways
+        # the signals and headers, the header length, key hash and last use of every slot, and the hits, misses,
+        # evictions and clock
+        self.nbytes = num_slots * slot_bytes + num_slots * 24 + 4 * 8
+        self.shm = shared_memory.SharedMemory(create=True, size=self.nbytes)
+        self.lock = multiprocessing.get_context(mp_context).Lock()
+        self.owner = True
+        self.__attach__()
+        self.slot_keys[:] = -1
+        self.slot_ticks[:] = 0
+        self.counters[:] = 0
+
+    def __attach__(self):
+        num_slots = self.num_sets * self.num_ways
+        offset = 0
+        self.signals = np.ndarray((self.num_sets, self.num_ways) + self.signal_shape, dtype=self.dtype,
+                                  buffer=self.shm.buf, offset=offset)
+        offset += self.signals.nbytes
+        self.headers = np.ndarray((self.num_sets, self.num_ways, self.header_bytes), dtype=np.uint8,
+                                  buffer=self.shm.buf, offset=offset)
+        offset += self.headers.nbytes
+        self.header_lengths = np.ndarray((self.num_sets, self.num_ways), dtype=np.int64, buffer=self.shm.buf,
+                                         offset=offset)
+        offset += num_slots * 8
+        self.slot_keys = np.ndarray((self.num_sets, self.num_ways), dtype=np.int64, buffer=self.shm.buf, offset=offset)
+        offset += num_slots * 8
+        self.slot_ticks = np.ndarray((self.num_sets, self.num_ways), dtype=np.int64, buffer=self.shm.buf,
+                                     offset=offset)
+        offset += num_slots * 8
+        self.counters = np.ndarray(4, dtype=np.int64, buffer=self.shm.buf, offset=offset)
+
+    def __getstate__(self):
+        # spawned workers attach to the shared memory block by its name
+        state = {key: value for key, value in self.__dict__.items()
+                 if key not in ('shm', 'signals', 'headers', 'header_lengths', 'slot_keys', 'slot_ticks', 'counters')}
+        state['shm_name'] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        shm_name = state.pop('shm_name')
+        self.__dict__.update(state)
+        # the workers share the resource tracker of the main process, the block is registered there once
+        self.shm = shared_memory.SharedMemory(name=shm_name)
+        self.owner = False
+        self.__attach__()
+
+    def get_or_load(self, key, load):
+        """
+        Get a record from the cache, loading (and caching) it on a miss.
+        Args:
+            key: the key of the record, e.g. its record path.
+            load: loads the (stored_signal, record) pair of the record.
+        Returns:
+            The stored signal of the record, a private copy, and its header (see get_header).
+        """
+        key_hash = _key_hash(key)
+        set_idx = key_hash % self.num_sets
+        with self.lock:
+            self.counters[3] += 1
+            ways = np.flatnonzero(self.slot_keys[set_idx] == key_hash)
+            if len(ways):
+                self.counters[0] += 1
+                self.slot_ticks[set_idx, ways[0]] = self.counters[3]
+                stored_signal = self.signals[set_idx, ways[0]].copy()
+                header_data = self.headers[set_idx, ways[0], :self.header_lengths[set_idx, ways[0]]].tobytes()
+            else:
+                self.counters[1] += 1
+                stored_signal = None
+        if stored_signal is not None:
+            return stored_signal, pickle.loads(header_data)
+        stored_signal, record = load()
+        header = get_header(record)
+        header_data = pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL)
+        if (stored_signal.shape != self.signal_shape or stored_signal.dtype != self.dtype
+                or len(header_data) > self.header_bytes):
+            return stored_signal, header  # a slot would reshape, cast or cut it, such records are not cached
+        with self.lock:
+            if (self.slot_keys[set_idx] == key_hash).any():
+                return stored_signal, header  # cached meanwhile by another worker
+            way = int(np.argmin(self.slot_ticks[set_idx]))
+            if self.slot_keys[set_idx, way] >= 0:
+                self.counters[2] += 1
+            self.counters[3] += 1
+            self.slot_keys[set_idx, way] = -1
+            self.signals[set_idx, way] = stored_signal
+            self.headers[set_idx, way, :len(header_data)] = np.frombuffer(header_data, dtype=np.uint8)
+            self.header_lengths[set_idx, way] = len(header_data)
+            self.slot_keys[set_idx, way] = key_hash
+            self.slot_ticks[set_idx, way] = self.counters[3]
+        return stored_signal, header
+
+    def clear(self):
+        with self.lock:
+            self.slot_keys[:] = -1
+            self.slot_ticks[:] = 0
+
+    def get_stats(self):
+        """
+        Get the hit/miss statistics of the cache, summed over all the processes using it.
+        """
+        hits, misses, evictions = (int(count) for count in self.counters[:3])
+        requests = hits + misses
+        num_records = int((self.slot_keys >= 0).sum())
+        return {'hits': hits, 'misses': misses, 'evictions': evictions,
+                'hit_rate': hits / requests if requests else 0.0, 'num_records': num_records,
+                'num_bytes': num_records * (self.signals[0, 0].nbytes + self.header_bytes),
+                'max_bytes': self.signals.nbytes + self.headers.nbytes}
+
+    def close(self):
+        """
+        Detach from the shared memory, the process that created the cache also frees it.
+        """
+        self.signals = self.headers = self.header_lengths = self.slot_keys = self.slot_ticks = self.counters = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,132 @@
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from label_store import align_labels
+
+
+def _intersect(rows: Optional[np.ndarray], other_rows: np.ndarray) -> np.ndarray:
+    return other_rows if rows is None else np.intersect1d(rows, other_rows, assume_unique=True)
+
+
+class RecordQuery:
+    """
+    This class is used to select records by subject, split, label, quality and date without reading any file.
+    The columns of the manifest (see signal_store.MANIFEST_COLUMNS) are indexed once: the rows of every subject,
+    split and label, and the rows sorted by quality and by date. Every filter of select is a lookup in one of
+    the indexes, giving sorted rows, and the filters are combined by intersecting the rows.
+    Args:
+        manifest: the records, one row per record with at least a record_id column, e.g. SignalStore.manifest.
+        label_store: a LabelStore (or any object with get_matrix, get_record_ids and get_categories).
+        splits: the manifest rows of every fold, e.g. from splits.load_splits.
+        quality: a quality score of every record, e.g. the number of valid median beat leads.
+        ecg_times: the time of every record, e.g. the ecg_time of machine_measurements.
+    Example:
+        query = RecordQuery(store.manifest, label_store=label_store, splits=load_splits('splits.npz'),
+                            quality=valid.sum(axis=1))
+        record_ids = query.select(split='train', labels=['Atrial fibrillation'], min_quality=10, limit=1000)
+        dataset = ECGDataset(signal_store=store, record_ids=record_ids)
+    """
+    def __init__(self, manifest: pd.DataFrame, label_store=None, splits: Optional[Dict[str, np.ndarray]] = None,
+                 quality: Optional[Sequence[float]] = None, ecg_times: Optional[Sequence] = None):
+        self.record_ids = manifest['record_id'].to_numpy().astype(str)
+        self.subject_ids = manifest['subject_id'].to_numpy() if 'subject_id' in manifest else None
+        self.splits = {name: np.unique(rows) for name, rows in (splits or {}).items()}
+        self.labels = None
+        self.categories = None
+        if label_store is not None:
+            self.labels = sparse.csc_matrix(align_labels(label_store.get_matrix(), label_store.get_record_ids(),
+                                                         self.record_ids))
+            self.categories = pd.Index(label_store.get_categories())
+        self.quality_order, self.sorted_quality = self.__sort__(quality)
+        self.time_order, self.sorted_times = self.__sort__(None if ecg_times is None else pd.to_datetime(ecg_times))
+        self.subject_rows = None
+
+    def __len__(self) -> int:
+        return len(self.record_ids)
+
+    @staticmethod
+    def __sort__(values):
+        if values is None:
+            return None, None
+        values = np.asarray(values)
+        # the records without a value (nan, NaT) match no range, they would sort last and match any open range
+        order = np.flatnonzero(~pd.isna(values))
+        order = order[np.argsort(values[order], kind='stable')]
+        return order, values[order]
+
+    def __get_subject_rows__(self, subject_ids) -> np.ndarray:
+        if self.subject_ids is None:
+            raise ValueError("the manifest has no subject_id column")
+        if self.subject_rows is None:
+            rows = pd.Series(np.arange(len(self.subject_ids)))
+            self.subject_rows = rows.groupby(self.subject_ids.astype(str)).indices
+        rows = [self.subject_rows.get(str(subject_id), []) for subject_id in np.atleast_1d(subject_ids)]
+        return np.unique(np.concatenate(rows)).astype(np.int64) if rows else np.empty(0, dtype=np.int64)
+
+    def __get_label_rows__(self, label: str) -> np.ndarray:
+        if self.labels is None:
+            raise ValueError("labels require a label_store")
+        column = self.categories.get_loc(label)
+        return np.sort(self.labels.indices[self.labels.indptr[column]:self.labels.indptr[column + 1]])
+
+    @staticmethod
+    def __get_range_rows__(order, sorted_values, low, high, name) -> np.ndarray:
+        if order is None:
+            raise ValueError(f"filtering by {name} requires the {name} of the records")
+        start = 0 if low is None else np.searchsorted(sorted_values, low, side='left')
+        end = len(order) if high is None else np.searchsorted(sorted_values, high, side='right')
+        return np.sort(order[start:end])
+
+    def select_rows(self, subject_ids=None, split: Optional[str] = None, labels: Optional[Sequence[str]] = None,
+                    any_labels: Optional[Sequence[str]] = None, min_quality=None, max_quality=None,
+                    start_time=None, end_time=None, limit: Optional[int] = None,
+                    seed: Optional[int] = None) -> np.ndarray:
+        """
+        Select the manifest rows of the records matching all the given filters.
+        Args:
+            subject_ids: a subject id or a list of subject ids.
+            split: the name of a fold of splits.
+            labels: the records must have all these labels.
+            any_labels: the records must have at least one of these labels.
+            min_quality: the minimal quality, inclusive.
+            max_quality: the maximal quality, inclusive.
+            start_time: the earliest ecg time, inclusive.
+            end_time: the latest ecg time, inclusive.
+            limit: the maximal number of rows, the first ones unless seed is given.
+            seed: when given with limit, the rows are drawn at random with this seed.
+        Returns:
+            The sorted manifest rows.
+        """
+        rows = None
+        if split is not None:
+            rows = _intersect(rows, self.splits[split])
+        if subject_ids is not None:
+            rows = _intersect(rows, self.__get_subject_rows__(subject_ids))
+        for label in labels or []:
+            rows = _intersect(rows, self.__get_label_rows__(label))
+        if any_labels:
+            rows = _intersect(rows, np.unique(np.concatenate([self.__get_label_rows__(label)
+                                                              for label in any_labels])))
+        if min_quality is not None or max_quality is not None:
+            rows = _intersect(rows, self.__get_range_rows__(self.quality_order, self.sorted_quality, min_quality,
+                                                            max_quality, 'quality'))
+        if start_time is not None or end_time is not None:
+            start_time = None if start_time is None else pd.Timestamp(start_time).to_datetime64()
+            end_time = None if end_time is None else pd.Timestamp(end_time).to_datetime64()
+            rows = _intersect(rows, self.__get_range_rows__(self.time_order, self.sorted_times, start_time, end_time,
+                                                            'ecg_times'))
+        rows = np.arange(len(self.record_ids)) if rows is None else rows
+        if limit is not None and len(rows) > limit:
+            if seed is None:
+                return rows[:limit]
+            return np.sort(np.random.default_rng(seed).choice(rows, limit, replace=False))
+        return rows
+
+    def select(self, **filters) -> np.ndarray:
+        """
+        Select the record ids of the records matching all the given filters, see select_rows.
+        """
+        return self.record_ids[self.select_rows(**filters)]
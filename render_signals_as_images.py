@@ -1,6 +1,8 @@
 from concurrent.futures import ThreadPoolExecutor
-from itertools import islice
+from functools import partial
+from itertools import chain, islice
 import os
+import shutil
 import pandas as pd
 import numpy as np
 from PIL import Image
@@ -18,6 +20,13 @@ from pathlib import Path
 from scipy.signal import butter, filtfilt
 from ECGMetaData import ECGMetaData
 from ECGGenerator import ECGGenerator
+from dtype_policy import DEFAULT_DTYPE_POLICY
+from ecg_io import read_wfdb_record, load_challenge_data, get_challenge_sample_rate, get_mimic_header_path
+from resampling import resample_to_rate, resample_records
+from signal_store import pad_or_truncate
+from median_beats import (median_beats, median_beats_validity, open_median_beats_memmap, compact_valid_ecgs,
+                          save_kept_idx, BEAT_LENGTH)
+from dedup import content_hash, get_canonical_rows
 
 
 SAMPLE_RATE = 500
@@ -44,60 +53,71 @@ def is_signal_good(signal):
     return count_num_bad_leads < 3
 
 
-def load_challenge_data(filename):
-    x = loadmat(filename)
-    data = np.asarray(x['val'], dtype=np.float64)
-    new_file = filename.replace('.mat', '.hea')
-    input_header_file = os.path.join(new_file)
-    with open(input_header_file, 'r') as f:
-        header_data = f.readlines()
-    return data, header_data
-
-
-def import_ecg_data(directory, ecg_len=5000, trunc="post", pad="post"):
+def import_ecg_data(directory, ecg_len=5000, trunc="post", pad="post", dtype_policy=DEFAULT_DTYPE_POLICY,
+                    sample_rate=SAMPLE_RATE):
     """
     get ecg data from a directory after padding or truncating if needed.
     in WPW all the data is at least 5000 and without any Nans
+    for large directories use signal_store.pack_challenge_signals, which reads the files in parallel
+    and streams them to a signal store instead of holding them in memory.
     :param directory:
     :param ecg_len:
     :param trunc:
     :param pad:
+    :param dtype_policy: the signals are returned as ADC values in the policy's storage dtype.
+    :param sample_rate: the signals are resampled to this rate, records are batched by their original rate.
     :return:
     """
     print("Starting ECG import..")
     ecgs = []
+    source_rates = []
     name_mapping = []
     for i, ecgfilename in enumerate(tqdm(sorted(os.listdir(directory)))):
         # if i not in [167, 171, 317, 319]: #the file numbers with the longer duration
         #     continue
         filepath = directory + os.sep + ecgfilename
         if filepath.endswith(".mat"):
-            data, header_data = load_challenge_data(filepath)
+            data, header_data = load_challenge_data(filepath, dtype_policy)
             # if data.shape != (12, 5000):  # TODO: note: there are larger files, can we use them for more samples?
             #     print(f"file num {i}, {ecgfilename}, need to be padded or truncated, original size is {data.shape}")
-            # data = pad_sequences(data, maxlen=ecg_len, truncating=trunc, padding=pad)
             ecgs.append(data)
+            source_rates.append(get_challenge_sample_rate(header_data))
             name_mapping.append(ecgfilename.split('.')[0])
+    ecgs = resample_records(ecgs, source_rates, sample_rate, dtype=dtype_policy.get_storage_dtype())
+    ecgs = [pad_or_truncate(data, ecg_len, trunc=trunc, pad=pad) for data in ecgs]
     print("Finished!")
     return np.asarray(ecgs), name_mapping
 
-def process_files(file_pair):
+def process_files(file_pair, dtype_policy=DEFAULT_DTYPE_POLICY, sample_rate=SAMPLE_RATE, with_content_hash=False):
     header_path, signal_path = file_pair
     study_file = header_path.stem
-    metadata = wfdb.rdheader(f'{header_path.parent}/{study_file}')
+    stored_signal, metadata = read_wfdb_record(f'{header_path.parent}/{study_file}', dtype_policy)
     patient_id = metadata.comments
     patient_id = [column.split(":")[1].strip() for column in patient_id][0]
-    study_signal = signal_path.stem
-    signal_data, signal_metadata = wfdb.rdsamp(f'{signal_path.parent}/{study_signal}')
-    return signal_data.T, (patient_id, study_file)
+    signal_data = dtype_policy.to_compute(stored_signal, metadata.adc_gain, metadata.baseline)
+    if metadata.fs != sample_rate:
+        signal_data = resample_to_rate(signal_data, metadata.fs, sample_rate, dtype=dtype_policy.get_compute_dtype())
+    return signal_data, (patient_id, study_file), content_hash(stored_signal) if with_content_hash else None
 
 
-def import_ecg_mimic_data(directory, ecg_len=5000, trunc="post", pad="post", num_of_ecgs_to_test=None):
+def import_ecg_mimic_data(directory, ecg_len=5000, trunc="post", pad="post", num_of_ecgs_to_test=None,
+                          dtype_policy=DEFAULT_DTYPE_POLICY, record_ids=None, return_content_hashes=False):
+    """
+    Read the MIMIC-IV-ECG records of a directory.
+    :param record_ids: when given (e.g. from record_query.RecordQuery.select), only these records are read,
+    the directory must be the files directory of the dataset and is not searched.
+    :param return_content_hashes: also return the content hash of every record (see dedup.content_hash).
+    """
     print("Starting ECG import..")
     ecgs = []
     name_mapping = []
-    header_paths = directory.rglob("*.hea")
-    signal_paths = directory.rglob("*.dat")
+    content_hashes = []
+    if record_ids is not None:
+        header_paths = [get_mimic_header_path(directory, record_id) for record_id in record_ids]
+        signal_paths = [header_path.with_suffix('.dat') for header_path in header_paths]
+    else:
+        header_paths = directory.rglob("*.hea")
+        signal_paths = directory.rglob("*.dat")
 
     ecgs = []
     name_mapping = []
@@ -108,94 +128,81 @@ def import_ecg_mimic_data(directory, ecg_len=5000, trunc="post", pad="post", num
         file_pairs = islice(file_pairs, num_of_ecgs_to_test)
 
     with ThreadPoolExecutor() as executor:
-        results = executor.map(process_files, file_pairs)
+        results = executor.map(partial(process_files, dtype_policy=dtype_policy,
+                                       with_content_hash=return_content_hashes), file_pairs)
         
-        for ecg_data, ecg_name_mapping in results:
+        for ecg_data, ecg_name_mapping, ecg_content_hash in results:
             ecgs.append(ecg_data)
             name_mapping.append(ecg_name_mapping)
+            content_hashes.append(ecg_content_hash)
             
             if num_of_ecgs_to_test and len(ecgs) >= num_of_ecgs_to_test:
                 break
 
     print("Finished reading all data!")
+    if return_content_hashes:
+        return np.asarray(ecgs), name_mapping, content_hashes
     return np.asarray(ecgs), name_mapping
 
 
-def resample_beats(beats):
-    rsmp_beats = []
-    for i in beats:
-        i = np.asarray(i)
-
-        # i = i[~np.isnan(i)]
-        f = signal.resample(i, 250)
-        rsmp_beats.append(f)
-    rsmp_beats = np.asarray(rsmp_beats)
-    return rsmp_beats
-
-
-def median_beat(beat_dict):
-    beats = []
-    for i in beat_dict.values():
-        # print(i['Signal'])
-        beats.append(i['Signal'])
-    beats = np.asarray(beats)
-    rsmp_beats = resample_beats(beats)
-    med_beat = np.median(rsmp_beats, axis=0)
-    return med_beat
-
-
-def process_ecgs(raw_ecg):
-    processed_ecgs = []
-    for i in tqdm(range(len(raw_ecg))):
-        leadII = raw_ecg[i][1]
-        leadII_clean = nk.ecg_clean(leadII, sampling_rate=SAMPLE_RATE, method="neurokit")
-        r_peaks = nk.ecg_findpeaks(leadII_clean, sampling_rate=SAMPLE_RATE, method="neurokit", show=False)
-        twelve_leads = []
-        for lead_index, raw_lead_signal in enumerate(raw_ecg[i]):
-            try:
-                beats = nk.ecg_segment(raw_lead_signal, rpeaks=r_peaks['ECG_R_Peaks'], sampling_rate=SAMPLE_RATE,
-                                       show=False)
-                # note: the beats dict sometimes misses his last bit making it only Nans and zeroes. it should pad with
-                # nans the last beats but sometimes it is just zeroes and nans
-                last_bit_key = str(np.max(np.array(list(beats.keys()), dtype=int)))
-                last_bit_signal_values = np.sort(beats[last_bit_key]['Signal'].unique())
-                if np.array_equal(last_bit_signal_values, np.array([0, np.nan]), equal_nan=True):
-                    print(f"problematic last heart beat in ECG num {i}, lead {lead_index}")
-                med_beat = median_beat(beats)
-                twelve_leads.append(med_beat)
-                # print(f"try success in file {i}, lead {raw_lead_signal}")
-            except:
-                beats = np.ones(250) * np.nan
-                twelve_leads.append(beats)
-                # print(f"try failed in file {i}, lead {raw_lead_signal}") #in wpw, all beats succeed in the try
-        # twelve_leads = np.asarray(twelve_leads)
-        processed_ecgs.append(twelve_leads)
-    processed_ecgs = np.asarray(processed_ecgs)
-    return processed_ecgs
-
-
-def remove_some_ecgs(ecg_arr):
-    delete_list = []
-    for i in tqdm(range(len(ecg_arr))):
-        if np.all(ecg_arr[i].T[0] == 1):
-            delete_list.append(i)
-    ecg_arr = np.delete(ecg_arr, delete_list, axis=0)
-    return ecg_arr
-
-
-def remove_nans(ecg_arr):
-    new_arr = []
-    for i in tqdm(ecg_arr):
-        twelve_lead = []
-        for j in i:
-            if j[0] != j[0]:
-                j = np.ones(250)
-            twelve_lead.append(j)
-        new_arr.append(twelve_lead)
-    new_arr = np.asarray(new_arr)
-    return new_arr
-
-def main(ecg_formats,input_data_dir=Path("./files")):
+def process_ecgs(raw_ecg, num_ecgs=None, output_path=None, dtype_policy=DEFAULT_DTYPE_POLICY, min_valid_leads=1):
+    """
+    Compute the median beats of ecgs and drop the ecgs without enough valid leads.
+    :param raw_ecg: an array or an iterable of ecgs shaped (leads, samples).
+    :param num_ecgs: the number of ecgs, needed when raw_ecg is an iterable without a length.
+    :param output_path: when given, the results are streamed to memory-mapped files with this
+    prefix (see open_median_beats_memmap) instead of being held in memory, with the indexes of the kept ecgs
+    (see save_kept_idx).
+    :param dtype_policy: the median beats are computed and returned in the policy's compute dtype.
+    :param min_valid_leads: the ecgs with less valid leads are dropped (see compact_valid_ecgs), 0 keeps all.
+    :return: the median beats of the kept ecgs shaped (N, leads, 250), their validity mask shaped (N, leads)
+    and the indexes of the kept ecgs in raw_ecg.
+    """
+    num_ecgs = len(raw_ecg) if num_ecgs is None else num_ecgs
+    if hasattr(raw_ecg, 'shape'):
+        num_leads = raw_ecg.shape[1]
+    else:
+        # the number of leads is taken from the first ecg of the iterable
+        raw_ecg = iter(raw_ecg)
+        first_ecg = next(raw_ecg, None)
+        num_leads = 12 if first_ecg is None else len(first_ecg)
+        raw_ecg = chain([] if first_ecg is None else [first_ecg], raw_ecg)
+    if output_path is not None:
+        processed_ecgs, valid = open_median_beats_memmap(output_path, num_ecgs, num_leads=num_leads,
+                                                         dtype=dtype_policy.get_compute_dtype())
+    else:
+        processed_ecgs = np.empty((num_ecgs, num_leads, BEAT_LENGTH), dtype=dtype_policy.get_compute_dtype())
+        valid = np.empty((num_ecgs, num_leads), dtype=np.bool_)
+    for i, ecg in enumerate(tqdm(raw_ecg, total=num_ecgs)):
+        processed_ecgs[i] = np.nan
+        try:
+            leadII_clean = nk.ecg_clean(ecg[1], sampling_rate=SAMPLE_RATE, method="neurokit")
+            r_peaks = nk.ecg_findpeaks(leadII_clean, sampling_rate=SAMPLE_RATE, method="neurokit", show=False)
+        except ValueError:
+            print(f"could not find R-peaks in ECG num {i}")
+        else:
+            processed_ecgs[i] = median_beats(ecg, r_peaks['ECG_R_Peaks'], sampling_rate=SAMPLE_RATE)
+        valid[i] = median_beats_validity(processed_ecgs[i])
+    processed_ecgs, valid, kept_idx = compact_valid_ecgs(processed_ecgs, valid, min_valid_leads=min_valid_leads)
+    if output_path is not None:
+        processed_ecgs.flush()
+        valid.flush()
+        save_kept_idx(output_path, kept_idx)
+    return processed_ecgs, valid, kept_idx
+
+
+def copy_rendered_images(ecg_formats, source_name, target_name):
+    """
+    Copy the images of a rendered ecg to the name of another ecg with the same samples, in every format.
+    """
+    for ecg_format in ecg_formats:
+        output_images_dir = os.path.join(os.getcwd(), f'images_format_{ecg_format}')
+        source_path = f'{output_images_dir}/{source_name}.png'
+        if os.path.exists(source_path):
+            shutil.copyfile(source_path, f'{output_images_dir}/{target_name}.png')
+
+
+def main(ecg_formats,input_data_dir=Path("./files"),record_ids=None,skip_duplicates=True):
     # np.seterr(all='raise')
     SAMPLE_RATE = 500
     ECG_LEN =  SAMPLE_RATE*10
@@ -235,13 +242,25 @@ def main(ecg_formats,input_data_dir=Path("./files")):
     ]
 
     num_of_ecgs_to_test = None #1000  # None for all
-    full_ecg, full_name_mapping = import_ecg_mimic_data(input_data_dir, ecg_len=ECG_LEN, num_of_ecgs_to_test=num_of_ecgs_to_test)
-    ecg_signals = full_ecg[:num_of_ecgs_to_test]
-    name_mapping = full_name_mapping[:num_of_ecgs_to_test]
+    # record_ids (e.g. from record_query.RecordQuery.select) renders only these records
+    imported = import_ecg_mimic_data(input_data_dir, ecg_len=ECG_LEN, num_of_ecgs_to_test=num_of_ecgs_to_test,
+                                     record_ids=record_ids, return_content_hashes=skip_duplicates)
+    ecg_signals = imported[0][:num_of_ecgs_to_test]
+    name_mapping = imported[1][:num_of_ecgs_to_test]
+    # with skip_duplicates, a record with the same samples as an earlier one gets a copy of its images
+    canonical_rows = (get_canonical_rows(imported[2][:num_of_ecgs_to_test]) if skip_duplicates
+                      else np.arange(len(ecg_signals)))
+    num_skipped = 0
 
     for ecg_sample_index, (ecg_sample, ecg_signal_name) in enumerate(zip(ecg_signals, name_mapping)):
         ecg_signal_patiend_id = ecg_signal_name[0]
         ecg_signal_study_id = ecg_signal_name[1]
+        if canonical_rows[ecg_sample_index] != ecg_sample_index:
+            canonical_patient_id, canonical_study_id = name_mapping[canonical_rows[ecg_sample_index]]
+            copy_rendered_images(ecg_formats, f'{canonical_patient_id}_{canonical_study_id}',
+                                 f'{ecg_signal_patiend_id}_{ecg_signal_study_id}')
+            num_skipped += 1
+            continue
         clean_ecg_sample = []
         problematic_ecg_lead = 0  # id zero, no problems in sample, else an index of a problematic lead
 
@@ -301,6 +320,10 @@ def main(ecg_formats,input_data_dir=Path("./files")):
             except ValueError:
                 print(f'Could not render ecg {ecg_signal_name} with format {ecg_format}')
 
+    if skip_duplicates and len(ecg_signals):
+        print(f"Skipped {num_skipped} duplicate ECGs out of {len(ecg_signals)} "
+              f"({num_skipped / len(ecg_signals):.1%} of the rendering), their images are copies")
+
 if __name__ == '__main__':
     ecg_formats = [0]
     main(ecg_formats)
\ No newline at end of file
@@ -0,0 +1,306 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from multi_hot import multi_hot_from_codes
+
+# default names given to columns in the MIMIC-IV ECG database for the free-text diagnosis
+REPORT_COLUMNS = [f'report_{i}' for i in range(18)]
+IGNORED_CLASSIFICATIONS = ('?', '', 'Ignore')
+# a report starting with one of these words is an uncertain diagnosis
+UNCERTAINTY_WORDS = ('possible', 'probable', 'likely', 'borderline', 'questionable', 'equivocal', 'suspected',
+                     'unconfirmed', 'uncertain', 'inconclusive', 'indeterminate', 'unknown', 'unspec')
+# modifier reports only make sense with the report before them, e.g. 'atrial fibrillation',
+# 'with rapid ventricular response'. The report before is mapped to the category it modifies.
+REPORTS_TO_HANDLE_MAP = {
+    'atrial fibrillation': 'Atrial Fibrillation',
+    'probable atrial fibrillation': 'Atrial Fibrillation',
+    'atrial flutter': 'Atrial Flutter',
+    'possible atrial flutter': 'Atrial Flutter',
+    'possible idioventricular rhythm': 'Idioventricular Rhythm',
+}
+# the category replacing the modified category, for every modifier report
+MODIFIED_CATEGORIES = {
+    'with rapid ventricular response': {
+        'Atrial Fibrillation': 'Atrial Fibrillation with a Rapid Ventricular Rate',
+        'Atrial Flutter': 'Atrial Flutter with a Rapid Ventricular Rate',
+        'Idioventricular Rhythm': 'Accelerated Idioventricular Rhythm',
+    },
+    'with slow ventricular response': {
+        'Atrial Fibrillation': 'Atrial Fibrillation with a Slow Ventricular Rate',
+        'Atrial Flutter': 'Atrial Flutter with a Slow Ventricular Rate',
+        'Idioventricular Rhythm': 'Idioventricular Rhythm with a Slow Ventricular Rate',
+    },
+}
+
+
+def clean_report(report):
+    """
+    Remove the excess from a free-text diagnosis: '.', '- ', 'summary:' and nans.
+    """
+    if pd.isna(report):
+        return ''
+    report = report.lower()
+    if report.endswith('.'):
+        report = report[:-1].strip()
+    if report.startswith('- '):
+        report = report[1:].lstrip()
+    elif report.startswith('summary:'):
+        report = report[8:].lstrip()
+    return report
+
+
+def is_uncertain_report(reports) -> np.ndarray:
+    """
+    Flag the cleaned reports that start with an uncertainty word (see UNCERTAINTY_WORDS).
+    Args:
+        reports: the cleaned reports, missing reports are nans.
+    Returns:
+        A bool array, True for every uncertain report.
+    """
+    return pd.Series(reports, dtype=object).fillna('').str.startswith(UNCERTAINTY_WORDS).to_numpy(dtype=bool)
+
+
+def remove_uncertain_labels(labels: sparse.csr_matrix, uncertain_labels: sparse.csr_matrix) -> sparse.csr_matrix:
+    """
+    Reset the label bits that were set by an uncertain report (labels AND NOT uncertain_labels).
+    Example: 'Sinus rhythm', 'Possible right atrial abnormality' keeps Normal Sinus Rhythm only.
+    """
+    labels = sparse.csr_matrix(labels)
+    without_uncertain = (labels - labels.multiply(uncertain_labels)).tocsr()
+    without_uncertain.eliminate_zeros()
+    return without_uncertain.astype(labels.dtype)
+
+
+def build_diagnosis_map(tags_df: pd.DataFrame) -> Dict[str, List[str]]:
+    """
+    Build the manually fitted diagnosis map from the tags file.
+    Args:
+        tags_df: the tags file (tags.csv), with 'Unique Report' and 'Our Classification' columns.
+            'Our Classification' holds comma separated categories.
+    Returns:
+        A dict from every category to the cleaned reports classified as it.
+    """
+    diagnosis_map = {}
+    for free_text_diagnosis, manual_classification in zip(tags_df['Unique Report'], tags_df['Our Classification']):
+        if pd.isna(manual_classification):
+            continue
+        for category in (k.strip() for k in manual_classification.split(',')):
+            if category not in IGNORED_CLASSIFICATIONS and not category.startswith('?'):
+                diagnosis_map.setdefault(category, []).append(free_text_diagnosis)
+    return diagnosis_map
+
+
+class ModifierReportParser:
+    """
+    This class is used to resolve the modifier reports (MODIFIED_CATEGORIES) against the report before them.
+    The report columns of a study are read as one sequence: the first modifier report of the study and its
+    predecessor select a rule, and if the modified category is set it is replaced by the category of the rule
+    (e.g. Atrial Fibrillation -> Atrial Fibrillation with a Rapid Ventricular Rate).
+    All the studies are resolved together with array operations.
+    Rules whose categories are not in the label space are ignored.
+    """
+    def __init__(self, categories: List[str], reports_to_handle_map: Dict[str, str] = None,
+                 modified_categories: Dict[str, Dict[str, str]] = None):
+        reports_to_handle_map = REPORTS_TO_HANDLE_MAP if reports_to_handle_map is None else reports_to_handle_map
+        modified_categories = MODIFIED_CATEGORIES if modified_categories is None else modified_categories
+        category_to_idx = {category: idx for idx, category in enumerate(categories)}
+        self.num_categories = len(categories)
+        self.modifier_to_code = {modifier: code for code, modifier in enumerate(modified_categories)}
+        base_categories = list(dict.fromkeys(reports_to_handle_map.values()))
+        self.report_before_to_code = {report: base_categories.index(category)
+                                      for report, category in reports_to_handle_map.items()}
+        # (base code, modifier code) -> the modified category index and the replacing category index
+        self.base_idxs = np.full((len(base_categories), len(modified_categories)), -1, dtype=np.int64)
+        self.replacing_idxs = np.full_like(self.base_idxs, -1)
+        for modifier, replacements in modified_categories.items():
+            for base_category, replacing_category in replacements.items():
+                if base_category in base_categories and base_category in category_to_idx and \
+                        replacing_category in category_to_idx:
+                    rule = base_categories.index(base_category), self.modifier_to_code[modifier]
+                    self.base_idxs[rule] = category_to_idx[base_category]
+                    self.replacing_idxs[rule] = category_to_idx[replacing_category]
+
+    def resolve(self, reports: np.ndarray, labels: sparse.csr_matrix) -> sparse.csr_matrix:
+        """
+        Resolve the modifier reports of a table of free-text reports.
+        Args:
+            reports: the reports, shaped (records, report columns). Missing reports are nans.
+            labels: the binary label matrix of the reports, shaped (records, categories).
+        Returns:
+            The resolved binary CSR label matrix.
+        """
+        reports = np.asarray(reports, dtype=object)
+        codes, unique_reports = pd.factorize(reports.ravel())
+        return self.resolve_codes(codes.reshape(reports.shape), [clean_report(report) for report in unique_reports],
+                                  labels)
+
+    def resolve_codes(self, codes: np.ndarray, cleaned_reports: List[str],
+                      labels: sparse.csr_matrix) -> sparse.csr_matrix:
+        """
+        Resolve the modifier reports of a factorized table of reports, see resolve.
+        Args:
+            codes: the code of every report in cleaned_reports, shaped (records, report columns), -1 when missing.
+            cleaned_reports: the unique cleaned reports.
+            labels: the binary label matrix of the reports, shaped (records, categories).
+        """
+        # the last entry is used by the missing reports (code -1)
+        modifier_codes = np.array([self.modifier_to_code.get(report, -1) for report in cleaned_reports] + [-1])
+        report_before_codes = np.array([self.report_before_to_code.get(report, -1)
+                                        for report in cleaned_reports] + [-1])
+        modifiers = modifier_codes[codes]
+        # a modifier in the first report column has nothing to modify
+        has_modifier = modifiers[:, 1:] >= 0
+        rows = np.flatnonzero(has_modifier.any(axis=1))
+        cols = has_modifier[rows].argmax(axis=1) + 1
+        modifiers = modifiers[rows, cols]
+        reports_before = report_before_codes[codes[rows, cols - 1]]
+        known = reports_before >= 0
+        rows, base_idxs, replacing_idxs = (rows[known], self.base_idxs[reports_before[known], modifiers[known]],
+                                           self.replacing_idxs[reports_before[known], modifiers[known]])
+        labels = sparse.csr_matrix(labels)
+        known = base_idxs >= 0
+        rows, base_idxs, replacing_idxs = rows[known], base_idxs[known], replacing_idxs[known]
+        if len(rows) == 0:
+            return labels
+        is_set = np.asarray(labels[rows, base_idxs]).ravel() > 0
+        rows, base_idxs, replacing_idxs = rows[is_set], base_idxs[is_set], replacing_idxs[is_set]
+        ones = np.ones(len(rows), dtype=np.int16)
+        delta = sparse.csr_matrix((np.concatenate((-ones, ones)), (np.concatenate((rows, rows)),
+                                                                  np.concatenate((base_idxs, replacing_idxs)))),
+                                  shape=labels.shape)
+        resolved = (labels.astype(np.int16) + delta).tocsr()
+        resolved.eliminate_zeros()
+        resolved.data[:] = 1
+        return resolved.astype(labels.dtype)
+
+
+class ReportClassifier:
+    """
+    This class is used to classify the free-text reports of the MIMIC-IV-ECG machine measurements.
+    It builds an inverted index from every cleaned report to the indexes of its categories once, then
+    maps all the report columns in one pass over their unique values.
+    Example:
+        classifier = ReportClassifier(build_diagnosis_map(pd.read_csv('tags.csv')))
+        labels, study_ids = classifier.classify(pd.read_csv('all_data/machine_measurements.csv'))
+    """
+    def __init__(self, diagnosis_map: Dict[str, List[str]]):
+        self.categories = list(diagnosis_map.keys())
+        self.num_categories = len(self.categories)
+        report_to_indices = {}
+        for idx, category in enumerate(self.categories):
+            for report in diagnosis_map[category]:
+                report_to_indices.setdefault(clean_report(report), []).append(idx)
+        self.report_to_indices = {report: np.unique(idxs) for report, idxs in report_to_indices.items()}
+        self.modifier_parser = ModifierReportParser(self.categories)
+
+    def __len__(self) -> int:
+        return self.num_categories
+
+    def get_categories(self) -> List[str]:
+        return self.categories
+
+    def get_report_categories(self, report: str) -> List[str]:
+        """
+        Get the categories of a single free-text report.
+        """
+        return [self.categories[idx] for idx in self.report_to_indices.get(clean_report(report), [])]
+
+    def __factorize__(self, reports: np.ndarray) -> Tuple[np.ndarray, np.ndarray, List[str], Tuple[int, int]]:
+        reports = np.asarray(reports, dtype=object)
+        codes, unique_reports = pd.factorize(reports.ravel())
+        # every unique report is cleaned once
+        cleaned_reports = [clean_report(report) for report in unique_reports]
+        rows = np.arange(codes.size) // reports.shape[1]
+        return rows, codes, cleaned_reports, (reports.shape[0], self.num_categories)
+
+    def encode_reports(self, reports: np.ndarray, resolve_modifiers: bool = True) -> sparse.csr_matrix:
+        """
+        Classify a table of free-text reports.
+        Args:
+            reports: the reports, shaped (records, report columns). Missing reports are nans.
+            resolve_modifiers: resolve the modifier reports, see ModifierReportParser.
+        Returns:
+            A binary CSR matrix shaped (records, categories).
+        """
+        reports = np.asarray(reports, dtype=object)
+        rows, codes, cleaned_reports, shape = self.__factorize__(reports)
+        unique_indices = [self.report_to_indices.get(report, ()) for report in cleaned_reports]
+        labels = multi_hot_from_codes(rows, codes, unique_indices, shape)
+        if resolve_modifiers:
+            labels = self.modifier_parser.resolve_codes(codes.reshape(reports.shape), cleaned_reports, labels)
+        return labels
+
+    def encode_reports_with_uncertainty(self, reports: np.ndarray,
+                                        resolve_modifiers: bool = True) -> Tuple[sparse.csr_matrix,
+                                                                                 sparse.csr_matrix]:
+        """
+        Classify a table of free-text reports, and separately the uncertain reports only.
+        Both matrices come from a single pass over the unique reports.
+        Args:
+            reports: the reports, shaped (records, report columns). Missing reports are nans.
+            resolve_modifiers: resolve the modifier reports of all the labels, see ModifierReportParser.
+        Returns:
+            The binary CSR matrices of all the labels and of the labels set by uncertain reports,
+            both shaped (records, categories).
+        """
+        reports = np.asarray(reports, dtype=object)
+        rows, codes, cleaned_reports, shape = self.__factorize__(reports)
+        unique_indices = [self.report_to_indices.get(report, ()) for report in cleaned_reports]
+        uncertain = is_uncertain_report(cleaned_reports)
+        uncertain_indices = [idxs if is_uncertain else () for idxs, is_uncertain in zip(unique_indices, uncertain)]
+        labels = multi_hot_from_codes(rows, codes, unique_indices, shape)
+        if resolve_modifiers:
+            labels = self.modifier_parser.resolve_codes(codes.reshape(reports.shape), cleaned_reports, labels)
+        return labels, multi_hot_from_codes(rows, codes, uncertain_indices, shape)
+
+    def classify(self, reports_df: pd.DataFrame, report_columns: List[str] = None,
+                 without_uncertain: bool = False) -> Tuple[sparse.csr_matrix, np.ndarray]:
+        """
+        Classify the reports of the machine measurements table.
+        Args:
+            reports_df: the machine measurements table.
+            report_columns: the report columns, defaults to the ones of REPORT_COLUMNS in reports_df.
+            without_uncertain: reset the labels set by uncertain reports (image_to_diagnosis_without_uncertain).
+        Returns:
+            The binary CSR label matrix shaped (studies, categories) and the study ids of its rows.
+        """
+        if not without_uncertain:
+            labels = self.encode_reports(self.__report_table__(reports_df, report_columns))
+            return labels, reports_df['study_id'].to_numpy()
+        labels, uncertain_labels, study_ids = self.classify_uncertainty(reports_df, report_columns)
+        return remove_uncertain_labels(labels, uncertain_labels), study_ids
+
+    def classify_uncertainty(self, reports_df: pd.DataFrame,
+                             report_columns: List[str] = None) -> Tuple[sparse.csr_matrix, sparse.csr_matrix,
+                                                                        np.ndarray]:
+        """
+        Classify the reports of the machine measurements table, see encode_reports_with_uncertainty.
+        Returns:
+            The label matrix, the uncertain label matrix (image_to_diagnosis_uncertain) and the study ids of
+            their rows.
+        """
+        labels, uncertain_labels = self.encode_reports_with_uncertainty(
+            self.__report_table__(reports_df, report_columns))
+        return labels, uncertain_labels, reports_df['study_id'].to_numpy()
+
+    @staticmethod
+    def __report_table__(reports_df: pd.DataFrame, report_columns: List[str] = None) -> np.ndarray:
+        if report_columns is None:
+            report_columns = [col for col in REPORT_COLUMNS if col in reports_df.columns]
+        return reports_df[report_columns].to_numpy(dtype=object)
+
+
+def labels_to_dataframe(labels: sparse.csr_matrix, categories: List[str], reports_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert a label matrix to the wide image_to_diagnosis table (subject_id, study_id, image_id, categories...).
+    """
+    image_to_reports_df = pd.DataFrame({
+        'subject_id': reports_df['subject_id'].to_numpy(),
+        'study_id': reports_df['study_id'].to_numpy(),
+        'image_id': (reports_df['subject_id'].astype(str) + '_' + reports_df['study_id'].astype(str)).to_numpy(),
+    })
+    diagnosis_df = pd.DataFrame(labels.toarray(), columns=categories)
+    return pd.concat([image_to_reports_df, diagnosis_df], axis=1)
@@ -0,0 +1,90 @@
+from functools import lru_cache
+from math import gcd
+
+import numpy as np
+from scipy import signal
+
+@lru_cache(maxsize=None)
+def get_resample_factors(source_rate, target_rate):
+    """
+    Get the up and down factors that convert source_rate to target_rate.
+    Args:
+        source_rate: the sampling rate of the signal.
+        target_rate: the wanted sampling rate.
+    Returns:
+        The (up, down) factors, reduced by their gcd.
+    """
+    source_rate, target_rate = int(round(source_rate)), int(round(target_rate))
+    divisor = gcd(source_rate, target_rate)
+    return target_rate // divisor, source_rate // divisor
+
+
+@lru_cache(maxsize=None)
+def get_polyphase_filter(up, down, window=('kaiser', 5.0)):
+    """
+    Design the anti-aliasing FIR filter resample_poly uses for the given factors.
+    Designing it is the costly part of resample_poly for uncommon rates (257 -> 500 Hz needs
+    a 10001 taps filter), so it is done once per pair of factors.
+    Args:
+        up: the upsampling factor.
+        down: the downsampling factor.
+        window: the window of the filter, as in resample_poly.
+    Returns:
+        The filter coefficients (read only, resample_poly copies them).
+    """
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    h = signal.firwin(2 * half_len + 1, 1. / max_rate, window=window)
+    h.setflags(write=False)
+    return h
+
+
+def resample_to_rate(ecg_data, source_rate, target_rate, dtype=None):
+    """
+    Resample signals from source_rate to target_rate along the last axis.
+    Args:
+        ecg_data: the signals, shaped (..., samples).
+        source_rate: the sampling rate of the signals.
+        target_rate: the wanted sampling rate.
+        dtype: the dtype of the output, defaults to float. Integer dtypes are rounded and clipped,
+            so ADC values stay ADC values. The smallest integer is reserved for missing samples (see
+            DTypePolicy) and is never produced.
+    Returns:
+        The resampled signals.
+    """
+    up, down = get_resample_factors(source_rate, target_rate)
+    if up == down:
+        resampled = np.asarray(ecg_data)
+    else:
+        resampled = signal.resample_poly(ecg_data, up, down, axis=-1, window=get_polyphase_filter(up, down))
+    if dtype is None:
+        return resampled
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer) and not np.issubdtype(resampled.dtype, np.integer):
+        info = np.iinfo(dtype)
+        resampled = np.clip(np.rint(resampled), info.min + 1, info.max)
+    return resampled.astype(dtype, copy=False)
+
+
+def resample_records(ecgs, source_rates, target_rate, dtype=None):
+    """
+    Resample records of mixed sampling rates and lengths to target_rate.
+    Records sharing a sampling rate and a shape are stacked and resampled in a single call.
+    Args:
+        ecgs: the records, each shaped (leads, samples).
+        source_rates: the sampling rate of each record, or a single rate for all of them.
+        target_rate: the wanted sampling rate.
+        dtype: the dtype of the output, see resample_to_rate.
+    Returns:
+        A list of the resampled records, in the order of ecgs.
+    """
+    source_rates = np.broadcast_to(np.asarray(source_rates), (len(ecgs),))
+    resampled = [None] * len(ecgs)
+    groups = {}
+    for idx, (ecg, source_rate) in enumerate(zip(ecgs, source_rates)):
+        groups.setdefault((source_rate, np.shape(ecg)), []).append(idx)
+    for (source_rate, _), idxs in groups.items():
+        batch = resample_to_rate(np.stack([ecgs[idx] for idx in idxs]), source_rate, target_rate, dtype=dtype)
+        for idx, ecg in zip(idxs, batch):
+            resampled[idx] = ecg
+    return resampled
@@ -0,0 +1,112 @@
+import hashlib
+import os
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+from torch.utils.data import Sampler
+
+
+def class_balanced_weights(labels: sparse.csr_matrix, power: float = 1.0) -> np.ndarray:
+    """
+    Compute the sampling weight of every record from the frequencies of the labels.
+    A record weighs as the inverse frequency of its rarest label (to the given power), so every label is
+    drawn about as often as the others. Records without labels weigh as the most common label.
+    Args:
+        labels: the binary label matrix shaped (records, labels).
+        power: 1 balances the labels, 0 keeps the natural frequencies, values in between soften the balancing.
+    Returns:
+        The weight of every record, float64 shaped (records,).
+    """
+    labels = sparse.csr_matrix(labels, dtype=np.float64)
+    label_counts = np.asarray(labels.sum(axis=0)).ravel()
+    inverse_frequency = np.zeros_like(label_counts)
+    np.divide(1.0, label_counts, out=inverse_frequency, where=label_counts > 0)
+    weights = labels.multiply(inverse_frequency[None, :] ** power).tocsr().max(axis=1).toarray().ravel()
+    unlabeled = weights <= 0
+    if unlabeled.all():
+        return np.ones(len(weights))
+    weights[unlabeled] = weights[~unlabeled].min()
+    return weights
+
+
+def build_alias_table(weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Build the alias table of a discrete distribution (Vose's method), to draw from it in O(1) per sample.
+    Args:
+        weights: the non-negative weight of every item.
+    Returns:
+        The probability of keeping every bucket's own item and the alias item of every bucket.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    num_items = len(weights)
+    scaled = weights * (num_items / weights.sum())
+    prob = np.ones(num_items, dtype=np.float64)
+    alias = np.arange(num_items, dtype=np.int64)
+    small = np.flatnonzero(scaled < 1.0).tolist()
+    large = np.flatnonzero(scaled >= 1.0).tolist()
+    scaled_list = scaled.tolist()
+    while small and large:
+        less, more = small.pop(), large[-1]
+        prob[less] = scaled_list[less]
+        alias[less] = more
+        scaled_list[more] -= 1.0 - scaled_list[less]
+        if scaled_list[more] < 1.0:
+            small.append(large.pop())
+    # the leftovers are 1 up to rounding errors
+    return prob, alias
+
+
+def draw_from_alias_table(prob: np.ndarray, alias: np.ndarray, num_samples: int,
+                          rng: np.random.Generator) -> np.ndarray:
+    """
+    Draw items from an alias table (see build_alias_table) with replacement.
+    """
+    buckets = rng.integers(len(prob), size=num_samples)
+    return np.where(rng.random(num_samples) < prob[buckets], buckets, alias[buckets])
+
+
+class ClassBalancedSampler(Sampler):
+    """
+    This class is used to draw class balanced batches from an ECGDataset.
+    The weights of the records (see class_balanced_weights) are turned into an alias table once, then every
+    epoch draws len(dataset) records (or num_samples) with replacement in O(1) per record.
+    With a cache_path the alias table is saved, it is rebuilt only when the labels, the split or the power
+    change.
+    Example:
+        splits = load_splits('splits.npz')
+        dataset = ECGDataset(signal_store=store, label_store=label_store, indices=splits['train'])
+        sampler = ClassBalancedSampler(label_store.get_matrix()[splits['train']])
+        data_loader = DataLoader(dataset, batch_size=64, sampler=sampler, collate_fn=dataset.collate_fn)
+    """
+    def __init__(self, labels: sparse.csr_matrix, num_samples: Optional[int] = None, power: float = 1.0,
+                 seed: Optional[int] = None, cache_path=None):
+        labels = sparse.csr_matrix(labels)
+        self.num_samples = labels.shape[0] if num_samples is None else num_samples
+        self.rng = np.random.default_rng(seed)
+        fingerprint = self.__fingerprint__(labels, power)
+        if cache_path is not None and os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                if str(cached['fingerprint']) == fingerprint:
+                    self.prob, self.alias = cached['prob'], cached['alias']
+                    return
+        self.prob, self.alias = build_alias_table(class_balanced_weights(labels, power))
+        if cache_path is not None:
+            # through a file, np.savez would append .npz to a path without it and the cache would never be found
+            with open(cache_path, 'wb') as cache_file:
+                np.savez(cache_file, prob=self.prob, alias=self.alias, fingerprint=np.asarray(fingerprint))
+
+    @staticmethod
+    def __fingerprint__(labels: sparse.csr_matrix, power: float) -> str:
+        # a sorted copy, sort_indices would reorder the caller's matrix in place
+        labels = labels.sorted_indices()
+        digest = hashlib.blake2b(repr((labels.shape, power)).encode(), digest_size=16)
+        digest.update(np.ascontiguousarray(labels.indptr, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(labels.indices, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(draw_from_alias_table(self.prob, self.alias, self.num_samples, self.rng).tolist())
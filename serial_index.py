@@ -0,0 +1,126 @@
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from label_store import memmap_npz
+
+
+def save_serial_index(path, subject_ids: Sequence[int], study_ids: Sequence[int], ecg_times: Sequence):
+    """
+    Save the studies sorted by subject and then by time, with the offsets of every subject, in a single .npz file.
+    Args:
+        path: the index file, written as is (without adding a .npz suffix).
+        subject_ids: the subject id of every study, e.g. the subject_id column of machine_measurements.csv.
+        study_ids: the study id of every study.
+        ecg_times: the time of every study, studies without a time are dropped.
+    """
+    studies = pd.DataFrame({'subject_id': np.asarray(subject_ids, dtype=np.int64),
+                            'study_id': np.asarray(study_ids, dtype=np.int64),
+                            'ecg_time': pd.to_datetime(np.asarray(ecg_times))}).dropna(subset=['ecg_time'])
+    studies = studies.sort_values(['subject_id', 'ecg_time', 'study_id'], kind='stable')
+    study_subject_ids = studies['subject_id'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, study_subject_ids[1:] != study_subject_ids[:-1]]) if len(studies) else []
+    study_ids = studies['study_id'].to_numpy()
+    # the positions of the studies sorted by study id, to find a study by binary search
+    study_order = np.argsort(study_ids, kind='stable')
+    # through a file, np.savez would append .npz to a path without it
+    with open(path, 'wb') as index_file:
+        np.savez(index_file, subject_ids=study_subject_ids[starts],
+                 offsets=np.r_[starts, len(studies)].astype(np.int64), study_ids=study_ids,
+                 ecg_times=studies['ecg_time'].to_numpy().astype('datetime64[ns]'),
+                 study_subject_ids=study_subject_ids, sorted_study_ids=study_ids[study_order],
+                 study_positions=study_order.astype(np.int64))
+
+
+def build_serial_index(path, ecg_df: pd.DataFrame) -> 'SerialIndex':
+    """
+    Build the serial index of the ECGs of machine_measurements.csv (e.g. from MimicTables.read) and open it.
+    """
+    save_serial_index(path, ecg_df['subject_id'], ecg_df['study_id'], ecg_df['ecg_time'])
+    return SerialIndex(path)
+
+
+class SerialIndex:
+    """
+    This class is used to find the serial ECGs of a subject, read from a serial index written by
+    save_serial_index.
+    The studies are sorted by subject and then by time, the studies of a subject are contiguous and the
+    offsets of every subject are kept. A subject or a study is found by binary search, so getting the
+    ordered studies of a subject, or the previous or next study of a study, is O(log n) and reads no table.
+    The arrays are memory-mapped.
+    Example:
+        serial_index = build_serial_index('serial_index.npz', tables.read('machine_measurements'))
+        prior_study_id = serial_index.get_prior_study(40689238)
+    """
+    def __init__(self, path):
+        self.path = path
+        arrays = memmap_npz(path)
+        self.subject_ids = arrays['subject_ids']
+        self.offsets = arrays['offsets']
+        self.study_ids = arrays['study_ids']
+        self.ecg_times = arrays['ecg_times']
+        self.study_subject_ids = arrays['study_subject_ids']
+        self.sorted_study_ids = arrays['sorted_study_ids']
+        self.study_positions = arrays['study_positions']
+
+    def __len__(self) -> int:
+        return len(self.study_ids)
+
+    def get_positions(self, study_ids) -> np.ndarray:
+        """
+        Get the positions of studies in the subject and time order, -1 for unknown studies.
+        """
+        study_ids = np.asarray(study_ids, dtype=np.int64)
+        if len(self) == 0:
+            return np.full(study_ids.shape, -1, dtype=np.int64)
+        idxs = np.minimum(np.searchsorted(self.sorted_study_ids, study_ids), len(self) - 1)
+        return np.where(self.sorted_study_ids[idxs] == study_ids, self.study_positions[idxs], -1)
+
+    def get_subject_studies(self, subject_id) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the studies of a subject in time order.
+        Returns:
+            The study ids and their ecg times, empty for an unknown subject.
+        """
+        idx = np.searchsorted(self.subject_ids, subject_id)
+        if idx == len(self.subject_ids) or self.subject_ids[idx] != subject_id:
+            return self.study_ids[:0], self.ecg_times[:0]
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.study_ids[start:end], self.ecg_times[start:end]
+
+    def get_prior_studies(self, study_ids, max_days: Optional[float] = None, step: int = -1) -> np.ndarray:
+        """
+        Get the previous study of the same subject of every study.
+        Args:
+            study_ids: the study ids.
+            max_days: when given, the studies more than max_days apart from the study are ignored.
+            step: -1 for the previous study, 1 for the next one.
+        Returns:
+            The study id of the previous (or next) study of every study, -1 when there is none.
+        """
+        positions = self.get_positions(study_ids)
+        if len(self) == 0:
+            return positions
+        other_positions = positions + step
+        valid = (positions >= 0) & (other_positions >= 0) & (other_positions < len(self))
+        other_positions = np.where(valid, other_positions, 0)
+        valid &= self.study_subject_ids[other_positions] == self.study_subject_ids[np.maximum(positions, 0)]
+        if max_days is not None:
+            delta = np.abs(self.ecg_times[other_positions] - self.ecg_times[np.maximum(positions, 0)])
+            valid &= delta <= np.timedelta64(int(max_days * 24 * 3600), 's')
+        return np.where(valid, self.study_ids[other_positions], -1)
+
+    def get_next_studies(self, study_ids, max_days: Optional[float] = None) -> np.ndarray:
+        """
+        Get the next study of the same subject of every study, -1 when there is none, see get_prior_studies.
+        """
+        return self.get_prior_studies(study_ids, max_days=max_days, step=1)
+
+    def get_prior_study(self, study_id) -> Optional[int]:
+        prior_study_id = int(self.get_prior_studies([study_id])[0])
+        return None if prior_study_id < 0 else prior_study_id
+
+    def get_next_study(self, study_id) -> Optional[int]:
+        next_study_id = int(self.get_next_studies([study_id])[0])
+        return None if next_study_id < 0 else next_study_id
@@ -0,0 +1,242 @@
+import io
+import os
+import tarfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+from torch.utils.data import IterableDataset
+
+from dtype_policy import DEFAULT_DTYPE_POLICY
+from ecg_dataset import get_worker_shards, shuffle_items, stack_signals
+
+SHARD_INDEX_FILE = 'shards.csv'
+SHARD_INDEX_COLUMNS = ['shard', 'num_records', 'num_bytes', 'first_record_id', 'last_record_id']
+# the member names of a record are '{record_id}.{suffix}'
+SIGNAL_SUFFIX = 'signal.npz'
+LABELS_SUFFIX = 'labels.npy'
+IMAGE_SUFFIX = 'png'
+
+
+def _to_npy_bytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    return buffer.getvalue()
+
+
+def _split_member_name(name):
+    record_id, suffix = name.split('.', 1)
+    return record_id, suffix
+
+
+class ShardWriter:
+    """
+    This class is used to write records to tar shards of fixed size, the members of a record are written
+    together so a shard is read with purely sequential I/O.
+    A shard is closed once it holds max_shard_records records or max_shard_bytes bytes. The shard index
+    (shards.csv, see SHARD_INDEX_COLUMNS) lists the shards in the order they were written.
+    Example:
+        with ShardWriter('shards') as writer:
+            writer.write('10000032_40689238', {'signal.npz': signal_bytes, 'labels.npy': labels_bytes})
+    """
+    def __init__(self, output_dir, max_shard_records=1000, max_shard_bytes=2 ** 30, shard_prefix='shard'):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.max_shard_records = max_shard_records
+        self.max_shard_bytes = max_shard_bytes
+        self.shard_prefix = shard_prefix
+        self.shard_rows = []
+        self.tar = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __open_shard__(self):
+        shard_name = f'{self.shard_prefix}-{len(self.shard_rows):06d}.tar'
+        self.tar = tarfile.open(self.output_dir / shard_name, 'w')
+        self.shard_rows.append({'shard': shard_name, 'num_records': 0, 'num_bytes': 0, 'first_record_id': None,
+                                'last_record_id': None})
+
+    def __close_shard__(self):
+        self.tar.close()
+        self.tar = None
+        self.shard_rows[-1]['num_bytes'] = os.path.getsize(self.output_dir / self.shard_rows[-1]['shard'])
+
+    def write(self, record_id, members):
+        """
+        Write a record.
+        Args:
+            record_id: the record id, it must not contain dots.
+            members: the files of the record, from their suffix (e.g. 'signal.npz') to their bytes.
+        """
+        if self.tar is None:
+            self.__open_shard__()
+        shard_row = self.shard_rows[-1]
+        for suffix, data in members.items():
+            tar_info = tarfile.TarInfo(f'{record_id}.{suffix}')
+            tar_info.size = len(data)
+            self.tar.addfile(tar_info, io.BytesIO(data))
+        shard_row['num_records'] += 1
+        shard_row['first_record_id'] = shard_row['first_record_id'] or record_id
+        shard_row['last_record_id'] = record_id
+        if shard_row['num_records'] >= self.max_shard_records or self.tar.offset >= self.max_shard_bytes:
+            self.__close_shard__()
+
+    def close(self):
+        """
+        Close the last shard and write the shard index.
+        """
+        if self.tar is not None:
+            self.__close_shard__()
+        pd.DataFrame(self.shard_rows, columns=SHARD_INDEX_COLUMNS).to_csv(self.output_dir / SHARD_INDEX_FILE,
+                                                                          index=False)
+
+
+def export_shards(output_dir, signal_store, label_store=None, image_dirs=None, indices=None,
+                  max_shard_records=1000, max_shard_bytes=2 ** 30):
+    """
+    Export the records of a signal store to tar shards (see ShardWriter) with their labels and rendered images.
+    Every record is written as:
+        {record_id}.signal.npz - the stored signal, adc_gain and baseline, compressed.
+        {record_id}.labels.npy - the multi-hot labels, when a label store is given.
+        {record_id}.{format}.png - the rendered image of every format of image_dirs, when it exists.
+    Args:
+        output_dir: the directory of the shards.
+        signal_store: the SignalStore to export.
+        label_store: the LabelStore of the records.
+        image_dirs: a dict from a format name (e.g. 'format_0') to the directory of its images, named
+            {record_id}.png as written by render_signals_as_images.main. The png files are copied as they are.
+        indices: the signal store rows to export (e.g. a fold of splits.load_splits), defaults to all the rows.
+        max_shard_records: the maximal number of records of a shard.
+        max_shard_bytes: the size a shard is closed at.
+    Returns:
+        The shard index.
+    """
+    rows = np.arange(len(signal_store)) if indices is None else np.asarray(indices, dtype=np.int64)
+    record_ids = signal_store.get_record_ids().astype(str)
+    label_rows = None if label_store is None else label_store.get_rows(record_ids[rows])
+    with ShardWriter(output_dir, max_shard_records=max_shard_records, max_shard_bytes=max_shard_bytes) as writer:
+        for row_idx, row in enumerate(rows):
+            signal_buffer = io.BytesIO()
+            np.savez_compressed(signal_buffer, signal=signal_store.get_stored_signal(row),
+                                adc_gain=signal_store.adc_gain[row], baseline=signal_store.baseline[row])
+            members = {SIGNAL_SUFFIX: signal_buffer.getvalue()}
+            if label_store is not None:
+                label_row = label_rows[row_idx]
+                labels = (label_store.get_labels(label_row) if label_row >= 0
+                          else np.zeros(label_store.shape[1], dtype=np.uint8))
+                members[LABELS_SUFFIX] = _to_npy_bytes(labels)
+            for format_name, image_dir in (image_dirs or {}).items():
+                image_path = Path(image_dir) / f'{record_ids[row]}.png'
+                if image_path.exists():
+                    members[f'{format_name}.{IMAGE_SUFFIX}'] = image_path.read_bytes()
+            writer.write(record_ids[row], members)
+    return read_shard_index(output_dir)
+
+
+def read_shard_index(shard_dir):
+    return pd.read_csv(Path(shard_dir) / SHARD_INDEX_FILE, dtype={'first_record_id': str, 'last_record_id': str})
+
+
+def iter_shard_records(fileobj):
+    """
+    Read the records of a tar shard sequentially, without seeking.
+    Args:
+        fileobj: the shard, any readable binary stream (a local file, a pipe, an object store stream).
+    Returns:
+        An iterator over (record_id, members) pairs, members maps every suffix to its bytes.
+    """
+    record_id, members = None, {}
+    with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        for tar_info in tar:
+            if not tar_info.isfile():
+                continue
+            member_record_id, suffix = _split_member_name(tar_info.name)
+            if member_record_id != record_id and members:
+                yield record_id, members
+                members = {}
+            record_id = member_record_id
+            members[suffix] = tar.extractfile(tar_info).read()
+    if members:
+        yield record_id, members
+
+
+class ShardDataset(IterableDataset):
+    """
+    This class is used to stream the records of tar shards written by export_shards, for training.
+    Every DataLoader worker reads its own shards from start to end, the only I/O is sequential reads of
+    whole shards, so the shards can be copied to a local NVMe disk or served by an object store (open_shard
+    opens a shard path as a binary stream, e.g. fsspec.open for s3 paths).
+    The shard order is shuffled every epoch and the records are shuffled through a buffer of buffer_size records.
+    Items are (signal_data, images, record_id, labels) tuples: the signal in mV in the compute dtype, a dict of
+    the images by format name (as arrays, or png bytes when decode_images is False), the record id and the
+    multi-hot labels (None when the shards have no labels).
+    Example:
+        dataset = ShardDataset('shards')
+        data_loader = DataLoader(dataset, batch_size=64, num_workers=8, collate_fn=dataset.collate_fn)
+        for epoch in range(num_epochs):
+            dataset.set_epoch(epoch)
+            for signal_data, images, record_ids, labels in data_loader:
+                ...
+    """
+    def __init__(self, shard_dir, dtype_policy=DEFAULT_DTYPE_POLICY, buffer_size=2048, shuffle=True, seed=0,
+                 decode_images=True, open_shard=None, batch_transform=None):
+        self.shard_dir = str(shard_dir)
+        self.shards = read_shard_index(shard_dir)['shard'].tolist()
+        self.dtype_policy = dtype_policy
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.decode_images = decode_images
+        self.open_shard = open_shard
+        self.batch_transform = batch_transform
+
+    def set_epoch(self, epoch):
+        """
+        Set the epoch, the shuffling of every epoch is different and reproducible.
+        """
+        self.epoch = epoch
+
+    def __decode__(self, record_id, members):
+        with np.load(io.BytesIO(members[SIGNAL_SUFFIX])) as signal_file:
+            signal_data = self.dtype_policy.to_compute(signal_file['signal'], signal_file['adc_gain'],
+                                                       signal_file['baseline'])
+        labels = np.load(io.BytesIO(members[LABELS_SUFFIX])) if LABELS_SUFFIX in members else None
+        images = {}
+        for suffix, data in members.items():
+            if suffix.endswith(f'.{IMAGE_SUFFIX}'):
+                images[suffix[:-len(IMAGE_SUFFIX) - 1]] = (np.asarray(Image.open(io.BytesIO(data)))
+                                                           if self.decode_images else data)
+        return signal_data, images, record_id, labels
+
+    def __read_shard__(self, shard):
+        shard_path = f'{self.shard_dir}/{shard}'
+        with (open(shard_path, 'rb') if self.open_shard is None else self.open_shard(shard_path)) as fileobj:
+            for record_id, members in iter_shard_records(fileobj):
+                yield self.__decode__(record_id, members)
+
+    def __iter__(self):
+        worker_shards, rng = get_worker_shards(len(self.shards), self.shuffle, self.seed, self.epoch)
+        items = (item for shard_idx in worker_shards for item in self.__read_shard__(self.shards[shard_idx]))
+        if not self.shuffle:
+            yield from items
+            return
+        yield from shuffle_items(items, self.buffer_size, rng)
+
+    def collate_fn(self, batch):
+        signal_data_list, images_list, record_ids, labels_list = list(zip(*batch))
+        signal_data_array = stack_signals(signal_data_list, self.dtype_policy, self.batch_transform)
+        images = images_list
+        # the images are stacked when every record has the same formats
+        if self.decode_images and images_list[0] and all(item_images.keys() == images_list[0].keys()
+                                                         for item_images in images_list):
+            images = {name: torch.from_numpy(np.stack([item_images[name] for item_images in images_list]))
+                      for name in images_list[0]}
+        labels = None if labels_list[0] is None else torch.from_numpy(np.stack(labels_list))
+        return torch.from_numpy(signal_data_array), images, record_ids, labels
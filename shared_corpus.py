@@ -0,0 +1,88 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from signal_store import SignalStore
+
+# the arrays of the block, in their order in it
+SHARED_ARRAYS = ('signals', 'adc_gain', 'baseline')
+ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class SharedSignalStore(SignalStore):
+    """
+    This class is used to load a signal store (or some of its records) once into POSIX shared memory, so all
+    the DataLoader workers read a single copy of the corpus instead of opening and caching the files each.
+    The stored signals and the calibration are copied, in chunks of chunk_size records, to one shared memory
+    block created by the main process. Pickling the store (as the DataLoader does for every worker) sends
+    only the name of the block and the manifest, the workers attach to the block without copying it.
+    With indices, only these rows of signal_store are loaded, row i of the shared store is row indices[i].
+    It is a SignalStore, so it can be passed as the signal_store of ECGDataset and IterableECGDataset.
+    Call close() in the main process when done, to free the shared memory.
+    Example:
+        shared_store = SharedSignalStore(SignalStore('store'), indices=splits['train'])
+        dataset = ECGDataset(signal_store=shared_store, label_store=label_store)
+        data_loader = DataLoader(dataset, batch_size=64, num_workers=multiprocessing.cpu_count(),
+                                 collate_fn=dataset.collate_fn)
+    """
+    def __init__(self, signal_store, indices=None, chunk_size=4096):
+        self.store_dir = signal_store.store_dir
+        self.dtype_policy = signal_store.dtype_policy
+        rows = np.arange(len(signal_store)) if indices is None else np.asarray(indices, dtype=np.int64)
+        self.manifest = signal_store.manifest.iloc[rows].reset_index(drop=True)
+        self.layout = {}
+        offset = 0
+        for name in SHARED_ARRAYS:
+            source = getattr(signal_store, name)
+            shape = (len(rows),) + source.shape[1:]
+            self.layout[name] = (offset, shape, source.dtype.str)
+            offset = _aligned(offset + int(np.prod(shape)) * source.dtype.itemsize)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        self.owner = True
+        self.__attach__()
+        for name in SHARED_ARRAYS:
+            source, target = getattr(signal_store, name), getattr(self, name)
+            for start in range(0, len(rows), chunk_size):
+                chunk_rows = rows[start:start + chunk_size]
+                # a slice reads the memory-mapped rows sequentially
+                if (np.diff(chunk_rows) == 1).all():
+                    target[start:start + len(chunk_rows)] = source[chunk_rows[0]:chunk_rows[-1] + 1]
+                else:
+                    target[start:start + len(chunk_rows)] = source[chunk_rows]
+
+    def __attach__(self):
+        for name, (offset, shape, dtype) in self.layout.items():
+            setattr(self, name, np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.shm.buf, offset=offset))
+
+    def __getstate__(self):
+        # the workers attach to the shared memory block by its name
+        state = {key: value for key, value in self.__dict__.items() if key not in ('shm',) + SHARED_ARRAYS}
+        state['shm_name'] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        shm_name = state.pop('shm_name')
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=shm_name)
+        self.owner = False
+        self.__attach__()
+
+    def get_nbytes(self):
+        """
+        Get the size of the shared memory block, shared by all the processes attached to it.
+        """
+        return self.shm.size
+
+    def close(self):
+        """
+        Detach from the shared memory, the process that created the store also frees it.
+        """
+        for name in SHARED_ARRAYS:
+            setattr(self, name, None)
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
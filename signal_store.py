@@ -0,0 +1,295 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from dedup import CONTENT_HASH_COLUMN, content_hash
+from dtype_policy import DEFAULT_DTYPE_POLICY
+from ecg_io import read_wfdb_record, load_challenge_data, get_challenge_sample_rate, get_challenge_calibration
+from resampling import resample_to_rate
+
+SIGNALS_FILE = 'signals.npy'
+ADC_GAIN_FILE = 'adc_gain.npy'
+BASELINE_FILE = 'baseline.npy'
+MANIFEST_FILE = 'manifest.csv'
+MANIFEST_COLUMNS = ['record_id', 'subject_id', 'study_id', 'dataset', 'record_path', 'source_fs', 'source_len',
+                    CONTENT_HASH_COLUMN]
+
+
+def pad_or_truncate(ecg_data, ecg_len, trunc="post", pad="post", value=0):
+    """
+    Pad or truncate signals to ecg_len samples, like keras' pad_sequences.
+    Args:
+        ecg_data: the signals, shaped (leads, samples).
+        ecg_len: the wanted number of samples.
+        trunc: 'pre' to drop samples from the beginning, 'post' to drop them from the end.
+        pad: 'pre' to pad at the beginning, 'post' to pad at the end.
+        value: the padding value, a scalar or shaped (leads,).
+    Returns:
+        The signals, shaped (leads, ecg_len).
+    """
+    num_samples = ecg_data.shape[-1]
+    if num_samples >= ecg_len:
+        return ecg_data[..., :ecg_len] if trunc == "post" else ecg_data[..., num_samples - ecg_len:]
+    padded = np.empty(ecg_data.shape[:-1] + (ecg_len,), dtype=ecg_data.dtype)
+    padded[...] = np.asarray(value, dtype=ecg_data.dtype)[..., None]
+    if pad == "post":
+        padded[..., :num_samples] = ecg_data
+    else:
+        padded[..., ecg_len - num_samples:] = ecg_data
+    return padded
+
+
+class SignalStoreWriter:
+    """
+    This class is used to write a packed signal store.
+    A store is a directory holding the signals of N records packed in a single array, row i
+    of every file describes the same record:
+        signals.npy - the stored signals, shaped (N, leads, ecg_len), in the storage dtype.
+        adc_gain.npy, baseline.npy - the calibration of every lead, shaped (N, leads).
+        manifest.csv - one row per record, see MANIFEST_COLUMNS.
+    The arrays are memory-mapped, so records are streamed to disk as they are written.
+    The content hash of every record (see dedup.content_hash) is written to the manifest, the loaders of
+    pack_mimic_signals and pack_challenge_signals compute it in the worker processes over the raw samples of
+    the record file, before resampling and padding, the same hash render_signals_as_images computes.
+    Example:
+        with SignalStoreWriter('store', num_records=len(paths)) as writer:
+            for ecg_data, adc_gain, baseline, record_id in records:
+                writer.append(ecg_data, adc_gain, baseline, record_id=record_id)
+    """
+    def __init__(self, store_dir, num_records, num_leads=12, ecg_len=5000, dtype_policy=DEFAULT_DTYPE_POLICY):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.ecg_len = ecg_len
+        self.dtype_policy = dtype_policy
+        self.signals = np.lib.format.open_memmap(self.store_dir / SIGNALS_FILE, mode='w+',
+                                                 dtype=dtype_policy.get_storage_dtype(),
+                                                 shape=(num_records, num_leads, ecg_len))
+        self.adc_gain = np.lib.format.open_memmap(self.store_dir / ADC_GAIN_FILE, mode='w+', dtype=np.float32,
+                                                  shape=(num_records, num_leads))
+        self.baseline = np.lib.format.open_memmap(self.store_dir / BASELINE_FILE, mode='w+', dtype=np.float32,
+                                                  shape=(num_records, num_leads))
+        self.manifest_rows = []
+
+    def __len__(self):
+        return len(self.manifest_rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, ecg_data, adc_gain, baseline, **manifest_fields):
+        """
+        Write the next record.
+        Args:
+            ecg_data: the stored signal (ADC values), shaped (leads, ecg_len).
+            adc_gain: the ADC gain of every lead.
+            baseline: the ADC baseline of every lead.
+            manifest_fields: the manifest columns of the record.
+        Returns:
+            The index of the record in the store.
+        """
+        idx = len(self.manifest_rows)
+        self.signals[idx] = ecg_data
+        self.adc_gain[idx] = adc_gain
+        self.baseline[idx] = baseline
+        if CONTENT_HASH_COLUMN not in manifest_fields:
+            manifest_fields[CONTENT_HASH_COLUMN] = content_hash(self.signals[idx])
+        self.manifest_rows.append(manifest_fields)
+        return idx
+
+    def close(self):
+        """
+        Flush the arrays and write the manifest. Rows that were not written are ignored by SignalStore.
+        """
+        self.signals.flush()
+        self.adc_gain.flush()
+        self.baseline.flush()
+        manifest = pd.DataFrame(self.manifest_rows)
+        manifest = manifest.reindex(columns=MANIFEST_COLUMNS + [col for col in manifest.columns
+                                                               if col not in MANIFEST_COLUMNS])
+        manifest.to_csv(self.store_dir / MANIFEST_FILE, index=False)
+
+
+class SignalStore:
+    """
+    This class is used to read a packed signal store written by SignalStoreWriter.
+    The arrays are memory-mapped, only the records that are accessed are read from disk.
+    """
+    def __init__(self, store_dir, dtype_policy=DEFAULT_DTYPE_POLICY, mmap_mode='r'):
+        self.store_dir = Path(store_dir)
+        self.dtype_policy = dtype_policy
+        self.manifest = pd.read_csv(self.store_dir / MANIFEST_FILE,
+                                    dtype={'record_id': str, CONTENT_HASH_COLUMN: str})
+        num_records = len(self.manifest)
+        self.signals = np.load(self.store_dir / SIGNALS_FILE, mmap_mode=mmap_mode)[:num_records]
+        self.adc_gain = np.load(self.store_dir / ADC_GAIN_FILE, mmap_mode=mmap_mode)[:num_records]
+        self.baseline = np.load(self.store_dir / BASELINE_FILE, mmap_mode=mmap_mode)[:num_records]
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def get_record_ids(self):
+        return self.manifest['record_id'].to_numpy()
+
+    def get_content_hashes(self, chunk_size=4096):
+        """
+        Get the content hash of every record, from the manifest, or computed for stores written without it.
+        """
+        if CONTENT_HASH_COLUMN in self.manifest:
+            return self.manifest[CONTENT_HASH_COLUMN].to_numpy()
+        return np.asarray([content_hash(stored_signal) for start in range(0, len(self), chunk_size)
+                           for stored_signal in np.asarray(self.signals[start:start + chunk_size])])
+
+    def get_stored_signal(self, idx):
+        """
+        Get the stored signal (ADC values) of a record.
+        """
+        return self.signals[idx]
+
+    def get_signal(self, idx):
+        """
+        Get the signal of a record in mV, in the compute dtype of the store's dtype policy.
+        Args:
+            idx: the index of the record, or an array of indexes.
+        Returns:
+            The signal, shaped (leads, samples) or (len(idx), leads, samples).
+        """
+        return self.dtype_policy.to_compute(self.signals[idx], self.adc_gain[idx], self.baseline[idx])
+
+
+def _resample_stored_signal(stored_signal, source_fs, sample_rate, baseline, dtype_policy):
+    """
+    Resample a stored signal without spreading its missing samples through the filter: they are set to the
+    baseline before the resampling, and the resampled samples nearest to them are set missing again.
+    """
+    nan_value = dtype_policy.get_nan_value()
+    missing = np.isnan(stored_signal) if nan_value is None else stored_signal == nan_value
+    if missing.any():
+        stored_signal = np.where(missing, np.asarray(baseline, dtype=np.float32)[:, None], stored_signal)
+    resampled = resample_to_rate(stored_signal, source_fs, sample_rate, dtype=dtype_policy.get_storage_dtype())
+    if missing.any():
+        nearest = np.rint(np.arange(resampled.shape[-1]) * (source_fs / sample_rate)).astype(np.int64)
+        resampled[missing[:, np.minimum(nearest, missing.shape[-1] - 1)]] = np.nan if nan_value is None else nan_value
+    return resampled
+
+
+def _check_num_leads(stored_signal, num_leads, path):
+    if stored_signal.shape[0] != num_leads:
+        raise ValueError(f"{path} has {stored_signal.shape[0]} leads instead of {num_leads}")
+
+
+def _load_mimic_record(header_path, ecg_len, trunc, pad, sample_rate, dtype_policy, num_leads=12):
+    header_path = Path(header_path)
+    record_path = header_path.with_suffix('')
+    stored_signal, metadata = read_wfdb_record(record_path, dtype_policy)
+    _check_num_leads(stored_signal, num_leads, header_path)
+    raw_content_hash = content_hash(stored_signal)
+    subject_id = [column.split(":")[1].strip() for column in metadata.comments][0]
+    adc_gain = np.asarray(metadata.adc_gain, dtype=np.float32)
+    baseline = np.asarray(metadata.baseline, dtype=np.float32)
+    if metadata.fs != sample_rate:
+        stored_signal = _resample_stored_signal(stored_signal, metadata.fs, sample_rate, baseline, dtype_policy)
+    stored_signal = pad_or_truncate(stored_signal, ecg_len, trunc=trunc, pad=pad, value=baseline)
+    stored_signal = stored_signal.astype(dtype_policy.get_storage_dtype(), copy=False)
+    manifest_fields = {'record_id': f'{subject_id}_{metadata.record_name}', 'subject_id': subject_id,
+                       'study_id': metadata.record_name, 'dataset': 'MIMIC', 'record_path': str(record_path),
+                       'source_fs': metadata.fs, 'source_len': metadata.sig_len,
+                       CONTENT_HASH_COLUMN: raw_content_hash}
+    return stored_signal, adc_gain, baseline, manifest_fields
+
+
+def _load_challenge_record(filepath, ecg_len, trunc, pad, sample_rate, dtype_policy, dataset=None, num_leads=12):
+    filepath = str(filepath)
+    stored_signal, header_data = load_challenge_data(filepath, dtype_policy)
+    _check_num_leads(stored_signal, num_leads, filepath)
+    raw_content_hash = content_hash(stored_signal)
+    source_fs, source_len = get_challenge_sample_rate(header_data), stored_signal.shape[-1]
+    adc_gain, baseline = get_challenge_calibration(header_data)
+    if source_fs != sample_rate:
+        stored_signal = _resample_stored_signal(stored_signal, source_fs, sample_rate, baseline, dtype_policy)
+    stored_signal = pad_or_truncate(stored_signal, ecg_len, trunc=trunc, pad=pad, value=baseline)
+    stored_signal = stored_signal.astype(dtype_policy.get_storage_dtype(), copy=False)
+    manifest_fields = {'record_id': os.path.basename(filepath).split('.')[0], 'dataset': dataset,
+                       'record_path': filepath[:-len('.mat')], 'source_fs': source_fs, 'source_len': source_len,
+                       CONTENT_HASH_COLUMN: raw_content_hash}
+    return stored_signal, adc_gain, baseline, manifest_fields
+
+
+def _try_load_record(path, load_record):
+    try:
+        return load_record(path)
+    except Exception as error:  # a bad record (corrupt, out of range, other leads) must not abort the whole pack
+        return error
+
+
+def _pack_records(load_record, paths, store_dir, num_leads, ecg_len, num_workers, dtype_policy, chunksize=64):
+    with SignalStoreWriter(store_dir, len(paths), num_leads=num_leads, ecg_len=ecg_len,
+                           dtype_policy=dtype_policy) as writer, \
+            ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(partial(_try_load_record, load_record=load_record), paths, chunksize=chunksize)
+        for path, result in zip(paths, tqdm(results, total=len(paths))):
+            if isinstance(result, Exception):
+                tqdm.write(f"Skipped {path}: {result!r}")
+                continue
+            stored_signal, adc_gain, baseline, manifest_fields = result
+            writer.append(stored_signal, adc_gain, baseline, **manifest_fields)
+    if len(writer) < len(paths):
+        print(f"Skipped {len(paths) - len(writer)} of {len(paths)} records")
+    return SignalStore(store_dir, dtype_policy)
+
+
+def pack_mimic_signals(directory, store_dir, ecg_len=5000, trunc="post", pad="post", sample_rate=500,
+                       num_workers=None, dtype_policy=DEFAULT_DTYPE_POLICY, num_leads=12):
+    """
+    Pack the MIMIC-IV-ECG WFDB records of a directory into a signal store, in parallel.
+    Records that cannot be read (corrupt, out of the storage range, other leads) are skipped and logged.
+    Args:
+        directory: the directory to search the records in (e.g. './files').
+        store_dir: the directory of the store.
+        ecg_len: the number of samples every record is padded or truncated to.
+        trunc: see pad_or_truncate.
+        pad: see pad_or_truncate.
+        sample_rate: the records are resampled to this rate.
+        num_workers: the number of worker processes, defaults to the number of cpus.
+        dtype_policy: the dtype policy of the store.
+        num_leads: the number of leads of the records, records with other leads are skipped.
+    Returns:
+        The packed SignalStore.
+    """
+    header_paths = sorted(str(path) for path in Path(directory).rglob("*.hea"))
+    load_record = partial(_load_mimic_record, ecg_len=ecg_len, trunc=trunc, pad=pad, sample_rate=sample_rate,
+                          dtype_policy=dtype_policy, num_leads=num_leads)
+    return _pack_records(load_record, header_paths, store_dir, num_leads, ecg_len, num_workers, dtype_policy)
+
+
+def pack_challenge_signals(directory, store_dir, ecg_len=5000, trunc="post", pad="post", sample_rate=500,
+                           num_workers=None, dtype_policy=DEFAULT_DTYPE_POLICY, dataset=None, num_leads=12):
+    """
+    Pack the PhysioNet challenge .mat records of a directory into a signal store, in parallel.
+    Records that cannot be read (corrupt, out of the storage range, other leads) are skipped and logged.
+    The parallel, streaming version of render_signals_as_images.import_ecg_data.
+    Args:
+        directory: the directory of the .mat and .hea files.
+        store_dir: the directory of the store.
+        ecg_len: the number of samples every record is padded or truncated to.
+        trunc: see pad_or_truncate.
+        pad: see pad_or_truncate.
+        sample_rate: the records are resampled to this rate.
+        num_workers: the number of worker processes, defaults to the number of cpus.
+        dtype_policy: the dtype policy of the store.
+        dataset: the dataset name written to the manifest (e.g. 'Georgia').
+        num_leads: the number of leads of the records, records with other leads are skipped.
+    Returns:
+        The packed SignalStore.
+    """
+    mat_paths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".mat"))
+    load_record = partial(_load_challenge_record, ecg_len=ecg_len, trunc=trunc, pad=pad, sample_rate=sample_rate,
+                          dtype_policy=dtype_policy, dataset=dataset, num_leads=num_leads)
+    return _pack_records(load_record, mat_paths, store_dir, num_leads, ecg_len, num_workers, dtype_policy)
@@ -0,0 +1,111 @@
+from typing import Dict, Sequence
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+DEFAULT_SPLIT_RATIOS = {'train': 0.8, 'val': 0.1, 'test': 0.1}
+
+
+def _fill_quotas(counts: np.ndarray, needs: np.ndarray) -> np.ndarray:
+    """
+    Assign items to folds in order, so every fold gets about its share of the items' counts.
+    Args:
+        counts: the (positive) count of every item.
+        needs: the remaining need of every fold.
+    Returns:
+        The fold of every item.
+    """
+    needs = np.maximum(needs, 0)
+    if needs.sum() <= 0:
+        needs = np.ones_like(needs)
+    # the neediest fold is filled first
+    order = np.argsort(-needs, kind='stable')
+    bounds = np.cumsum(needs[order]) / needs.sum() * counts.sum()
+    midpoints = np.cumsum(counts) - counts / 2
+    return order[np.minimum(np.searchsorted(bounds, midpoints), len(order) - 1)]
+
+
+def stratified_group_split(labels: sparse.csr_matrix, subject_ids: Sequence,
+                           ratios: Dict[str, float] = None, seed: int = 0) -> Dict[str, np.ndarray]:
+    """
+    Split the studies to folds keeping all the studies of a subject in the same fold, while preserving the
+    frequency of every label in every fold (iterative stratification over subjects).
+    The labels are processed from the rarest to the most common. All the unassigned subjects having the
+    label are assigned at once, the folds needing the label the most are filled first. The label counts
+    of the folds are updated with a single sparse product per label.
+    Args:
+        labels: the binary label matrix shaped (studies, labels), e.g. from a label store.
+        subject_ids: the subject id of every study.
+        ratios: the size ratio of every fold, defaults to DEFAULT_SPLIT_RATIOS.
+        seed: the seed shuffling the subjects.
+    Returns:
+        A dict from every fold name to the sorted study (row) indexes of the fold.
+    """
+    ratios = DEFAULT_SPLIT_RATIOS if ratios is None else ratios
+    fold_names = list(ratios)
+    fold_ratios = np.asarray([ratios[name] for name in fold_names], dtype=np.float64)
+    fold_ratios /= fold_ratios.sum()
+    rng = np.random.default_rng(seed)
+
+    subject_codes, unique_subjects = pd.factorize(np.asarray(subject_ids))
+    num_subjects, num_studies = len(unique_subjects), len(subject_codes)
+    studies_of_subject = sparse.csr_matrix((np.ones(num_studies, dtype=np.int64),
+                                            (subject_codes, np.arange(num_studies))),
+                                           shape=(num_subjects, num_studies))
+    subject_labels = (studies_of_subject @ sparse.csr_matrix(labels, dtype=np.int64)).tocsr()
+    subject_labels_by_label = subject_labels.tocsc()
+    subject_sizes = np.asarray(studies_of_subject.sum(axis=1)).ravel()
+
+    remaining_counts = np.asarray(subject_labels.sum(axis=0), dtype=np.float64).ravel()
+    fold_needs = fold_ratios[:, None] * remaining_counts
+    size_needs = fold_ratios * num_studies
+    subject_folds = np.full(num_subjects, -1, dtype=np.int64)
+    # a random order breaks ties between subjects
+    shuffled_rank = np.empty(num_subjects, dtype=np.int64)
+    shuffled_rank[rng.permutation(num_subjects)] = np.arange(num_subjects)
+
+    def assign(subjects: np.ndarray, counts: np.ndarray, needs: np.ndarray):
+        order = np.argsort(shuffled_rank[subjects])
+        subjects, counts = subjects[order], counts[order]
+        folds = _fill_quotas(counts.astype(np.float64), needs)
+        subject_folds[subjects] = folds
+        assigned = sparse.csr_matrix((np.ones(len(subjects)), (folds, np.arange(len(subjects)))),
+                                     shape=(len(fold_names), len(subjects)))
+        assigned_labels = (assigned @ subject_labels[subjects]).toarray()
+        fold_needs[...] -= assigned_labels
+        remaining_counts[...] -= assigned_labels.sum(axis=0)
+        size_needs[...] -= np.bincount(folds, weights=subject_sizes[subjects], minlength=len(fold_names))
+
+    remaining_labels = remaining_counts > 0
+    while remaining_labels.any():
+        label = np.flatnonzero(remaining_labels)[np.argmin(remaining_counts[remaining_labels])]
+        start, end = subject_labels_by_label.indptr[label], subject_labels_by_label.indptr[label + 1]
+        subjects, counts = subject_labels_by_label.indices[start:end], subject_labels_by_label.data[start:end]
+        keep = subject_folds[subjects] < 0
+        assign(subjects[keep], counts[keep], fold_needs[:, label])
+        remaining_labels &= remaining_counts > 0
+        remaining_labels[label] = False
+
+    # the subjects without labels balance the fold sizes
+    subjects = np.flatnonzero(subject_folds < 0)
+    if len(subjects):
+        assign(subjects, subject_sizes[subjects], size_needs.copy())
+
+    study_folds = subject_folds[subject_codes]
+    return {name: np.flatnonzero(study_folds == fold) for fold, name in enumerate(fold_names)}
+
+
+def save_splits(path, splits: Dict[str, np.ndarray]):
+    """
+    Save the study indexes of every fold to a .npz file.
+    """
+    np.savez(path, **splits)
+
+
+def load_splits(path) -> Dict[str, np.ndarray]:
+    """
+    Load the study indexes of every fold saved by save_splits, to pass to ECGDataset(indices=...).
+    """
+    with np.load(path) as splits:
+        return {name: splits[name] for name in splits.files}
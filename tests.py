@@ -1,3 +1,4 @@
+import tempfile
 from pathlib import Path
 import pandas as pd
 import wfdb
@@ -6,7 +7,54 @@ import numpy as np
 import torch
 from torch.utils.data import Dataset, DataLoader
 import unittest
-from ecg_dataset import ECGDataset
+from ecg_dataset import ECGDataset, IterableECGDataset, collate_batch
+from median_beats import median_beats, compact_valid_ecgs, open_median_beats_memmap, save_kept_idx, load_kept_idx
+from dtype_policy import DTypePolicy
+from report_classifier import ReportClassifier, build_diagnosis_map
+from categories import Categories, dataset_lookup_dicts, CategoriesRegistry
+from multi_hot import multi_hot_from_codes
+from fuzzy_matcher import FuzzyAliasMatcher
+from label_store import LabelStore, save_label_store, align_labels
+from patient_features import attach_patient_features
+from mimic_tables import MimicTables
+from splits import stratified_group_split
+from samplers import ClassBalancedSampler, build_alias_table, class_balanced_weights
+from signal_store import (SignalStoreWriter, SignalStore, pad_or_truncate, pack_mimic_signals,
+                          pack_challenge_signals)
+from record_cache import RecordCache, SharedRecordCache
+from shared_corpus import SharedSignalStore
+from augmentation import BatchAugmentation, GaussianNoise, LeadDropout, AmplitudeScaling
+from record_query import RecordQuery
+from dedup import content_hash, get_canonical_rows, get_dedup_report
+from shard_export import export_shards, ShardDataset
+from serial_index import build_serial_index
+from ecg_dataset import SerialPairDataset
+from ecg_io import read_wfdb_record, get_signal_metadata, load_challenge_data, get_challenge_calibration
+from ECGGenerator import ECGGenerator
+from resampling import get_resample_factors, resample_to_rate, resample_records
+
+
+def _write_store(store_dir, values, adc_gain=1.0, **manifest_columns):
+    """
+    Write a signal store of 12 lead, 50 samples records, every sample of record i is values[i].
+    Args:
+        store_dir: the directory of the store.
+        values: the sample value of every record.
+        adc_gain: the ADC gain of every lead.
+        manifest_columns: the value of every record, for every manifest column. The record ids default to
+            '1_{i}'.
+    Returns:
+        The SignalStore.
+    """
+    manifest_columns.setdefault('record_id', [f'1_{idx}' for idx in range(len(values))])
+    manifest_columns = {name: list(column) for name, column in manifest_columns.items()}
+    with SignalStoreWriter(store_dir, len(values), ecg_len=50) as writer:
+        for idx, value in enumerate(values):
+            writer.append(np.full((12, 50), value, dtype=np.int16), np.full(12, adc_gain), np.zeros(12),
+                          **{name: column[idx] for name, column in manifest_columns.items()})
+    return SignalStore(store_dir)
+
+
 #  These diagnostic ECGs use 12 leads and are 10 seconds in length. They are sampled at 500 Hz.
 
 
@@ -101,6 +149,747 @@ class SignalDataTestCase(unittest.TestCase):
             signal_id = get_signal_id(metadata)
             self.assertEqual(signal_leads, expected_signal_fs, f"Incorrect signal Leads found in signal - Subject id is: {subject_id}, Signal id is {signal_id}.") 
 
+class MedianBeatsTestCase(unittest.TestCase):
+    def test_median_beats_shape_and_nan_leads(self):
+        rpeaks = np.arange(100, 5000, 400)
+        ecg = np.zeros((12, 5000))
+        for rpeak in rpeaks:
+            ecg[:, rpeak - 5:rpeak + 5] = 1
+        ecg[3] = np.nan
+        med_beats = median_beats(ecg, rpeaks, sampling_rate=500)
+        self.assertEqual(med_beats.shape, (12, 250))
+        self.assertTrue(np.isnan(med_beats[3]).all())
+        self.assertFalse(np.isnan(np.delete(med_beats, 3, axis=0)).any())
+
+    def test_median_beats_without_enough_rpeaks(self):
+        med_beats = median_beats(np.zeros((12, 5000)), [2500], sampling_rate=500)
+        self.assertTrue(np.isnan(med_beats).all())
+
+    def test_compact_valid_ecgs(self):
+        ecg_arr = np.arange(10, dtype=np.float32)[:, None, None] * np.ones((10, 12, 250), dtype=np.float32)
+        valid = np.ones((10, 12), dtype=bool)
+        valid[[1, 4, 5]] = False
+        valid[7, :11] = False
+        kept_ecgs, kept_valid, kept_idx = compact_valid_ecgs(ecg_arr, valid, chunk_size=2)
+        np.testing.assert_array_equal(kept_idx, [0, 2, 3, 6, 7, 8, 9])
+        np.testing.assert_array_equal(kept_ecgs[:, 0, 0], kept_idx)
+        self.assertEqual(kept_valid[4].sum(), 1)
+
+    def test_compacted_output(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = f'{tmp_dir}/median_beats'
+            beats, valid = open_median_beats_memmap(output_path, 4, num_leads=2, beat_length=3)
+            beats[:] = np.arange(4)[:, None, None]
+            valid[:] = [[True, True], [False, False], [True, False], [False, False]]
+            beats, valid, kept_idx = compact_valid_ecgs(beats, valid)
+            beats.flush()
+            valid.flush()
+            save_kept_idx(output_path, kept_idx)
+            del beats, valid
+            # the reopened output has the kept ecgs only, not the left overs of the compaction
+            beats, valid = open_median_beats_memmap(output_path, None, mode='r')
+            np.testing.assert_array_equal(load_kept_idx(output_path), [0, 2])
+            np.testing.assert_array_equal(beats[:, 0, 0], [0, 2])
+            self.assertEqual(valid.shape, (2, 2))
+            del beats, valid
+            open_median_beats_memmap(output_path, 4, num_leads=2, beat_length=3)
+            self.assertIsNone(load_kept_idx(output_path))
+
+
+class DTypePolicyTestCase(unittest.TestCase):
+    def test_storage_round_trip(self):
+        dtype_policy = DTypePolicy()
+        adc_gain = np.full(12, 200.0)
+        physical = np.random.default_rng(0).normal(size=(12, 5000))
+        physical[3, 10] = np.nan
+        stored = dtype_policy.to_storage(physical, adc_gain)
+        computed = dtype_policy.to_compute(stored, adc_gain)
+        self.assertEqual(stored.dtype, np.int16)
+        self.assertEqual(computed.dtype, np.float32)
+        self.assertTrue(np.isnan(computed[3, 10]))
+        # the error is bounded by half of the ADC resolution
+        self.assertLessEqual(np.nanmax(np.abs(computed - physical)), 0.5 / 200 + 1e-6)
+
+
+class ReportClassifierTestCase(unittest.TestCase):
+    def test_classify(self):
+        tags_df = pd.DataFrame({'Unique Report': ['sinus rhythm', 'atrial fibrillation', 'abnormal ecg'],
+                                'Our Classification': ['Normal Sinus Rhythm',
+                                                       'Atrial Fibrillation, Atrial Fibrillation & Flutter',
+                                                       'Ignore']})
+        classifier = ReportClassifier(build_diagnosis_map(tags_df))
+        reports_df = pd.DataFrame({'subject_id': [1, 2, 3], 'study_id': [10, 20, 30],
+                                   'report_0': ['Sinus rhythm.', 'Atrial fibrillation', np.nan],
+                                   'report_1': ['Abnormal ECG', '- Sinus rhythm', np.nan]})
+        labels, study_ids = classifier.classify(reports_df)
+        self.assertEqual(classifier.get_categories(),
+                         ['Normal Sinus Rhythm', 'Atrial Fibrillation', 'Atrial Fibrillation & Flutter'])
+        np.testing.assert_array_equal(labels.toarray(), [[1, 0, 0], [1, 1, 1], [0, 0, 0]])
+        np.testing.assert_array_equal(study_ids, [10, 20, 30])
+        # an empty table gives empty labels
+        labels, study_ids = classifier.classify(reports_df.iloc[:0])
+        self.assertEqual(labels.shape, (0, 3))
+        self.assertEqual(len(study_ids), 0)
+        labels, uncertain_labels = classifier.encode_reports_with_uncertainty(np.empty((0, 2), dtype=object))
+        self.assertEqual((labels.shape, uncertain_labels.shape), ((0, 3), (0, 3)))
+
+    def test_classify_without_uncertain(self):
+        tags_df = pd.DataFrame({'Unique Report': ['sinus rhythm', 'possible right atrial abnormality',
+                                                  'right atrial abnormality'],
+                                'Our Classification': ['Normal Sinus Rhythm', 'Right Atrial Abnormality',
+                                                       'Right Atrial Abnormality']})
+        classifier = ReportClassifier(build_diagnosis_map(tags_df))
+        reports_df = pd.DataFrame({'subject_id': [1, 2], 'study_id': [10, 20],
+                                   'report_0': ['Sinus rhythm', 'Right atrial abnormality'],
+                                   'report_1': ['Possible right atrial abnormality', np.nan]})
+        labels, uncertain_labels, _ = classifier.classify_uncertainty(reports_df)
+        np.testing.assert_array_equal(uncertain_labels.toarray(), [[0, 1], [0, 0]])
+        labels, _ = classifier.classify(reports_df, without_uncertain=True)
+        np.testing.assert_array_equal(labels.toarray(), [[1, 0], [0, 1]])
+
+    def test_modifier_reports(self):
+        diagnosis_map = {'Atrial Fibrillation': ['atrial fibrillation'],
+                         'Atrial Fibrillation with a Rapid Ventricular Rate': [],
+                         'Atrial Fibrillation with a Slow Ventricular Rate': [],
+                         'Normal Sinus Rhythm': ['sinus rhythm']}
+        classifier = ReportClassifier(diagnosis_map)
+        reports_df = pd.DataFrame({'study_id': [10, 20, 30, 40],
+                                   'report_0': ['Atrial fibrillation', 'Atrial fibrillation', 'Sinus rhythm',
+                                                'With rapid ventricular response'],
+                                   'report_1': ['with rapid ventricular response.', np.nan,
+                                                'with slow ventricular response', np.nan]})
+        labels, _ = classifier.classify(reports_df)
+        np.testing.assert_array_equal(labels.toarray(), [[0, 1, 0, 0], [1, 0, 0, 0], [0, 0, 0, 1], [0, 0, 0, 0]])
+
+
+class CategoriesEncodingTestCase(unittest.TestCase):
+    def test_encode_decode(self):
+        categories = Categories({'AV Block - First-degree': ['IAVB'], 'Atrial Fibrillation': 'AF',
+                                 'Atrial Fibrillation & Flutter': ['AF', 'AFL']})
+        alias_lists = [['IAVB', 'AF', 'unknown'], [], ['AFL']]
+        matrix = categories.encode(alias_lists)
+        np.testing.assert_array_equal(matrix, [[1, 1, 1], [0, 0, 0], [0, 0, 1]])
+        expected = [['AV Block - First-degree', 'Atrial Fibrillation', 'Atrial Fibrillation & Flutter'], [],
+                    ['Atrial Fibrillation & Flutter']]
+        self.assertEqual(categories.decode(matrix), expected)
+        self.assertEqual(categories.decode(categories.encode(alias_lists, packed=True), packed=True), expected)
+
+    def test_immutable(self):
+        categories = Categories({'Atrial Fibrillation': ['AF']})
+        with self.assertRaises(AttributeError):
+            categories.categories = []
+        with self.assertRaises(AttributeError):
+            categories.new_attribute = 1
+        self.assertEqual(categories.categories, ['Atrial Fibrillation'])
+
+    def test_multi_hot_from_codes(self):
+        # code 0 sets columns 0 and 2, code 1 sets nothing, code 2 sets column 1
+        matrix = multi_hot_from_codes(rows=[0, 0, 1, 2, 2, 3], codes=[0, 2, 1, 2, -1, 0],
+                                      unique_indices=[[0, 2], [], [1]], shape=(5, 3))
+        self.assertEqual(matrix.dtype, np.uint8)
+        np.testing.assert_array_equal(matrix.toarray(), [[1, 1, 1], [0, 0, 0], [0, 1, 0], [1, 0, 1], [0, 0, 0]])
+        # duplicated items stay binary
+        matrix = multi_hot_from_codes([0, 0], [0, 0], [[1]], shape=(1, 2))
+        np.testing.assert_array_equal(matrix.toarray(), [[0, 1]])
+        self.assertEqual(multi_hot_from_codes([], [], [], shape=(2, 3)).nnz, 0)
+
+
+class CategoriesTestCase(unittest.TestCase):
+    def test_registry(self):
+        self.assertIs(dataset_lookup_dicts['PTB'], dataset_lookup_dicts['Georgia'])
+        self.assertEqual(hash(dataset_lookup_dicts['NY']), hash(dataset_lookup_dicts['NY']))
+
+    def test_pickle(self):
+        import pickle
+        categories = Categories({'Atrial Fibrillation': ['AF'], 'Sinus Rhythm': ['SR']})
+        hash(categories)
+        # the salted string hash is not pickled, it is computed again in the loading process
+        state = pickle.loads(pickle.dumps(categories)).__dict__
+        self.assertNotIn('_hash', state)
+        loaded = pickle.loads(pickle.dumps(categories))
+        self.assertEqual(loaded, categories)
+        self.assertEqual(hash(loaded), hash(categories))
+
+    def test_cache(self):
+        import categories
+        import pickle
+        lookup_dict = {'Atrial Fibrillation': ['AF']}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = Path(tmp_dir) / 'categories_cache.pkl'
+            try:
+                categories.enable_cache(None)
+                self.assertEqual(len(CategoriesRegistry({'X': lookup_dict})['X']), 1)
+                self.assertIsNone(categories._cache_path)
+                categories.enable_cache(str(cache_path))
+                CategoriesRegistry({'X': lookup_dict})['X']
+                with open(cache_path, 'rb') as cache_file:
+                    version, cache = pickle.load(cache_file)
+                self.assertEqual(version, categories.CATEGORIES_CACHE_VERSION)
+                self.assertIn(Categories(lookup_dict), cache.values())
+                # caches of another version are dropped
+                with open(cache_path, 'wb') as cache_file:
+                    pickle.dump((version - 1, {'stale': 1}), cache_file)
+                categories.enable_cache(str(cache_path))
+                self.assertNotIn('stale', categories._load_cache())
+            finally:
+                categories.enable_cache(None)
+
+    def test_translation_matrix(self):
+        source = Categories({'Atrial Fibrillation': ['AF'], 'Sinus Rhythm': ['SR'], 'Other': ['X']})
+        target = Categories({'AF & Flutter': ['AF', 'AFL'], 'Normal': ['sinus rhythm'], 'Unused': ['Y']})
+        translation = source.translation_matrix(target)
+        np.testing.assert_array_equal(translation.toarray(), [[1, 0, 0], [0, 0, 0], [0, 1, 0]])
+        self.assertEqual(dataset_lookup_dicts.get_translation_matrix('PTB', 'MIMIC').shape,
+                         (len(dataset_lookup_dicts['PTB']), len(dataset_lookup_dicts['MIMIC'])))
+
+
+class LabelStoreTestCase(unittest.TestCase):
+    def test_save_and_load(self):
+        from scipy import sparse
+        labels = sparse.csr_matrix(np.array([[1, 0, 1], [0, 0, 0], [0, 1, 0]], dtype=np.uint8))
+        aligned = align_labels(labels, ['1_10', '2_20', '3_30'], ['3_30', '4_40', '1_10'])
+        np.testing.assert_array_equal(aligned.toarray(), [[0, 1, 0], [0, 0, 0], [1, 0, 1]])
+        self.assertEqual(aligned.dtype, labels.dtype)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = f'{tmp_dir}/labels.npz'
+            save_label_store(path, aligned, ['A', 'B', 'C'], ['3_30', '4_40', '1_10'])
+            label_store = LabelStore(path)
+            self.assertEqual(len(label_store), 3)
+            self.assertEqual(label_store.get_categories(), ['A', 'B', 'C'])
+            np.testing.assert_array_equal(label_store.get_labels(2), [1, 0, 1])
+            self.assertEqual(label_store.get_row('4_40'), 1)
+            np.testing.assert_array_equal(label_store.get_matrix().toarray(), aligned.toarray())
+            del label_store
+
+
+class PatientFeaturesTestCase(unittest.TestCase):
+    def test_nearest_results(self):
+        ecg_df = pd.DataFrame({'subject_id': [1, 1, 2], 'study_id': [10, 11, 20],
+                               'ecg_time': ['2020-01-01 10:00:00', '2020-03-01 08:30:00', '2020-01-01 00:00:00']})
+        results_df = pd.DataFrame({'subject_id': [1, 1, 1, 2],
+                                   'chartdate': ['2019-12-30', '2020-02-27', '2020-02-27', '2020-05-01'],
+                                   'result_name': ['Weight (Lbs)', 'Weight (Lbs)', 'Weight (Lbs)', 'Blood Pressure'],
+                                   'result_value': ['100', '200', '300', '120/80']})
+        patients_df = pd.DataFrame({'subject_id': [1, 2], 'anchor_age': [50, 60], 'gender': ['M', 'F']})
+        features = attach_patient_features(ecg_df, results_df, patients_df)
+        self.assertEqual(features['image_id'].tolist(), ['1_10', '1_11', '2_20'])
+        self.assertEqual(features['age'].tolist(), [50, 50, 60])
+        self.assertEqual(features['Weight'].tolist()[:2], [45.36, 90.72])
+        self.assertTrue(pd.isna(features['Weight'][2]))
+        self.assertEqual(features['Blood Pressure'][2], '120/80')
+
+
+class MimicTablesTestCase(unittest.TestCase):
+    def test_columnar_cache(self):
+        import os
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, 'all_data'))
+            pd.DataFrame({'subject_id': [1, 2, 3], 'gender': ['M', 'F', 'F'], 'anchor_age': [50, 60, 70],
+                          'extra': [0, 0, 0]}).to_csv(os.path.join(tmp_dir, 'all_data', 'patients.csv'), index=False)
+            tables = MimicTables(tmp_dir, chunksize=2)
+            self.assertFalse(tables.is_cached('patients'))
+            patients_df = tables.read('patients')
+            self.assertTrue(tables.is_cached('patients'))
+            self.assertEqual(list(patients_df.columns), ['subject_id', 'gender', 'anchor_age'])
+            self.assertEqual(patients_df['gender'].dtype, 'category')
+            self.assertEqual(patients_df['anchor_age'].tolist(), [50, 60, 70])
+            self.assertEqual([len(chunk) for chunk in tables.iter_chunks('patients')], [2, 1])
+            os.utime(tables.get_source_path('patients'), ns=(0, 0))
+            self.assertFalse(tables.is_cached('patients'))
+
+
+class SplitsTestCase(unittest.TestCase):
+    def test_grouped_stratified_split(self):
+        from scipy import sparse
+        rng = np.random.default_rng(0)
+        subject_ids = rng.integers(0, 2000, 10000)
+        labels = sparse.csr_matrix((rng.random((10000, 5)) < [0.3, 0.1, 0.05, 0.01, 0.002]).astype(np.uint8))
+        splits = stratified_group_split(labels, subject_ids, ratios={'train': 0.8, 'val': 0.1, 'test': 0.1})
+        study_folds = np.full(10000, -1)
+        for fold, idxs in enumerate(splits.values()):
+            study_folds[idxs] = fold
+        self.assertFalse((study_folds < 0).any())
+        self.assertTrue((pd.Series(study_folds).groupby(subject_ids).nunique() == 1).all())
+        self.assertAlmostEqual(len(splits['train']) / 10000, 0.8, delta=0.02)
+        label_counts = np.asarray(labels.sum(axis=0)).ravel()
+        train_ratios = np.asarray(labels[splits['train']].sum(axis=0)).ravel() / label_counts
+        np.testing.assert_allclose(train_ratios[:4], 0.8, atol=0.05)
+
+
+class SamplersTestCase(unittest.TestCase):
+    def test_alias_table(self):
+        weights = np.array([1.0, 2.0, 0.0, 5.0])
+        prob, alias = build_alias_table(weights)
+        # the probability of every item summed over the buckets keeping it and the buckets aliasing it
+        item_prob = prob / len(weights)
+        np.add.at(item_prob, alias, (1 - prob) / len(weights))
+        np.testing.assert_allclose(item_prob, weights / weights.sum())
+
+    def test_class_balanced_sampler(self):
+        from scipy import sparse
+        labels = sparse.csr_matrix(np.array([[1, 0]] * 98 + [[0, 1]] * 2, dtype=np.uint8))
+        np.testing.assert_allclose(class_balanced_weights(labels)[[0, 99]], [1 / 98, 1 / 2])
+        sampler = ClassBalancedSampler(labels, num_samples=10000, seed=0)
+        drawn = np.fromiter(iter(sampler), dtype=np.int64)
+        self.assertEqual(len(drawn), 10000)
+        self.assertAlmostEqual((drawn >= 98).mean(), 0.5, delta=0.03)
+
+    def test_cache(self):
+        import samplers
+        from scipy import sparse
+        labels = sparse.csr_matrix(np.array([[1, 0], [1, 0], [0, 1]], dtype=np.uint8))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = f'{tmp_dir}/alias_table'
+            sampler = ClassBalancedSampler(labels, cache_path=cache_path)
+            self.assertTrue(Path(cache_path).exists())
+            build = samplers.build_alias_table
+            samplers.build_alias_table = None
+            try:
+                cached_sampler = ClassBalancedSampler(labels, cache_path=cache_path)
+            finally:
+                samplers.build_alias_table = build
+            np.testing.assert_array_equal(cached_sampler.prob, sampler.prob)
+            np.testing.assert_array_equal(cached_sampler.alias, sampler.alias)
+
+    def test_fingerprint_keeps_labels(self):
+        from scipy import sparse
+        # the same labels with unsorted column indices
+        labels = sparse.csr_matrix((np.ones(4, dtype=np.uint8), np.array([2, 0, 1, 0]), np.array([0, 2, 3, 4])),
+                                   shape=(3, 3))
+        indices = labels.indices.copy()
+        fingerprint = ClassBalancedSampler.__fingerprint__(labels, 1.0)
+        np.testing.assert_array_equal(labels.indices, indices)
+        self.assertEqual(fingerprint, ClassBalancedSampler.__fingerprint__(labels.sorted_indices(), 1.0))
+
+
+class IterableECGDatasetTestCase(unittest.TestCase):
+    def test_collate_batch(self):
+        batch = [(np.full((12, 50), idx, dtype=np.float64), {'record_id': str(idx)}, str(idx),
+                  np.array([idx, 1], dtype=np.uint8)) for idx in range(3)]
+        signal_data, signal_metadata, metadata = collate_batch(batch, DTypePolicy(), batch_transform=lambda x: x * 2)
+        self.assertEqual(np.asarray(signal_data).dtype, np.float32)
+        np.testing.assert_array_equal(np.asarray(signal_data)[:, 0, 0], [0, 2, 4])
+        self.assertEqual(metadata, ('0', '1', '2'))
+        labels = collate_batch(batch, DTypePolicy(), with_labels=True)[3]
+        np.testing.assert_array_equal(np.asarray(labels), [[0, 1], [1, 1], [2, 1]])
+
+    def test_shard_stream(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            signal_store = _write_store(tmp_dir, range(100), subject_id=[1] * 100, study_id=range(100))
+            dataset = IterableECGDataset(signal_store=signal_store, indices=np.arange(0, 100, 2), shard_size=16,
+                                         buffer_size=8)
+            items = list(dataset)
+            record_ids = [item[2] for item in items]
+            self.assertEqual(sorted(record_ids), sorted(f'1_{idx}' for idx in range(0, 100, 2)))
+            self.assertNotEqual(record_ids, [f'1_{idx}' for idx in range(0, 100, 2)])
+            for signal_data, signal_metadata, record_id in items:
+                self.assertEqual(signal_data[0, 0], signal_metadata['study_id'])
+            signal_data, _, _ = dataset.collate_fn(items[:4])
+            self.assertEqual(tuple(signal_data.shape), (4, 12, 50))
+            del signal_store, dataset, items, signal_data
+
+
+class SharedSignalStoreTestCase(unittest.TestCase):
+    def test_attach(self):
+        import pickle
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            signal_store = _write_store(tmp_dir, range(10), adc_gain=2.0, subject_id=[1] * 10, study_id=range(10))
+            shared_store = SharedSignalStore(signal_store, indices=[7, 2, 3, 4], chunk_size=2)
+            try:
+                attached_store = pickle.loads(pickle.dumps(shared_store))
+                self.assertEqual(list(attached_store.get_record_ids()), ['1_7', '1_2', '1_3', '1_4'])
+                np.testing.assert_allclose(attached_store.get_signal(0), signal_store.get_signal(7))
+                shared_store.signals[1] = 0
+                self.assertEqual(attached_store.get_stored_signal(1)[0, 0], 0)
+                dataset = ECGDataset(signal_store=attached_store)
+                self.assertEqual(dataset[3][2], '1_4')
+                attached_store.close()
+            finally:
+                shared_store.close()
+            del signal_store
+
+
+class BatchAugmentationTestCase(unittest.TestCase):
+    def test_batch_augmentation(self):
+        signals = np.random.default_rng(0).standard_normal((8, 12, 500), dtype=np.float32)
+        signals[0, 0, 0] = np.nan
+        augmented = BatchAugmentation(seed=1)(signals.copy())
+        np.testing.assert_array_equal(augmented, BatchAugmentation(seed=1)(signals.copy()))
+        self.assertFalse(np.allclose(augmented[1:], signals[1:]))
+        noisy = BatchAugmentation([GaussianNoise(p=1), AmplitudeScaling(p=1)])(signals.copy())
+        self.assertTrue(np.isnan(noisy[0, 0, 0]))
+        unchanged = BatchAugmentation([GaussianNoise(p=0), AmplitudeScaling(p=0)])(signals.copy())
+        np.testing.assert_array_equal(unchanged, signals)
+        dropped = BatchAugmentation([LeadDropout(lead_p=1.0, p=1.0)])(signals.copy())
+        self.assertTrue(((dropped != 0).any(axis=2).sum(axis=1) == 1).all())
+
+    def test_collate(self):
+        dataset = ECGDataset(Path('./non_existing_directory'), batch_transform=BatchAugmentation([GaussianNoise(p=1)]))
+        batch = [(np.zeros((12, 100), dtype=np.float32), {}, None) for _ in range(4)]
+        signal_data, _, _ = dataset.collate_fn(batch)
+        self.assertEqual(tuple(signal_data.shape), (4, 12, 100))
+        self.assertTrue((np.asarray(signal_data) != 0).any())
+
+
+class RecordQueryTestCase(unittest.TestCase):
+    def test_select(self):
+        from scipy import sparse
+        manifest = pd.DataFrame({'record_id': [f'{subject}_{study}' for subject, study in
+                                               [(1, 10), (1, 11), (2, 20), (3, 30), (3, 31)]],
+                                 'subject_id': [1, 1, 2, 3, 3]})
+        labels = sparse.csr_matrix(np.array([[1, 0], [1, 1], [0, 1], [1, 0]], dtype=np.uint8))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            save_label_store(f'{tmp_dir}/labels.npz', labels, ['A', 'B'], ['3_31', '1_11', '2_20', '1_10'])
+            query = RecordQuery(manifest, label_store=LabelStore(f'{tmp_dir}/labels.npz'),
+                                splits={'train': np.array([0, 1, 3, 4]), 'test': np.array([2])},
+                                quality=[12, 5, 12, 9, 11],
+                                ecg_times=['2180-01-01', '2181-01-01', '2180-06-01', '2182-01-01', '2183-01-01'])
+        self.assertEqual(list(query.select(split='train', labels=['A'])), ['1_10', '1_11', '3_31'])
+        self.assertEqual(list(query.select(labels=['A', 'B'])), ['1_11'])
+        self.assertEqual(list(query.select(any_labels=['A', 'B'], min_quality=10)), ['1_10', '2_20', '3_31'])
+        self.assertEqual(list(query.select(subject_ids=[1, 3], end_time='2181-01-01')), ['1_10', '1_11'])
+        self.assertEqual(list(query.select(split='train', limit=2)), ['1_10', '1_11'])
+        self.assertEqual(len(query.select(split='train', limit=2, seed=0)), 2)
+
+    def test_missing_values(self):
+        manifest = pd.DataFrame({'record_id': ['a', 'b', 'c']})
+        query = RecordQuery(manifest, quality=[np.nan, 5, 1], ecg_times=[None, '2180-01-01', '2181-01-01'])
+        # the records without a quality or a time match no range, even an open one
+        self.assertEqual(list(query.select(min_quality=3)), ['b'])
+        self.assertEqual(list(query.select(max_quality=5)), ['b', 'c'])
+        self.assertEqual(list(query.select(start_time='2180-06-01')), ['c'])
+        self.assertEqual(list(query.select(end_time='2181-01-01')), ['b', 'c'])
+        self.assertEqual(list(query.select()), ['a', 'b', 'c'])
+
+    def test_dataset_record_ids(self):
+        dataset = ECGDataset(Path('./files'), record_ids=['10000032_40689238'])
+        self.assertEqual(len(dataset), 1)
+        self.assertEqual(dataset.header_paths[0], Path('./files/p1000/p10000032/s40689238/40689238.hea'))
+
+
+class DedupTestCase(unittest.TestCase):
+    def test_content_hash(self):
+        signal = np.arange(24, dtype=np.int16).reshape(12, 2)
+        self.assertEqual(content_hash(signal), content_hash(signal.copy()))
+        self.assertNotEqual(content_hash(signal), content_hash(signal.reshape(2, 12)))
+        self.assertNotEqual(content_hash(signal), content_hash(signal + 1))
+        np.testing.assert_array_equal(get_canonical_rows(['a', 'b', 'a', 'c', 'b']), [0, 1, 0, 3, 1])
+        self.assertEqual(get_dedup_report(['a', 'b', 'a', 'a'])['num_duplicates'], 2)
+
+    def test_deduplicate_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            signal_store = _write_store(tmp_dir, [0, 1, 0, 2, 1, 3])
+            self.assertEqual(signal_store.manifest['content_hash'].nunique(), 4)
+            dataset = ECGDataset(signal_store=signal_store, indices=[5, 4, 2, 1, 0], deduplicate=True)
+            self.assertEqual([dataset[idx][2] for idx in range(len(dataset))], ['1_5', '1_4', '1_2'])
+            self.assertEqual(dataset.dedup_report['num_duplicates'], 2)
+            del signal_store, dataset
+
+
+class ShardExportTestCase(unittest.TestCase):
+    def test_export_and_stream(self):
+        from PIL import Image
+        from scipy import sparse
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            _write_store(f'{tmp_dir}/store', range(5), adc_gain=2.0)
+            save_label_store(f'{tmp_dir}/labels.npz', sparse.csr_matrix(np.eye(5, 3, dtype=np.uint8)),
+                             ['A', 'B', 'C'], [f'1_{idx}' for idx in range(5)])
+            Path(f'{tmp_dir}/images').mkdir()
+            Image.fromarray(np.zeros((4, 6, 3), dtype=np.uint8)).save(f'{tmp_dir}/images/1_3.png')
+            signal_store = SignalStore(f'{tmp_dir}/store')
+            shard_index = export_shards(f'{tmp_dir}/shards', signal_store, LabelStore(f'{tmp_dir}/labels.npz'),
+                                        image_dirs={'format_0': f'{tmp_dir}/images'}, max_shard_records=2)
+            self.assertEqual(list(shard_index['num_records']), [2, 2, 1])
+            items = list(ShardDataset(f'{tmp_dir}/shards', shuffle=False))
+            self.assertEqual([item[2] for item in items], [f'1_{idx}' for idx in range(5)])
+            np.testing.assert_allclose(items[4][0], signal_store.get_signal(4))
+            np.testing.assert_array_equal(items[1][3], [0, 1, 0])
+            self.assertEqual(items[3][1]['format_0'].shape, (4, 6, 3))
+            shuffled = list(ShardDataset(f'{tmp_dir}/shards', buffer_size=2, decode_images=False))
+            self.assertEqual(sorted(item[2] for item in shuffled), [f'1_{idx}' for idx in range(5)])
+            signal_data, _, _, labels = ShardDataset(f'{tmp_dir}/shards').collate_fn(items[:2])
+            self.assertEqual(tuple(signal_data.shape), (2, 12, 50))
+            del signal_store
+
+
+class SerialIndexTestCase(unittest.TestCase):
+    def test_serial_studies(self):
+        ecg_df = pd.DataFrame({'subject_id': [2, 1, 1, 2, 1, 3],
+                               'study_id': [20, 12, 10, 21, 11, 30],
+                               'ecg_time': ['2180-01-02', '2181-01-01', '2180-01-01', '2180-01-01', '2180-06-01',
+                                            None]})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            serial_index = build_serial_index(f'{tmp_dir}/serial_index.npz', ecg_df)
+            self.assertEqual(list(serial_index.get_subject_studies(1)[0]), [10, 11, 12])
+            self.assertEqual(len(serial_index.get_subject_studies(3)[0]), 0)
+            np.testing.assert_array_equal(serial_index.get_prior_studies([10, 11, 12, 20, 21, 99]),
+                                          [-1, 10, 11, 21, -1, -1])
+            self.assertEqual(serial_index.get_next_study(21), 20)
+            self.assertIsNone(serial_index.get_prior_study(10))
+            np.testing.assert_array_equal(serial_index.get_prior_studies([11, 12], max_days=200), [10, -1])
+            # the index is written to the given path, even without a .npz suffix
+            other_index = build_serial_index(f'{tmp_dir}/serial_index', ecg_df)
+            self.assertEqual(len(other_index), len(serial_index))
+            del other_index
+
+            signal_store = _write_store(f'{tmp_dir}/store', [10, 11, 20, 21],
+                                        record_id=['1_10', '1_11', '2_20', '2_21'], subject_id=[1, 1, 2, 2],
+                                        study_id=[10, 11, 20, 21])
+            dataset = SerialPairDataset(ECGDataset(signal_store=signal_store, indices=[1, 2]), serial_index)
+            self.assertEqual(len(dataset), 2)
+            prior_item, current_item = dataset[1]
+            self.assertEqual((prior_item[2], current_item[2]), ('2_21', '2_20'))
+            prior_batch, current_batch = dataset.collate_fn([dataset[0], dataset[1]])
+            self.assertEqual(tuple(prior_batch[0].shape), (2, 12, 50))
+            del signal_store, dataset
+
+            # a study packed twice and a record without a study id
+            signal_store = _write_store(f'{tmp_dir}/duplicates', range(5), subject_id=[1, 1, 1, None, 1],
+                                        study_id=[11, 10, 10, None, 12])
+            dataset = SerialPairDataset(ECGDataset(signal_store=signal_store), serial_index)
+            np.testing.assert_array_equal(dataset.current_idxs, [0, 4])
+            np.testing.assert_array_equal(dataset.prior_rows, [1, 0])
+            del signal_store, dataset
+
+            # a challenge store has no study ids
+            signal_store = _write_store(f'{tmp_dir}/challenge', [0, 0], record_id=['A0001', 'A0002'],
+                                        dataset=['Georgia'] * 2)
+            with self.assertRaises(ValueError):
+                SerialPairDataset(ECGDataset(signal_store=signal_store), serial_index)
+            del serial_index, signal_store
+
+
+class ECGIOTestCase(unittest.TestCase):
+    def test_read_wfdb_record(self):
+        physical = np.random.default_rng(0).normal(size=(1000, 3))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            wfdb.wrsamp('40689238', fs=500, units=['mV'] * 3, sig_name=['I', 'II', 'V1'], p_signal=physical,
+                        fmt=['16'] * 3, adc_gain=[200.0] * 3, baseline=[0] * 3, comments=['test'],
+                        write_dir=tmp_dir)
+            signal_data, record = read_wfdb_record(Path(tmp_dir) / '40689238')
+        self.assertEqual(signal_data.dtype, np.int16)
+        self.assertEqual(signal_data.shape, (3, 1000))
+        computed = DTypePolicy().to_compute(signal_data, record.adc_gain, record.baseline)
+        self.assertLessEqual(np.max(np.abs(computed - physical.T)), 0.5 / 200 + 1e-6)
+        signal_metadata = get_signal_metadata(record)
+        self.assertEqual((signal_metadata['fs'], signal_metadata['sig_len'], signal_metadata['n_sig']), (500, 1000, 3))
+        self.assertEqual(signal_metadata['sig_name'], ['I', 'II', 'V1'])
+        self.assertEqual(signal_metadata['units'], ['mV'] * 3)
+        self.assertEqual(signal_metadata['comments'], ['test'])
+
+    def test_load_challenge_data(self):
+        from scipy.io import savemat
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(Path(tmp_dir) / 'A0001.hea', 'w') as f:
+                f.write('A0001 2 500 3\n'
+                        'A0001.mat 16+24 1000/mV 16 0 0 0 0 I\n'
+                        'A0001.mat 16+24 500(10)/mV 16 0 0 0 0 II\n')
+            savemat(Path(tmp_dir) / 'A0001.mat', {'val': np.array([[1, -2, 3], [4, 5, 6]], dtype=np.int32)})
+            data, header_data = load_challenge_data(str(Path(tmp_dir) / 'A0001.mat'))
+            self.assertEqual(data.dtype, np.int16)
+            np.testing.assert_array_equal(data, [[1, -2, 3], [4, 5, 6]])
+            adc_gain, baseline = get_challenge_calibration(header_data)
+            np.testing.assert_array_equal(adc_gain, [1000, 500])
+            np.testing.assert_array_equal(baseline, [0, 10])
+            # values out of the int16 range must not wrap
+            savemat(Path(tmp_dir) / 'A0001.mat', {'val': np.array([[1, 40000, 3], [4, 5, 6]], dtype=np.int32)})
+            with self.assertRaises(ValueError):
+                load_challenge_data(str(Path(tmp_dir) / 'A0001.mat'))
+
+
+class ECGGeneratorTestCase(unittest.TestCase):
+    def test_calibration(self):
+        stored = np.array([[200, -400, -32768], [10, 20, 30]], dtype=np.int16)
+        ecg_generator = ECGGenerator(stored, adc_gain=np.array([200.0, 10.0]), baseline=np.array([0, 10]))
+        self.assertEqual(ecg_generator.ecg_data.dtype, np.float32)
+        np.testing.assert_allclose(ecg_generator.ecg_data, [[1, -2, np.nan], [0, 1, 2]])
+        # ADC values are never plotted as mV
+        with self.assertRaises(ValueError):
+            ECGGenerator(stored)
+        physical = np.array([[0.5, -1.0]], dtype=np.float64)
+        ecg_generator = ECGGenerator(physical)
+        self.assertEqual(ecg_generator.ecg_data.dtype, np.float32)
+        np.testing.assert_allclose(ecg_generator.ecg_data, physical)
+
+
+class ResamplingTestCase(unittest.TestCase):
+    def test_resample_to_rate(self):
+        from scipy.signal import resample_poly
+        rng = np.random.default_rng(0)
+        for source_rate, (up, down) in [(250, (2, 1)), (500, (1, 1)), (1000, (1, 2))]:
+            self.assertEqual(get_resample_factors(source_rate, 500), (up, down))
+            ecg_data = rng.normal(size=(12, 10 * source_rate))
+            resampled = resample_to_rate(ecg_data, source_rate, 500)
+            self.assertEqual(resampled.shape, (12, 5000))
+            np.testing.assert_allclose(resampled, resample_poly(ecg_data, up, down, axis=-1), atol=1e-12)
+
+    def test_integer_dtype(self):
+        stored = np.array([[-32767, 32767] * 500], dtype=np.int16)
+        resampled = resample_to_rate(stored, 1000, 500, dtype=np.int16)
+        self.assertEqual(resampled.dtype, np.int16)
+        self.assertEqual(resampled.shape, (1, 500))
+
+    def test_resample_records(self):
+        ecgs = [np.ones((12, 2500)), np.ones((12, 10000)), np.ones((12, 2500))]
+        resampled = resample_records(ecgs, [250, 1000, 250], 500)
+        self.assertEqual([ecg.shape for ecg in resampled], [(12, 5000)] * 3)
+
+
+class SignalStoreTestCase(unittest.TestCase):
+    def test_pad_or_truncate(self):
+        ecg_data = np.arange(8, dtype=np.int16).reshape(2, 4)
+        np.testing.assert_array_equal(pad_or_truncate(ecg_data, 2), [[0, 1], [4, 5]])
+        np.testing.assert_array_equal(pad_or_truncate(ecg_data, 2, trunc="pre"), [[2, 3], [6, 7]])
+        padded = pad_or_truncate(ecg_data, 6, value=np.array([-1, -2]))
+        self.assertEqual(padded.dtype, np.int16)
+        np.testing.assert_array_equal(padded, [[0, 1, 2, 3, -1, -1], [4, 5, 6, 7, -2, -2]])
+        np.testing.assert_array_equal(pad_or_truncate(ecg_data, 5, pad="pre"), [[0, 0, 1, 2, 3], [0, 4, 5, 6, 7]])
+
+    def test_writer_round_trip(self):
+        stored = np.random.default_rng(0).integers(-1000, 1000, size=(3, 12, 50), dtype=np.int16)
+        stored[1, 2, 5] = -32768
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with SignalStoreWriter(tmp_dir, 4, ecg_len=50) as writer:
+                for idx in range(3):
+                    writer.append(stored[idx], np.full(12, 200.0), np.full(12, 10.0), record_id=f'{idx:03d}')
+            store = SignalStore(tmp_dir)
+            self.assertEqual(len(store), 3)
+            self.assertEqual(store.get_record_ids().tolist(), ['000', '001', '002'])
+            np.testing.assert_array_equal(store.get_stored_signal(1), stored[1])
+            signal_data = store.get_signal(np.arange(3))
+            self.assertEqual(signal_data.dtype, np.float32)
+            self.assertTrue(np.isnan(signal_data[1, 2, 5]))
+            np.testing.assert_allclose(signal_data[0], (stored[0] - 10.0) / 200.0, rtol=1e-6)
+            self.assertEqual(len(set(store.get_content_hashes())), 3)
+            del store
+
+    def test_pack_challenge_signals(self):
+        from scipy.io import savemat
+        ecg_data = np.tile(np.rint(300 * np.sin(np.arange(1000) / 20)).astype(np.int16), (12, 1))
+        ecg_data[3, 400:410] = -32768
+        lead_lines = ''.join(f'A0001.mat 16+24 1000/mV 16 0 0 0 0 {lead}\n' for lead in range(12))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(Path(tmp_dir) / 'A0001.hea', 'w') as f:
+                f.write(f'A0001 12 250 1000\n{lead_lines}')
+            savemat(Path(tmp_dir) / 'A0001.mat', {'val': ecg_data})
+            store = pack_challenge_signals(tmp_dir, f'{tmp_dir}/store', ecg_len=2500, num_workers=1,
+                                           dataset='Georgia')
+            self.assertEqual(store.manifest.loc[0, 'record_id'], 'A0001')
+            self.assertEqual(store.manifest.loc[0, 'source_fs'], 250)
+            stored_signal = store.get_stored_signal(0)
+            self.assertEqual(stored_signal.shape, (12, 2500))
+            # the missing samples stay missing and are not spread by the resampling filter
+            missing = np.flatnonzero(stored_signal[3] == -32768)
+            self.assertTrue(np.all((missing >= 798) & (missing <= 820)))
+            self.assertFalse(np.any(stored_signal[[0, 4]] == -32768))
+            np.testing.assert_array_equal(store.adc_gain[0], np.full(12, 1000))
+            np.testing.assert_array_equal(stored_signal[0, 2000:], 0)
+            # the content hash is the one of the raw samples, before resampling and padding
+            self.assertEqual(store.get_content_hashes()[0], content_hash(ecg_data))
+            del store
+            # the records that cannot be read are skipped
+            savemat(Path(tmp_dir) / 'A0002.mat', {'val': ecg_data.astype(np.int32) * 200})
+            with open(Path(tmp_dir) / 'A0002.hea', 'w') as f:
+                f.write(f'A0002 12 250 1000\n{lead_lines}')
+            savemat(Path(tmp_dir) / 'A0003.mat', {'val': ecg_data[:6]})
+            with open(Path(tmp_dir) / 'A0003.hea', 'w') as f:
+                f.write('A0003 6 250 1000\n' +
+                        ''.join(f'A0003.mat 16+24 1000/mV 16 0 0 0 0 {lead}\n' for lead in range(6)))
+            store = pack_challenge_signals(tmp_dir, f'{tmp_dir}/store', ecg_len=2500, num_workers=1)
+            self.assertEqual(store.get_record_ids().tolist(), ['A0001'])
+            del store
+
+    def test_pack_mimic_signals(self):
+        physical = np.random.default_rng(0).normal(size=(5000, 12))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            record_dir = Path(tmp_dir) / 'files' / 'p1000' / 'p10000032' / 's40689238'
+            record_dir.mkdir(parents=True)
+            wfdb.wrsamp('40689238', fs=500, units=['mV'] * 12, sig_name=[f'L{lead}' for lead in range(12)],
+                        p_signal=physical, fmt=['16'] * 12, adc_gain=[200.0] * 12, baseline=[0] * 12,
+                        comments=['<subject_id>: 10000032'], write_dir=str(record_dir))
+            store = pack_mimic_signals(Path(tmp_dir) / 'files', f'{tmp_dir}/store', num_workers=1)
+            manifest_row = store.manifest.loc[0]
+            self.assertEqual((manifest_row['record_id'], str(manifest_row['study_id'])),
+                             ('10000032_40689238', '40689238'))
+            self.assertLessEqual(np.max(np.abs(store.get_signal(0) - physical.T)), 0.5 / 200 + 1e-6)
+            del store
+
+
+class FuzzyAliasMatcherTestCase(unittest.TestCase):
+    lookup_dict = {'Atrial Fibrillation': ['AF', 'Atrial fibrillation'],
+                   'Sinus Bradycardia': ['Sinus bradycardia', 'SB'],
+                   'Left Bundle Branch Block': ['Left bundle branch block', 'LBBB']}
+
+    def test_match(self):
+        matcher = FuzzyAliasMatcher(self.lookup_dict)
+        matches = matcher.match_many(['Atrial fibrilation.', 'sinus bradicardia', 'left bundle brnch block',
+                                      'completely unrelated text'])
+        self.assertEqual(matches['Atrial fibrilation.'][0], 'atrial fibrillation')
+        self.assertEqual(matches['Atrial fibrilation.'][2], ['Atrial Fibrillation'])
+        self.assertEqual(matches['sinus bradicardia'][2], ['Sinus Bradycardia'])
+        self.assertEqual(matches['left bundle brnch block'][2], ['Left Bundle Branch Block'])
+        self.assertNotIn('completely unrelated text', matches)
+        self.assertIsNone(matcher.match(''))
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = f'{tmp_dir}/fuzzy_matches.json'
+            matches = FuzzyAliasMatcher(self.lookup_dict, cache_path=cache_path).match_many(['atrial fibrilation'])
+            # the cached reports are not scored again
+            matcher = FuzzyAliasMatcher(self.lookup_dict, cache_path=cache_path)
+            self.assertIn('atrial fibrilation', matcher.cache)
+            matcher.get_candidates = None
+            self.assertEqual(matcher.match_many(['atrial fibrilation']), matches)
+            # the cache is dropped when the aliases change
+            changed_lookup_dict = dict(self.lookup_dict, **{'Atrial Flutter': ['AFL']})
+            self.assertEqual(FuzzyAliasMatcher(changed_lookup_dict, cache_path=cache_path).cache, {})
+            self.assertEqual(FuzzyAliasMatcher(self.lookup_dict, cache_path=cache_path, ngram=2).cache, {})
+
+
+class RecordCacheTestCase(unittest.TestCase):
+    def test_lru_budget(self):
+        record_cache = RecordCache(max_bytes=2 * 12 * 5000 * 2)
+        loads = []
+
+        def load(key):
+            loads.append(key)
+            return np.full((12, 5000), key, dtype=np.int16), {'key': key}
+
+        for key in [0, 1, 0, 2, 0, 1]:
+            stored_signal, record = record_cache.get_or_load(key, lambda: load(key))
+            self.assertEqual(stored_signal[0, 0], key)
+        self.assertEqual(loads, [0, 1, 2, 1])
+        stats = record_cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (2, 4, 2))
+        self.assertLessEqual(stats['num_bytes'], stats['max_bytes'])
+
+    def test_shared_cache(self):
+        record_cache = SharedRecordCache(max_bytes=8 * (12 * 500 * 2 + 2048), signal_shape=(12, 500))
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                wfdb.wrsamp('40689238', fs=500, units=['mV'] * 12, sig_name=[f'L{lead}' for lead in range(12)],
+                            p_signal=np.random.default_rng(0).normal(size=(500, 12)), fmt=['16'] * 12,
+                            adc_gain=[200.0] * 12, baseline=[0] * 12, comments=['<subject_id>: 10000032'],
+                            write_dir=tmp_dir)
+                record_path = f'{tmp_dir}/40689238'
+                stored_signal, record = record_cache.get_or_load(record_path, lambda: read_wfdb_record(record_path))
+            # a hit reads nothing from disk, the record files are gone
+            cached_signal, header = record_cache.get_or_load(record_path, None)
+            np.testing.assert_array_equal(cached_signal, stored_signal)
+            for field in ['record_name', 'adc_gain', 'baseline', 'fs', 'sig_len', 'sig_name', 'units', 'comments']:
+                self.assertEqual(getattr(header, field), getattr(record, field))
+            self.assertEqual(get_signal_metadata(header), get_signal_metadata(record))
+            self.assertEqual(record_cache.get_stats()['hits'], 1)
+            # a float signal would be truncated to int16 by a slot, it is not cached
+            float_load = lambda: (np.full((12, 500), 0.5), record)
+            record_cache.get_or_load('b', float_load)
+            stored_signal, _ = record_cache.get_or_load('b', float_load)
+            np.testing.assert_array_equal(stored_signal, 0.5)
+            self.assertEqual(record_cache.get_stats()['hits'], 1)
+        finally:
+            record_cache.close()
+
+
 def get_subject_id(signal_metadata):
     subject_id = signal_metadata["comments"]
     